@@ -1,17 +1,43 @@
 from datetime import datetime
 from datetime import date
+from datetime import timedelta
+from typing import Callable
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
 import pytz
 
 from datastore import DataStore, Appointment, Patient
+from datastore import AppointmentKey
+from datastore import AppointmentRow
+from datastore import PatientRow
+from datastore import new_appointment_ids
 from exceptions import NoResultsException, TimeInTheFutureException
-from exceptions import InvalidStatusChangeException
 from exceptions import TimeInThePastException
 from exceptions import PatientNotFoundException
-from messages import MSG_CANT_REINSTATE_CANCELLED
-from utils import Duration, MINS_TO_DURATION, Status
+from exceptions import PatientAlreadyExistsException
+from exceptions import AppointmentAlreadyExistsException
+from exceptions import BatchTooLargeException
+from exceptions import ClinicianUnavailableException
+from exceptions import InvalidTimeRangeException
+from exceptions import TimeRangeTooLongException
+from schedule import ScheduleIndex
+from schedule import clinician_spans
+from schedule import appointment_end
+from schedule import as_utc
+from schedule import free_slots
+from schedule import naive_utc
+from schedule import utc_days
+from utils import Duration, MINS_TO_DURATION, NameMatch
 from utils import DURATION_TO_MINS
+from utils import decode_cursor
+from utils import encode_cursor
+from utils import etag_matches
+from utils import make_etag
 
 utc = pytz.UTC
 
@@ -38,6 +64,37 @@ def patient_to_dict(patient: Patient) -> dict:
     }
 
 
+# Response value of each Duration by minutes, saves an Enum lookup per row
+DURATION_VALUES = {mins: duration.value for mins, duration in MINS_TO_DURATION.items()}
+
+
+def appointment_row_to_dict(row: AppointmentRow) -> dict:
+    """
+    appointment_to_dict for the list endpoints, which read AppointmentRows rather than Appointments
+    """
+    appointment_id, patient_id, status, time, duration_mins, clinician, department, postcode = row
+    return {
+        "clinician": clinician,
+        "department": department,
+        "duration": DURATION_VALUES[duration_mins],
+        "id": appointment_id,
+        "patient": patient_id,
+        "postcode": postcode,
+        "status": status,
+        "time": time
+    }
+
+
+def patient_row_to_dict(row: PatientRow) -> dict:
+    nhs_num, name, date_of_birth, postcode = row
+    return {
+        "date_of_birth": date_of_birth,
+        "name": name,
+        "patient": nhs_num,
+        "postcode": postcode
+    }
+
+
 def time_in_the_future(time: datetime) -> bool:
     return time > datetime.now().replace(tzinfo=utc)
 
@@ -46,9 +103,250 @@ def date_in_the_future(dateVal: date) -> bool:
     return dateVal > datetime.now().date()
 
 
+def skipped_appointments(appointments: List[Appointment], errors: List[Optional[str]],
+                         created: List[str]) -> List[int]:
+    """
+    :param errors: The errors found before the appointments were passed to DataStore.create_appointments
+    :param created: ids of the appointments it stored
+    :return: Indexes of the appointments it skipped, only the first appointment with a given id is stored
+    """
+    created_ids = set(created)
+    skipped: List[int] = []
+    for idx, appointment in enumerate(appointments):
+        if errors[idx] is not None:
+            continue
+        if appointment.id in created_ids:
+            created_ids.remove(appointment.id)
+        else:
+            skipped.append(idx)
+    return skipped
+
+
+def skipped_errors(appointments: List[Appointment], skipped: List[int], stored: Set[str],
+                   schedules: ScheduleIndex, errors: List[Optional[str]]) -> None:
+    """
+    Explain why DataStore.create_appointments skipped appointments, it checks ids and double-booking as it
+    stores the rest, but doesn't say which check failed
+    :param skipped: Indexes of the skipped appointments
+    :param stored: ids of the skipped appointments which are in use
+    :param schedules: The active appointments across the spans of the other skipped appointments' clinicians
+    :param errors: Updated with an error message for each skipped appointment
+    """
+    for idx in skipped:
+        appointment = appointments[idx]
+        if appointment.id in stored:
+            errors[idx] = AppointmentAlreadyExistsException(appointment.id).user_message
+        else:
+            clashes = schedules.overlapping(appointment.clinician, appointment.time, appointment_end(appointment),
+                                            exclude_id=appointment.id)
+            errors[idx] = ClinicianUnavailableException(clashes[0] if clashes else "").user_message
+
+
+def appointments_to_create(appointments: List[Appointment]) -> Tuple[List[Optional[str]], List[Appointment]]:
+    """
+    Check a batch of appointments before they are passed to DataStore.create_appointments
+    Appointments without an id are given one
+    :return: Tuple of: an error message for each appointment, None where it passed; the appointments which passed
+    """
+    errors: List[Optional[str]] = [None] * len(appointments)
+    now = datetime.now().replace(tzinfo=utc)
+    future: List[Appointment] = []
+    for idx, appointment in enumerate(appointments):
+        if appointment.time > now:
+            future.append(appointment)
+        else:
+            errors[idx] = TimeInThePastException(str(appointment.time)).user_message
+
+    new_ids = iter(new_appointment_ids(sum(1 for appointment in future if appointment.id is None)))
+    for appointment in future:
+        if appointment.id is None:
+            appointment.id = next(new_ids)
+    return errors, future
+
+
+def skipped_spans(appointments: List[Appointment], skipped: List[int],
+                  stored: Set[str]) -> Dict[str, Tuple[datetime, datetime]]:
+    """
+    :return: The spans to read each clinician's appointments across, to find what the skipped appointments
+    whose ids aren't in use clash with
+    """
+    return clinician_spans(appointments[idx] for idx in skipped if appointments[idx].id not in stored)
+
+
+def patients_to_create(patients: List[Patient]) -> Tuple[List[Optional[str]], List[Patient]]:
+    """
+    Check a batch of patients before they are passed to DataStore.create_patients
+    :return: Tuple of: an error message for each patient, None where it passed; the patients which passed
+    """
+    errors: List[Optional[str]] = [None] * len(patients)
+    today = datetime.now().date()
+    valid: List[Patient] = []
+    for idx, patient in enumerate(patients):
+        if patient.date_of_birth > today:
+            errors[idx] = TimeInTheFutureException(str(patient.date_of_birth)).user_message
+        else:
+            valid.append(patient)
+    return errors, valid
+
+
+def skipped_patient_errors(patients: List[Patient], created: List[str], errors: List[Optional[str]]) -> None:
+    """
+    :param created: NHS Numbers which DataStore.create_patients stored
+    :param errors: From patients_to_create, updated with an error for each patient which wasn't stored
+    """
+    created_ids = set(created)
+    for idx, patient in enumerate(patients):
+        if errors[idx] is not None:
+            continue
+        if patient.nhs_num in created_ids:
+            # Only the first patient with a given NHS Number is stored
+            created_ids.remove(patient.nhs_num)
+        else:
+            errors[idx] = PatientAlreadyExistsException(patient.nhs_num).user_message
+
+
+def deleted_patient_errors(patient_ids: List[str], deleted: List[str]) -> List[Optional[str]]:
+    """
+    :param deleted: NHS Numbers which DataStore.delete_patients deleted
+    :return: An error message for each NHS Number, in the same order, None where the patient was deleted
+    """
+    deleted_ids = set(deleted)
+    errors: List[Optional[str]] = []
+    for patient_id in patient_ids:
+        if patient_id in deleted_ids:
+            # A repeated NHS Number is only deleted once
+            deleted_ids.remove(patient_id)
+            errors.append(None)
+        else:
+            errors.append(PatientNotFoundException(patient_id).user_message)
+    return errors
+
+
+def status_change_only(appointment_time: Optional[datetime], duration_mins: Optional[int],
+                       clinician: Optional[str], status: Optional[str]) -> bool:
+    """
+    :return: True if an update only changes the status, which can't double-book, so the DataStore can check the
+    status change rules and make the change in one statement
+    """
+    return status is not None and appointment_time is None and duration_mins is None and clinician is None
+
+
+def unless_current(entity: Union[Appointment, Patient], to_dict: Callable[..., dict],
+                   if_none_match: Optional[str]) -> Tuple[Optional[dict], str]:
+    """
+    The ETag is checked before the response dict is built, so nothing is built for a client whose copy is current
+    :param entity: The patient or appointment
+    :param to_dict: Builds the response dict of the entity
+    :param if_none_match: If-None-Match header rxd from the FE
+    :return: Tuple of: response dict, None if if_none_match matches; ETag of the entity
+    """
+    etag = make_etag(entity.incarnation, entity.version)
+    if etag_matches(if_none_match, etag):
+        return None, etag
+    return to_dict(entity), etag
+
+
+def page_after(cursor: Optional[str]) -> Optional[AppointmentKey]:
+    """
+    :return: The key to page from, None for the first page
+    """
+    return decode_cursor(cursor) if cursor is not None else None
+
+
+def appointments_page(rows: List[AppointmentRow], limit: int) -> Tuple[List[dict], Optional[str]]:
+    """
+    :param rows: Up to limit + 1 rows, the extra row says there is another page
+    :return: Tuple of: appointments, cursor for the next page or None if this is the last page
+    """
+    appointments = [appointment_row_to_dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(appointments[-1]["time"], appointments[-1]["id"])
+    return appointments, next_cursor
+
+
 APPOINTMENT_ID_FIELD = "appointment_id"
 PATIENT_ID_FIELD = "patient_id"
 
+# Most patients returned by a prefix or fuzzy name search, unless the results are streamed
+NAME_SEARCH_LIMIT = 100
+# Longest time range searched for free slots in one request
+MAX_FREE_SLOT_DAYS = 31
+# Most patients or appointments fetched by one batch get
+MAX_BATCH_GET = 5000
+DURATIONS_BY_LENGTH = sorted(Duration, key=DURATION_TO_MINS.get)
+
+
+def name_search_limit(match: NameMatch) -> Optional[int]:
+    """
+    Prefix and fuzzy searches return at most NAME_SEARCH_LIMIT patients, the best matches
+    """
+    return NAME_SEARCH_LIMIT if match != NameMatch.EXACT else None
+
+
+def check_time_range(start: datetime, end: datetime) -> Tuple[datetime, datetime]:
+    """
+    :return: start and end in UTC
+    """
+    start, end = as_utc(start), as_utc(end)
+    if end <= start:
+        raise InvalidTimeRangeException(f"{start} - {end}")
+    return start, end
+
+
+def batch_keys(keys: List[str]) -> List[str]:
+    """
+    Check the size of a batch get
+    :return: keys with any repeats dropped, in the order requested
+    """
+    keys = list(dict.fromkeys(keys))
+    if len(keys) > MAX_BATCH_GET:
+        raise BatchTooLargeException(str(len(keys)))
+    return keys
+
+
+def batch_get_result(keys: List[str], found: Dict[str, dict], entities_field: str) -> dict:
+    """
+    :param keys: ids requested, from batch_keys
+    :param found: id -> response dict of each entity found
+    :param entities_field: Response field for the entities found
+    :return: Response with the entities found, in the order requested, and the ids which weren't
+    """
+    return {entities_field: [found[key] for key in keys if key in found],
+            "not_found": [key for key in keys if key not in found]}
+
+
+def free_slot_range(start: datetime, end: datetime) -> Tuple[datetime, datetime]:
+    """
+    Check the range of a free slot search, the part already in the past is dropped
+    :return: start and end of the search, start is not before end
+    """
+    start, end = check_time_range(start, end)
+    if end - start > timedelta(days=MAX_FREE_SLOT_DAYS):
+        raise TimeRangeTooLongException(f"{start} - {end}")
+    start = max(start, datetime.now().replace(tzinfo=utc))
+    return min(start, end), end
+
+
+def free_slots_to_dicts(booked: List[Appointment], start: datetime, end: datetime,
+                        duration: Optional[Duration]) -> List[dict]:
+    """
+    :param booked: The clinician's active appointments overlapping [start, end), may repeat
+    :param duration: Only return slots which can fit this duration, any duration if None
+    :return: Each free slot, with the durations it can fit, times are naive UTC so they are formatted like
+    appointment times
+    """
+    shortest = DURATION_TO_MINS[duration] if duration is not None else min(DURATION_TO_MINS.values())
+    slots = []
+    for slot_start, slot_end in free_slots(booked, start, end, timedelta(minutes=shortest)):
+        slot_mins = (slot_end - slot_start) / timedelta(minutes=1)
+        slots.append({
+            "start": naive_utc(slot_start),
+            "end": naive_utc(slot_end),
+            "durations": [fits.value for fits in DURATIONS_BY_LENGTH if DURATION_TO_MINS[fits] <= slot_mins]
+        })
+    return slots
+
 
 class PatientAppointmentsApp:
     """
@@ -64,31 +362,139 @@ class PatientAppointmentsApp:
         duration_mins = DURATION_TO_MINS[duration]
         if not time_in_the_future(appointment_time):
             raise TimeInThePastException(str(appointment_time))
+        # The DataStore checks for double-booking as it stores the appointment
         appointment_id = self.dataStore.create_appointment(patient, appointment_time, duration_mins,
                                                            clinician, department, postcode, appointment_id=existing_id)
         return {APPOINTMENT_ID_FIELD: appointment_id}
 
+    def create_appointments(self, appointments: List[Appointment]) -> List[Optional[str]]:
+        """
+        Create many appointments at once
+        Each appointment is checked individually, the valid ones are stored together in one transaction
+        Appointments which would double-book a clinician, including with an earlier appointment in the
+        same batch, aren't created
+        Appointments without an id are given one
+        :param appointments: Appointments to create, they are always created active
+        :return: An error message for each appointment, in the same order, None where the appointment was created
+        """
+        errors, future = appointments_to_create(appointments)
+        created = self.dataStore.create_appointments(future)
+        skipped = skipped_appointments(appointments, errors, created)
+        if skipped:
+            stored = {appt.id for appt in self.dataStore.get_appointments_by_id(
+                [appointments[idx].id for idx in skipped])}
+            schedules = ScheduleIndex()
+            for clinician, (start, end) in skipped_spans(appointments, skipped, stored).items():
+                for booked in self.dataStore.get_overlapping_appointments(clinician, start, end):
+                    schedules.add(booked)
+            skipped_errors(appointments, skipped, stored, schedules, errors)
+        return errors
+
+    def get_appointments_by_id(self, appointment_ids: List[str]) -> dict:
+        """
+        Get many appointments at once
+        :param appointment_ids: ids of the appointments, at most MAX_BATCH_GET
+        :return: appointments: the appointments found, in the order requested; not_found: ids with no appointment
+        """
+        appointment_ids = batch_keys(appointment_ids)
+        found = {appt.id: appointment_to_dict(appt) for appt in self.dataStore.get_appointments_by_id(appointment_ids)}
+        return batch_get_result(appointment_ids, found, "appointments")
+
     def get_appointment(self, appointment_id: str) -> dict:
         appointment = self.dataStore.get_appointment(appointment_id)
         if appointment is None:
             raise NoResultsException(appointment_id)
         return appointment_to_dict(appointment)
 
+    def get_appointment_if_changed(self, appointment_id: str,
+                                   if_none_match: Optional[str] = None) -> Tuple[Optional[dict], str]:
+        """
+        Get an appointment unless the client's copy is current
+        :param appointment_id: id of the appointment
+        :param if_none_match: If-None-Match header rxd from the FE
+        :return: Tuple of: appointment, None if if_none_match matches; ETag of the appointment
+        """
+        appointment = self.dataStore.get_appointment(appointment_id)
+        if appointment is None:
+            raise NoResultsException(appointment_id)
+        return unless_current(appointment, appointment_to_dict, if_none_match)
+
     def get_patient_appointments(self, patient: str) -> List[dict]:
-        return [appointment_to_dict(appt) for appt in self.dataStore.get_appointments(patient)]
+        return [appointment_row_to_dict(row) for row in self.dataStore.get_appointment_rows(patient)]
 
     def get_clinician_appointments(self, clinician: str) -> List[dict]:
-        return [appointment_to_dict(appt) for appt in self.dataStore.get_clinician_appointments(clinician)]
+        return [appointment_row_to_dict(row) for row in self.dataStore.get_clinician_appointment_rows(clinician)]
+
+    def iter_patient_appointments(self, patient: str) -> Iterator[dict]:
+        return (appointment_row_to_dict(row) for row in self.dataStore.iter_appointment_rows(patient))
+
+    def iter_clinician_appointments(self, clinician: str) -> Iterator[dict]:
+        return (appointment_row_to_dict(row) for row in self.dataStore.iter_clinician_appointment_rows(clinician))
+
+    def get_patient_appointments_page(self, patient: str, limit: int,
+                                      cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Get one page of a patient's appointments, ordered by time
+        :param patient: NHS Number of the patient
+        :param limit: Maximum number of appointments in the page
+        :param cursor: Cursor returned with the previous page, None for the first page
+        :return: Tuple of: appointments, cursor for the next page or None if this is the last page
+        """
+        # Ask for one extra to find out if there is another page
+        return appointments_page(self.dataStore.get_appointment_rows(patient, limit=limit + 1,
+                                                                     after=page_after(cursor)), limit)
+
+    def get_clinician_appointments_page(self, clinician: str, limit: int,
+                                        cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Get one page of a clinician's appointments, ordered by time
+        :param clinician: Name of the clinician
+        :param limit: Maximum number of appointments in the page
+        :param cursor: Cursor returned with the previous page, None for the first page
+        :return: Tuple of: appointments, cursor for the next page or None if this is the last page
+        """
+        return appointments_page(self.dataStore.get_clinician_appointment_rows(clinician, limit=limit + 1,
+                                                                               after=page_after(cursor)), limit)
+
+    def get_department_appointments_page(self, department: str, start: datetime, end: datetime,
+                                         status: Optional[str], limit: int,
+                                         cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Get one page of a department's appointments starting in a time range, ordered by time
+        :param department: Name of the department
+        :param start: Start of the range
+        :param end: End of the range
+        :param status: Only return appointments with this status, any status if None
+        :param limit: Maximum number of appointments in the page
+        :param cursor: Cursor returned with the previous page, None for the first page
+        :return: Tuple of: appointments, cursor for the next page or None if this is the last page
+        """
+        start, end = check_time_range(start, end)
+        return appointments_page(self.dataStore.get_department_appointment_rows(
+            department, start, end, status=status, limit=limit + 1, after=page_after(cursor)), limit)
+
+    def get_clinician_free_slots(self, clinician: str, start: datetime, end: datetime,
+                                 duration: Optional[Duration] = None) -> List[dict]:
+        """
+        Find the gaps in a clinician's schedule that can fit an appointment
+        The clinician's appointments are read a day at a time, which a caching DataStore serves from memory
+        :param clinician: Name of the clinician
+        :param start: Start of the search
+        :param end: End of the search, at most MAX_FREE_SLOT_DAYS after start
+        :param duration: Only return slots which can fit this duration, any duration if None
+        :return: Free slots in time order
+        """
+        start, end = free_slot_range(start, end)
+        booked = [appt for day in utc_days(start, end) for appt in self.dataStore.get_clinician_day(clinician, day)]
+        return free_slots_to_dicts(booked, start, end, duration)
 
     def update_appointment(self, appointment_id: str, *, appointment_time: Optional[datetime] = None,
                            duration: Optional[Duration] = None, clinician: Optional[str] = None,
                            status: Optional[str] = None) -> dict:
-        if status is not None:
-            appt: Appointment = self.dataStore.get_appointment(appointment_id)
-            if appt.status == Status.CANCELLED.value and status == Status.ACTIVE.value:
-                # Cancelled appointments cannot be reinstated
-                raise InvalidStatusChangeException(MSG_CANT_REINSTATE_CANCELLED)
         duration_mins = DURATION_TO_MINS[duration] if duration is not None else None
+        if status_change_only(appointment_time, duration_mins, clinician, status):
+            return {APPOINTMENT_ID_FIELD: self.dataStore.update_appointment_status(appointment_id, status)}
+        # The DataStore checks for double-booking as it makes the change
         appt_id = self.dataStore.update_appointment(appointment_id, appointment_time=appointment_time,
                                                     duration_mins=duration_mins, clinician=clinician,
                                                     status=status)
@@ -100,20 +506,74 @@ class PatientAppointmentsApp:
         patient_id = self.dataStore.create_patient(patient, date_of_birth, patient_name, postcode)
         return {PATIENT_ID_FIELD: patient_id}
 
+    def create_patients(self, patients: List[Patient]) -> List[Optional[str]]:
+        """
+        Create many patients at once
+        Each patient is checked individually, the valid ones are stored together
+        :param patients: Patients to create
+        :return: An error message for each patient, in the same order, None where the patient was created
+        """
+        errors, valid = patients_to_create(patients)
+        skipped_patient_errors(patients, self.dataStore.create_patients(valid), errors)
+        return errors
+
     def update_patient(self, patient: str, *, date_of_birth: Optional[date] = None,
                        patient_name: Optional[str] = None, postcode: Optional[str] = None) -> dict:
         patient_id = self.dataStore.update_patient(patient, date_of_birth=date_of_birth,
                                                    patient_name=patient_name, postcode=postcode)
         return {PATIENT_ID_FIELD: patient_id}
 
+    def get_patients_by_id(self, patient_ids: List[str]) -> dict:
+        """
+        Get many patients at once
+        :param patient_ids: NHS Numbers of the patients, at most MAX_BATCH_GET
+        :return: patients: the patients found, in the order requested; not_found: NHS Numbers with no patient
+        """
+        patient_ids = batch_keys(patient_ids)
+        found = {patient.nhs_num: patient_to_dict(patient)
+                 for patient in self.dataStore.get_patients_by_id(patient_ids)}
+        return batch_get_result(patient_ids, found, "patients")
+
     def get_patient(self, patient_id: str) -> dict:
         patient: Patient = self.dataStore.get_patient(patient_id)
         if patient is None:
             raise PatientNotFoundException(patient_id)
         return patient_to_dict(patient)
 
-    def find_patient(self, patient_name: str, date_of_birth: Optional[date]) -> List[dict]:
-        return [patient_to_dict(patient) for patient in self.dataStore.findPatient(patient_name, date_of_birth)]
+    def get_patient_if_changed(self, patient_id: str,
+                               if_none_match: Optional[str] = None) -> Tuple[Optional[dict], str]:
+        """
+        Get a patient unless the client's copy is current
+        :param patient_id: NHS Number of the patient
+        :param if_none_match: If-None-Match header rxd from the FE
+        :return: Tuple of: patient, None if if_none_match matches; ETag of the patient
+        """
+        patient: Patient = self.dataStore.get_patient(patient_id)
+        if patient is None:
+            raise PatientNotFoundException(patient_id)
+        return unless_current(patient, patient_to_dict, if_none_match)
+
+    def find_patient(self, patient_name: str, date_of_birth: Optional[date],
+                     match: NameMatch = NameMatch.EXACT) -> List[dict]:
+        """
+        Find patients by name, see DataStore.findPatient
+        Prefix and fuzzy searches return at most NAME_SEARCH_LIMIT patients, the best matches
+        """
+        return [patient_row_to_dict(row) for row in self.dataStore.find_patient_rows(
+            patient_name, date_of_birth, match=match.value, limit=name_search_limit(match))]
+
+    def iter_find_patient(self, patient_name: str, date_of_birth: Optional[date],
+                          match: NameMatch = NameMatch.EXACT) -> Iterator[dict]:
+        return (patient_row_to_dict(row)
+                for row in self.dataStore.iter_patient_rows(patient_name, date_of_birth, match=match.value))
 
     def delete_patient(self, patient_id) -> dict:
         return {"patient": self.dataStore.delete_patient(patient_id)}
+
+    def delete_patients(self, patient_ids: List[str]) -> List[Optional[str]]:
+        """
+        Delete many patients, and all of their appointments, in one transaction
+        :param patient_ids: NHS Numbers of the patients to delete
+        :return: An error message for each NHS Number, in the same order, None where the patient was deleted
+        """
+        return deleted_patient_errors(patient_ids, self.dataStore.delete_patients(patient_ids))
@@ -0,0 +1,219 @@
+from datetime import datetime
+from datetime import date
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from application import APPOINTMENT_ID_FIELD
+from application import PATIENT_ID_FIELD
+from application import appointment_row_to_dict
+from application import appointment_to_dict
+from application import appointments_page
+from application import appointments_to_create
+from application import batch_get_result
+from application import batch_keys
+from application import check_time_range
+from application import date_in_the_future
+from application import deleted_patient_errors
+from application import free_slot_range
+from application import free_slots_to_dicts
+from application import name_search_limit
+from application import page_after
+from application import patient_row_to_dict
+from application import patient_to_dict
+from application import patients_to_create
+from application import skipped_appointments
+from application import skipped_errors
+from application import skipped_patient_errors
+from application import skipped_spans
+from application import status_change_only
+from application import time_in_the_future
+from application import unless_current
+from datastore import AsyncDataStore, Appointment, Patient
+from exceptions import NoResultsException, TimeInTheFutureException
+from exceptions import TimeInThePastException
+from exceptions import PatientNotFoundException
+from schedule import ScheduleIndex
+from schedule import utc_days
+from utils import Duration, NameMatch
+from utils import DURATION_TO_MINS
+
+
+class AsyncPatientAppointmentsApp:
+    """
+    Repository of Application business logic for the async handlers
+    The same checks as PatientAppointmentsApp, made against an AsyncDataStore, the rules themselves are module
+    functions of application shared by both
+    """
+    def __init__(self, dataStore: AsyncDataStore):
+        self.dataStore = dataStore
+
+    async def create_appointment(self, patient: str, appointment_time: datetime, duration: Duration,
+                                 clinician: str, department: str, postcode: str,
+                                 existing_id: Optional[str] = None) -> dict:
+        duration_mins = DURATION_TO_MINS[duration]
+        if not time_in_the_future(appointment_time):
+            raise TimeInThePastException(str(appointment_time))
+        # The DataStore checks for double-booking as it stores the appointment
+        appointment_id = await self.dataStore.create_appointment(patient, appointment_time, duration_mins,
+                                                                 clinician, department, postcode,
+                                                                 appointment_id=existing_id)
+        return {APPOINTMENT_ID_FIELD: appointment_id}
+
+    async def create_appointments(self, appointments: List[Appointment]) -> List[Optional[str]]:
+        """
+        Create many appointments at once, see PatientAppointmentsApp.create_appointments
+        :param appointments: Appointments to create, they are always created active
+        :return: An error message for each appointment, in the same order, None where the appointment was created
+        """
+        errors, future = appointments_to_create(appointments)
+        created = await self.dataStore.create_appointments(future)
+        skipped = skipped_appointments(appointments, errors, created)
+        if skipped:
+            stored = {appt.id for appt in await self.dataStore.get_appointments_by_id(
+                [appointments[idx].id for idx in skipped])}
+            schedules = ScheduleIndex()
+            for clinician, (start, end) in skipped_spans(appointments, skipped, stored).items():
+                for booked in await self.dataStore.get_overlapping_appointments(clinician, start, end):
+                    schedules.add(booked)
+            skipped_errors(appointments, skipped, stored, schedules, errors)
+        return errors
+
+    async def get_appointments_by_id(self, appointment_ids: List[str]) -> dict:
+        """
+        Get many appointments at once, see PatientAppointmentsApp.get_appointments_by_id
+        """
+        appointment_ids = batch_keys(appointment_ids)
+        found = {appt.id: appointment_to_dict(appt)
+                 for appt in await self.dataStore.get_appointments_by_id(appointment_ids)}
+        return batch_get_result(appointment_ids, found, "appointments")
+
+    async def get_appointment_if_changed(self, appointment_id: str,
+                                         if_none_match: Optional[str] = None) -> Tuple[Optional[dict], str]:
+        """
+        Get an appointment unless the client's copy is current
+        :param appointment_id: id of the appointment
+        :param if_none_match: If-None-Match header rxd from the FE
+        :return: Tuple of: appointment, None if if_none_match matches; ETag of the appointment
+        """
+        appointment = await self.dataStore.get_appointment(appointment_id)
+        if appointment is None:
+            raise NoResultsException(appointment_id)
+        return unless_current(appointment, appointment_to_dict, if_none_match)
+
+    async def get_patient_appointments(self, patient: str) -> List[dict]:
+        return [appointment_row_to_dict(row) for row in await self.dataStore.get_appointment_rows(patient)]
+
+    async def get_clinician_appointments(self, clinician: str) -> List[dict]:
+        return [appointment_row_to_dict(row) for row in await self.dataStore.get_clinician_appointment_rows(clinician)]
+
+    async def get_patient_appointments_page(self, patient: str, limit: int,
+                                            cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Get one page of a patient's appointments, see PatientAppointmentsApp.get_patient_appointments_page
+        """
+        return appointments_page(
+            await self.dataStore.get_appointment_rows(patient, limit=limit + 1, after=page_after(cursor)), limit)
+
+    async def get_clinician_appointments_page(self, clinician: str, limit: int,
+                                              cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Get one page of a clinician's appointments, see PatientAppointmentsApp.get_clinician_appointments_page
+        """
+        return appointments_page(await self.dataStore.get_clinician_appointment_rows(
+            clinician, limit=limit + 1, after=page_after(cursor)), limit)
+
+    async def get_department_appointments_page(self, department: str, start: datetime, end: datetime,
+                                               status: Optional[str], limit: int,
+                                               cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Get one page of a department's appointments, see PatientAppointmentsApp.get_department_appointments_page
+        """
+        start, end = check_time_range(start, end)
+        return appointments_page(await self.dataStore.get_department_appointment_rows(
+            department, start, end, status=status, limit=limit + 1, after=page_after(cursor)), limit)
+
+    async def get_clinician_free_slots(self, clinician: str, start: datetime, end: datetime,
+                                       duration: Optional[Duration] = None) -> List[dict]:
+        """
+        Find the gaps in a clinician's schedule, see PatientAppointmentsApp.get_clinician_free_slots
+        """
+        start, end = free_slot_range(start, end)
+        booked = [appt for day in utc_days(start, end)
+                  for appt in await self.dataStore.get_clinician_day(clinician, day)]
+        return free_slots_to_dicts(booked, start, end, duration)
+
+    async def update_appointment(self, appointment_id: str, *, appointment_time: Optional[datetime] = None,
+                                 duration: Optional[Duration] = None, clinician: Optional[str] = None,
+                                 status: Optional[str] = None) -> dict:
+        duration_mins = DURATION_TO_MINS[duration] if duration is not None else None
+        if status_change_only(appointment_time, duration_mins, clinician, status):
+            return {APPOINTMENT_ID_FIELD: await self.dataStore.update_appointment_status(appointment_id, status)}
+        # The DataStore checks for double-booking as it makes the change
+        appt_id = await self.dataStore.update_appointment(appointment_id, appointment_time=appointment_time,
+                                                          duration_mins=duration_mins, clinician=clinician,
+                                                          status=status)
+        return {APPOINTMENT_ID_FIELD: appt_id}
+
+    async def create_patient(self, patient: str, date_of_birth: date, patient_name: str, postcode: str) -> dict:
+        if date_in_the_future(date_of_birth):
+            raise TimeInTheFutureException(str(date_of_birth))
+        patient_id = await self.dataStore.create_patient(patient, date_of_birth, patient_name, postcode)
+        return {PATIENT_ID_FIELD: patient_id}
+
+    async def create_patients(self, patients: List[Patient]) -> List[Optional[str]]:
+        """
+        Create many patients at once, see PatientAppointmentsApp.create_patients
+        :param patients: Patients to create
+        :return: An error message for each patient, in the same order, None where the patient was created
+        """
+        errors, valid = patients_to_create(patients)
+        skipped_patient_errors(patients, await self.dataStore.create_patients(valid), errors)
+        return errors
+
+    async def update_patient(self, patient: str, *, date_of_birth: Optional[date] = None,
+                             patient_name: Optional[str] = None, postcode: Optional[str] = None) -> dict:
+        patient_id = await self.dataStore.update_patient(patient, date_of_birth=date_of_birth,
+                                                         patient_name=patient_name, postcode=postcode)
+        return {PATIENT_ID_FIELD: patient_id}
+
+    async def get_patients_by_id(self, patient_ids: List[str]) -> dict:
+        """
+        Get many patients at once, see PatientAppointmentsApp.get_patients_by_id
+        """
+        patient_ids = batch_keys(patient_ids)
+        found = {patient.nhs_num: patient_to_dict(patient)
+                 for patient in await self.dataStore.get_patients_by_id(patient_ids)}
+        return batch_get_result(patient_ids, found, "patients")
+
+    async def get_patient_if_changed(self, patient_id: str,
+                                     if_none_match: Optional[str] = None) -> Tuple[Optional[dict], str]:
+        """
+        Get a patient unless the client's copy is current
+        :param patient_id: NHS Number of the patient
+        :param if_none_match: If-None-Match header rxd from the FE
+        :return: Tuple of: patient, None if if_none_match matches; ETag of the patient
+        """
+        patient: Patient = await self.dataStore.get_patient(patient_id)
+        if patient is None:
+            raise PatientNotFoundException(patient_id)
+        return unless_current(patient, patient_to_dict, if_none_match)
+
+    async def find_patient(self, patient_name: str, date_of_birth: Optional[date],
+                           match: NameMatch = NameMatch.EXACT) -> List[dict]:
+        """
+        Find patients by name, see PatientAppointmentsApp.find_patient
+        """
+        return [patient_row_to_dict(row) for row in await self.dataStore.find_patient_rows(
+            patient_name, date_of_birth, match=match.value, limit=name_search_limit(match))]
+
+    async def delete_patient(self, patient_id) -> dict:
+        return {"patient": await self.dataStore.delete_patient(patient_id)}
+
+    async def delete_patients(self, patient_ids: List[str]) -> List[Optional[str]]:
+        """
+        Delete many patients and their appointments at once, see PatientAppointmentsApp.delete_patients
+        :param patient_ids: NHS Numbers of the patients to delete
+        :return: An error message for each NHS Number, in the same order, None where the patient was deleted
+        """
+        return deleted_patient_errors(patient_ids, await self.dataStore.delete_patients(patient_ids))
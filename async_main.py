@@ -0,0 +1,93 @@
+import importlib
+from typing import Callable
+from typing import Optional
+
+import connexion
+from aiohttp import web
+from connexion.apis.aiohttp_api import AioHttpApi
+from connexion.resolver import Resolver
+
+from async_orm import AsyncAlchemyDatastore
+from datastore import get_async_data_store
+from datastore import set_async_data_store
+from main import get_port
+from metrics import InstrumentedDatastore
+from metrics import instrumented_resolver
+from serialisation import ResponseJsonifier
+from serialisation import set_json_backend
+from sql_profiler import SQL_PROFILER
+from sql_profiler import profiled
+
+
+"""
+asyncio entry point
+
+Serves the API from connexion's aiohttp app using the handlers in async_operations.py.
+connexion 2 has no ASGI support, aiohttp is its asyncio server: each worker handles many
+requests concurrently on one event loop instead of tying up a thread per request.
+
+Development:
+python async_main.py [PORT]
+
+Production, with gunicorn's aiohttp worker:
+gunicorn 'async_main:create_app()' --worker-class aiohttp.GunicornWebWorker --workers 4 --bind 0.0.0.0:8090
+"""
+
+# Modify DB_URL to use a different DB, it must use an async driver
+# See: https://docs.sqlalchemy.org/en/20/orm/extensions/asyncio.html
+DB_URL = 'sqlite+aiosqlite:///PANDA.db'
+
+
+def resolve_async_handler(operation_id: str) -> Callable:
+    """
+    Resolve the operationIds in the API definition to async handlers
+    operations.X is served by async_operations.X, other modules are used as they are
+    """
+    module_name, function_name = operation_id.rsplit('.', 1)
+    if module_name == 'operations':
+        module_name = 'async_operations'
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class PandaAioHttpApi(AioHttpApi):
+    """
+    AioHttpApi serialising responses with the selected JSON backend, see serialisation.py
+    """
+    @classmethod
+    def _set_jsonifier(cls):
+        cls.jsonifier = ResponseJsonifier()
+
+
+def create_app(db_url: str = DB_URL, json_backend: Optional[str] = None, metrics: bool = True,
+               profile_sql: bool = True) -> web.Application:
+    """
+    Create the aiohttp application serving the API
+    The DataStore is created when the application starts, inside the worker's event loop
+    :param db_url: SQLAlchemy DB URL using an async driver
+    :param json_backend: Library responses are serialised with, 'orjson' or 'json', None for the fastest installed
+    :param metrics: Record request handler and DataStore latencies, served from GET /metrics, see metrics.py
+    :param profile_sql: Time every SQL statement and log slow ones, served from GET /admin/sql, see sql_profiler.py
+    :return: aiohttp application
+    """
+    set_json_backend(json_backend)
+    app = connexion.AioHttpApp(__name__, specification_dir='apidef/')
+    app.api_cls = PandaAioHttpApi
+    resolve = profiled(resolve_async_handler)
+    resolver = instrumented_resolver(resolve) if metrics else Resolver(resolve)
+    app.add_api('patient-app.yml', resolver=resolver, pass_context_arg_name='request')
+
+    async def open_data_store(_: web.Application) -> None:
+        data_store = AsyncAlchemyDatastore(db_url, profiler=SQL_PROFILER if profile_sql else None)
+        await data_store.initialise()
+        set_async_data_store(InstrumentedDatastore(data_store) if metrics else data_store)
+
+    async def close_data_store(_: web.Application) -> None:
+        await get_async_data_store().dispose()
+
+    app.app.on_startup.append(open_data_store)
+    app.app.on_cleanup.append(close_data_store)
+    return app.app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=get_port())
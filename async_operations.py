@@ -0,0 +1,352 @@
+from datetime import date
+from datetime import datetime
+from typing import Awaitable
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import Union
+from typing import Tuple
+from typing import TypeVar
+
+from aiohttp import web
+
+from datastore import get_async_data_store
+from exceptions import DataEntryFieldException
+from exceptions import InvalidFieldException
+from exceptions import MissingFieldException
+from metrics import render_metrics
+from sql_profiler import SQL_PROFILER
+from application import APPOINTMENT_ID_FIELD
+from async_application import AsyncPatientAppointmentsApp
+from operations import DEFAULT_PAGE_SIZE
+from operations import _appointment_from_record
+from operations import _chunk_results
+from operations import _conditional_response
+from operations import _error_response
+from operations import _get_page_args
+from operations import _iter_bulk_chunks
+from operations import _page_response
+from operations import _patient_from_record
+from operations import _patient_id_from_record
+
+from utils import get_patient_id
+from utils import get_patient_id_list
+from utils import get_str_list_field
+from utils import get_duration_field
+from utils import get_status_field
+from utils import get_datetime_field
+from utils import get_str_field
+from utils import get_postcode_str
+from utils import get_date_field
+from utils import Duration
+from utils import NameMatch
+from utils import Status
+from utils import strToNameMatch
+
+T = TypeVar('T')
+
+
+"""
+asyncio versions of the request handlers in operations.py
+
+These are used when the API is served by connexion's aiohttp app, see async_main.py,
+where many requests can be in flight at once in each worker process. They validate
+parameters and report errors exactly as the handlers in operations.py do, with the
+helpers imported from there, but await an AsyncPatientAppointmentsApp so waiting on
+the database doesn't block other requests.
+
+Results are always returned in full, the stream parameter is accepted and ignored.
+The aiohttp request is passed in as request, it is used to read headers.
+"""
+
+
+def _get_app() -> AsyncPatientAppointmentsApp:
+    return AsyncPatientAppointmentsApp(get_async_data_store())
+
+
+#######################
+# APPOINTMENT HANDLERS
+#######################
+async def create_appointment(**kwargs) -> Tuple[Union[dict, str], int]:
+    existing_id: Optional[str] = None
+
+    try:
+        existing_id = get_str_field(kwargs, "id")
+    except MissingFieldException:
+        # that's ok, it's optional
+        pass
+
+    try:
+        patient = get_patient_id(kwargs, 'patient')
+        appointment_time = get_datetime_field(kwargs, 'time')
+        duration = get_duration_field(kwargs, 'duration')
+        clinician = get_str_field(kwargs, 'clinician')
+        department = get_str_field(kwargs, 'department')
+        postcode = get_postcode_str(kwargs, 'postcode')
+        return await _get_app().create_appointment(patient, appointment_time, duration, clinician, department,
+                                                   postcode, existing_id=existing_id), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def bulk_create_appointments(body: bytes = b'', **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        created, errors = await _bulk_apply(body, _appointment_from_record, _get_app().create_appointments)
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+    return {"created": len(created),
+            "appointments": [{"line": line_no, APPOINTMENT_ID_FIELD: appt.id} for line_no, appt in created],
+            "errors": errors}, 200
+
+
+async def batch_get_appointments(body: dict, **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        return await _get_app().get_appointments_by_id(get_str_list_field(body, 'ids')), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def get_appointment(request: web.Request, **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        appointment_id = get_str_field(kwargs, 'id')
+        return _conditional_response(
+            await _get_app().get_appointment_if_changed(appointment_id, request.headers.get('If-None-Match')))
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def get_patient_appointments(**kwargs) -> Tuple[Union[List[dict], str], int]:
+    try:
+        patient = get_patient_id(kwargs, 'patient')
+        limit, cursor = _get_page_args(kwargs)
+        if limit is not None:
+            return _page_response(await _get_app().get_patient_appointments_page(patient, limit, cursor))
+        return await _get_app().get_patient_appointments(patient), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def get_clinician_appointments(**kwargs) -> Tuple[Union[List[dict], str], int]:
+    try:
+        clinician = get_str_field(kwargs, 'clinician')
+        limit, cursor = _get_page_args(kwargs)
+        if limit is not None:
+            return _page_response(await _get_app().get_clinician_appointments_page(clinician, limit, cursor))
+        return await _get_app().get_clinician_appointments(clinician), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def get_department_appointments(**kwargs) -> Tuple[Union[List[dict], str], int]:
+    status: Optional[Status] = None
+
+    try:
+        department = get_str_field(kwargs, 'department')
+        start = get_datetime_field(kwargs, 'from')
+        end = get_datetime_field(kwargs, 'to')
+        try:
+            status = get_status_field(kwargs, 'status')
+        except MissingFieldException:
+            # that's ok, it's optional
+            pass
+        # Always paged, a department can have any number of appointments in a range
+        limit, cursor = _get_page_args(kwargs)
+        return _page_response(await _get_app().get_department_appointments_page(
+            department, start, end, status.value if status is not None else None, limit or DEFAULT_PAGE_SIZE, cursor))
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def get_clinician_free_slots(**kwargs) -> Tuple[Union[List[dict], str], int]:
+    duration: Optional[Duration] = None
+
+    try:
+        clinician = get_str_field(kwargs, 'clinician')
+        start = get_datetime_field(kwargs, 'from')
+        end = get_datetime_field(kwargs, 'to')
+        try:
+            duration = get_duration_field(kwargs, 'duration')
+        except MissingFieldException:
+            # that's ok, it's optional
+            pass
+        return await _get_app().get_clinician_free_slots(clinician, start, end, duration=duration), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def update_appointment(**kwargs) -> Tuple[Union[dict, str], int]:
+    appointment_time: Optional[datetime] = None
+    duration: Optional[Duration] = None
+    clinician: Optional[str] = None
+    status: Optional[Status] = None
+
+    try:
+        # Don't mind missing field exceptions as these fields are optional
+        try:
+            appointment_time = get_datetime_field(kwargs, 'time')
+        except MissingFieldException:
+            pass
+        try:
+            duration = get_duration_field(kwargs, 'duration')
+        except MissingFieldException:
+            pass
+        try:
+            clinician = get_str_field(kwargs, 'clinician')
+        except MissingFieldException:
+            pass
+        try:
+            status = get_status_field(kwargs, 'status')
+        except MissingFieldException:
+            pass
+        # However, we do want to capture invalid fields if they've been included
+    except InvalidFieldException as ife:
+        return _error_response(ife)
+
+    try:
+        appointment_id = get_str_field(kwargs, 'id')
+        return await _get_app().update_appointment(appointment_id, appointment_time=appointment_time,
+                                                   duration=duration, clinician=clinician,
+                                                   status=status.value if status is not None else None), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+#######################
+# PATIENT HANDLERS
+#######################
+async def create_patient(**kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        patient = get_patient_id(kwargs, 'nhs_number')
+        date_of_birth = get_date_field(kwargs, 'date_of_birth')
+        patient_name = get_str_field(kwargs, 'name')
+        postcode = get_postcode_str(kwargs, 'postcode')
+        return await _get_app().create_patient(patient, date_of_birth, patient_name, postcode), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def bulk_create_patients(body: bytes = b'', **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        created, errors = await _bulk_apply(body, _patient_from_record, _get_app().create_patients)
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+    return {"created": len(created), "errors": errors}, 200
+
+
+async def update_patient(**kwargs) -> Tuple[Union[dict, str], int]:
+    date_of_birth: Optional[date] = None
+    patient_name: Optional[str] = None
+    postcode: Optional[str] = None
+
+    try:
+        # Don't mind missing field exceptions as these fields are optional
+        try:
+            date_of_birth: Optional[date] = get_date_field(kwargs, 'date_of_birth')
+        except MissingFieldException:
+            pass
+        try:
+            patient_name = get_str_field(kwargs, 'name')
+        except MissingFieldException:
+            pass
+        try:
+            postcode = get_postcode_str(kwargs, 'postcode')
+        except MissingFieldException:
+            pass
+        # However, we do want to capture invalid fields if they've been included
+    except InvalidFieldException as ife:
+        return _error_response(ife)
+
+    try:
+        patient_id = get_patient_id(kwargs, 'nhs_number')
+        return await _get_app().update_patient(patient_id, date_of_birth=date_of_birth,
+                                               patient_name=patient_name, postcode=postcode), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def batch_get_patients(body: dict, **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        return await _get_app().get_patients_by_id(get_patient_id_list(body, 'nhs_numbers')), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def get_patient(request: web.Request, **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        patient_id = get_patient_id(kwargs, 'nhs_number')
+        return _conditional_response(
+            await _get_app().get_patient_if_changed(patient_id, request.headers.get('If-None-Match')))
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def find_patient(**kwargs) -> Tuple[Union[List[dict], str], int]:
+    date_of_birth: Optional[date] = None
+
+    # Don't mind missing field exceptions as these fields are optional
+    try:
+        date_of_birth: Optional[date] = get_date_field(kwargs, 'date_of_birth')
+    except MissingFieldException:
+        pass
+    # However, we do want to capture invalid fields if they've been included
+    except InvalidFieldException as ife:
+        return _error_response(ife)
+
+    try:
+        patient_name = get_str_field(kwargs, 'name')
+        match = strToNameMatch(kwargs.get('match', NameMatch.EXACT.value))
+        return await _get_app().find_patient(patient_name, date_of_birth, match), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def delete_patient(**kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        patient_id = get_str_field(kwargs, 'nhs_number')
+        return await _get_app().delete_patient(patient_id), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+async def bulk_delete_patients(request: web.Request, **kwargs) -> Tuple[Union[dict, str], int]:
+    # connexion only passes request bodies to POST, PUT and PATCH handlers, so read it here
+    body = await request.read()
+    try:
+        deleted, errors = await _bulk_apply(body, _patient_id_from_record, _get_app().delete_patients)
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+    return {"deleted": len(deleted), "errors": errors}, 200
+
+
+#######################
+# ADMIN HANDLERS
+#######################
+async def get_cache_stats(**kwargs) -> Tuple[dict, int]:
+    # The async DataStore isn't cached
+    return {}, 200
+
+
+async def get_metrics(**kwargs) -> Tuple[str, int]:
+    return render_metrics(), 200
+
+
+async def get_sql_profile(**kwargs) -> Tuple[dict, int]:
+    return SQL_PROFILER.report(), 200
+
+
+#######################
+# BULK HELPERS
+#######################
+async def _bulk_apply(body: bytes, record_to_entity: Callable[[dict], T],
+                      apply_to_entities: Callable[[List[T]], Awaitable[List[Optional[str]]]]
+                      ) -> Tuple[List[Tuple[int, T]], List[dict]]:
+    """
+    Validate the records in a bulk request body and apply an app method to them in chunks of BULK_CHUNK_SIZE
+    See operations._bulk_apply
+    """
+    applied: List[Tuple[int, T]] = []
+    errors: List[dict] = []
+    for chunk in _iter_bulk_chunks(body, record_to_entity, errors):
+        _chunk_results(chunk, await apply_to_entities([entity for _, entity in chunk]), applied, errors)
+    errors.sort(key=lambda error: error["line"])
+    return applied, errors
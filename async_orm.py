@@ -0,0 +1,162 @@
+from datetime import date
+from datetime import datetime
+from typing import Callable
+from typing import List
+from typing import Optional
+from typing import TypeVar
+
+from sqlalchemy import Connection
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from datastore import AsyncDataStore
+from datastore import Appointment
+from datastore import AppointmentKey
+from datastore import AppointmentRow
+from datastore import Patient
+from datastore import PatientRow
+from migrations import upgrade_connection
+from orm import AlchemyDatastore
+from orm import Base
+from sql_profiler import SqlProfiler
+from utils import NameMatch
+
+T = TypeVar('T')
+
+
+"""
+asyncio SQLAlchemy DataStore
+
+AsyncAlchemyDatastore uses SQLAlchemy's asyncio engine with an async driver, e.g.
+sqlite+aiosqlite:///PANDA.db, so that waiting on the database doesn't block the
+event loop.
+
+The queries themselves are the ones in orm.py. Each method checks out an async
+connection and runs the matching AlchemyDatastore method on it through
+AsyncConnection.run_sync, which is how SQLAlchemy's own AsyncSession works: the
+synchronous ORM code runs in a greenlet and every database call in it is awaited
+on the event loop. Keeping one copy of the queries means the two DataStores can't
+drift apart.
+"""
+
+
+class AsyncAlchemyDatastore(AsyncDataStore):
+
+    def __init__(self, db_url: str, profiler: Optional[SqlProfiler] = None):
+        """
+        initialise() must be awaited before the DataStore is used
+        :param db_url: SQLAlchemy DB URL using an async driver
+        :param profiler: Times every statement and logs slow ones, see sql_profiler.py
+        """
+        self.engine = create_async_engine(db_url)
+        if profiler is not None:
+            profiler.attach(self.engine.sync_engine)
+
+    async def initialise(self) -> int:
+        """
+        Create any missing tables and apply outstanding migrations
+        :return: Schema version after the upgrade
+        """
+        async with self.engine.begin() as connection:
+            return await connection.run_sync(upgrade_connection, Base.metadata)
+
+    async def dispose(self) -> None:
+        await self.engine.dispose()
+
+    async def _run(self, method: Callable[..., T], *args, **kwargs) -> T:
+        def run(connection: Connection) -> T:
+            return method(AlchemyDatastore.for_connection(connection), *args, **kwargs)
+
+        async with self.engine.connect() as connection:
+            return await connection.run_sync(run)
+
+    async def create_appointment(self, patient: str, appointment_time: datetime, duration_mins: int,
+                                 clinician: str, department: str, postcode: str,
+                                 appointment_id: Optional[str] = None) -> str:
+        return await self._run(AlchemyDatastore.create_appointment, patient, appointment_time, duration_mins,
+                               clinician, department, postcode, appointment_id=appointment_id)
+
+    async def create_appointments(self, appointments: List[Appointment]) -> List[str]:
+        return await self._run(AlchemyDatastore.create_appointments, appointments)
+
+    async def get_appointment(self, appointment_id: str) -> Appointment:
+        return await self._run(AlchemyDatastore.get_appointment, appointment_id)
+
+    async def get_appointments_by_id(self, appointment_ids: List[str]) -> List[Appointment]:
+        return await self._run(AlchemyDatastore.get_appointments_by_id, appointment_ids)
+
+    async def get_appointments(self, patient_id: str, limit: Optional[int] = None,
+                               after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return await self._run(AlchemyDatastore.get_appointments, patient_id, limit=limit, after=after)
+
+    async def get_clinician_appointments(self, clinician: str, limit: Optional[int] = None,
+                                         after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return await self._run(AlchemyDatastore.get_clinician_appointments, clinician, limit=limit, after=after)
+
+    async def get_overlapping_appointments(self, clinician: str, start: datetime,
+                                           end: datetime) -> List[Appointment]:
+        return await self._run(AlchemyDatastore.get_overlapping_appointments, clinician, start, end)
+
+    async def get_department_appointments(self, department: str, start: datetime, end: datetime,
+                                          status: Optional[str] = None, limit: Optional[int] = None,
+                                          after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return await self._run(AlchemyDatastore.get_department_appointments, department, start, end,
+                               status=status, limit=limit, after=after)
+
+    async def get_appointment_rows(self, patient_id: str, limit: Optional[int] = None,
+                                   after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return await self._run(AlchemyDatastore.get_appointment_rows, patient_id, limit=limit, after=after)
+
+    async def get_clinician_appointment_rows(self, clinician: str, limit: Optional[int] = None,
+                                             after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return await self._run(AlchemyDatastore.get_clinician_appointment_rows, clinician, limit=limit, after=after)
+
+    async def get_department_appointment_rows(self, department: str, start: datetime, end: datetime,
+                                              status: Optional[str] = None, limit: Optional[int] = None,
+                                              after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return await self._run(AlchemyDatastore.get_department_appointment_rows, department, start, end,
+                               status=status, limit=limit, after=after)
+
+    async def update_appointment(self, appointment_id: str, appointment_time: Optional[datetime] = None,
+                                 duration_mins: Optional[int] = None, clinician: Optional[str] = None,
+                                 status: Optional[str] = None) -> str:
+        return await self._run(AlchemyDatastore.update_appointment, appointment_id,
+                               appointment_time=appointment_time, duration_mins=duration_mins,
+                               clinician=clinician, status=status)
+
+    async def update_appointment_status(self, appointment_id: str, status: str) -> str:
+        return await self._run(AlchemyDatastore.update_appointment_status, appointment_id, status)
+
+    async def create_patient(self, patient_id: str, date_of_birth: date, patient_name: str, postcode: str) -> str:
+        return await self._run(AlchemyDatastore.create_patient, patient_id, date_of_birth, patient_name, postcode)
+
+    async def create_patients(self, patients: List[Patient]) -> List[str]:
+        return await self._run(AlchemyDatastore.create_patients, patients)
+
+    async def update_patient(self, patient_id: str, date_of_birth: Optional[date] = None,
+                             patient_name: Optional[str] = None, postcode: Optional[str] = None) -> str:
+        return await self._run(AlchemyDatastore.update_patient, patient_id, date_of_birth=date_of_birth,
+                               patient_name=patient_name, postcode=postcode)
+
+    async def get_patient(self, patient_id: str) -> Patient:
+        return await self._run(AlchemyDatastore.get_patient, patient_id)
+
+    async def get_patients_by_id(self, patient_ids: List[str]) -> List[Patient]:
+        return await self._run(AlchemyDatastore.get_patients_by_id, patient_ids)
+
+    async def findPatient(self, patient_name: str, date_of_birth: Optional[date],
+                          match: str = NameMatch.EXACT.value, limit: Optional[int] = None) -> List[Patient]:
+        return await self._run(AlchemyDatastore.findPatient, patient_name, date_of_birth, match=match, limit=limit)
+
+    async def find_patient_rows(self, patient_name: str, date_of_birth: Optional[date],
+                                match: str = NameMatch.EXACT.value, limit: Optional[int] = None) -> List[PatientRow]:
+        return await self._run(AlchemyDatastore.find_patient_rows, patient_name, date_of_birth, match=match,
+                               limit=limit)
+
+    async def delete_patient(self, patient_id: str) -> str:
+        return await self._run(AlchemyDatastore.delete_patient, patient_id)
+
+    async def delete_patients(self, patient_ids: List[str]) -> List[str]:
+        return await self._run(AlchemyDatastore.delete_patients, patient_ids)
+
+    async def is_db_empty(self) -> bool:
+        return await self._run(AlchemyDatastore.is_db_empty)
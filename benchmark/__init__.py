@@ -0,0 +1,21 @@
+import timeit
+from typing import Callable
+
+
+"""
+Performance benchmarks
+
+Each module is a standalone benchmark, run from the repository root, e.g.:
+python -m benchmark.bench_dates
+"""
+
+
+def time_per_call(func: Callable[[], object], number: int, repeat: int = 5) -> float:
+    """
+    Time func, taking the best of several runs to reduce noise from the rest of the system
+    :param func: Function to time
+    :param number: Calls per run
+    :param repeat: Number of runs
+    :return: Seconds per call in the fastest run
+    """
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
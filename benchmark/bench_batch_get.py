@@ -0,0 +1,45 @@
+import sys
+import tempfile
+from typing import List
+
+from application import PatientAppointmentsApp
+from benchmark import time_per_call
+from benchmark.data import generate_patients
+from orm import AlchemyDatastore
+
+
+"""
+Fetching a ward dashboard's patients from SQLite: one get_patient per NHS Number,
+as repeated GET /patients/{nhs_number} requests do, compared with one batch get
+reading them with chunked IN queries in a single Session
+python -m benchmark.bench_batch_get [PATIENTS [BATCH ...]]
+"""
+
+DEFAULT_PATIENTS = 100000
+DEFAULT_BATCHES = [100, 1000, 5000]
+
+
+def main(count: int, batches: List[int]) -> None:
+    with tempfile.TemporaryDirectory() as db_dir:
+        data_store = AlchemyDatastore(f"sqlite:///{db_dir}/bench.db")
+        patients = generate_patients(count)
+        data_store.create_patients(patients)
+        patient_app = PatientAppointmentsApp(data_store)
+
+        print(f"{'batch':>8}{'one by one ms':>16}{'batch get ms':>16}{'speed up':>10}")
+        for batch in batches:
+            # Spread over the table rather than adjacent keys
+            nhs_nums = [patient.nhs_num for patient in patients[::max(1, count // batch)][:batch]]
+            one_by_one = [patient_app.get_patient(nhs_num) for nhs_num in nhs_nums]
+            assert patient_app.get_patients_by_id(nhs_nums)["patients"] == one_by_one
+
+            number = max(1, 2000 // batch)
+            single = time_per_call(lambda: [patient_app.get_patient(nhs_num) for nhs_num in nhs_nums], number, 3)
+            batched = time_per_call(lambda: patient_app.get_patients_by_id(nhs_nums), number, 3)
+            print(f"{len(nhs_nums):>8}{single * 1000:>16.1f}{batched * 1000:>16.1f}{single / batched:>9.1f}x")
+        data_store.dispose()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PATIENTS,
+         [int(arg) for arg in sys.argv[2:]] or DEFAULT_BATCHES)
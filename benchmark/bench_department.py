@@ -0,0 +1,71 @@
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+from typing import Callable
+from typing import List
+
+import pytz
+
+from benchmark.data import generate_clinician_appointments
+from datastore import Appointment
+from orm import AlchemyDatastore
+
+
+"""
+A department's day sheet from SQLite: fanning out over every clinician with
+get_clinician_appointments and filtering in Python, compared with one
+get_department_appointments range scan of the (department, time) index
+python -m benchmark.bench_department [APPOINTMENTS_PER_CLINICIAN]
+"""
+
+DEFAULT_COUNT = 10000
+CLINICIANS = 20
+DEPARTMENT = "oncology"
+DAYS = 10
+
+
+def _time(func: Callable[[], object], number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def _fan_out(data_store: AlchemyDatastore, clinicians: List[str], start: datetime, end: datetime) -> List[Appointment]:
+    appointments = [appt for clinician in clinicians for appt in data_store.get_clinician_appointments(clinician)
+                    if appt.department == DEPARTMENT and start <= appt.time.replace(tzinfo=pytz.UTC) < end]
+    return sorted(appointments, key=lambda appt: (appt.time, appt.id))
+
+
+def main(count: int) -> None:
+    clinicians = [f"Clinician {idx}" for idx in range(CLINICIANS)]
+    start = datetime(2030, 1, 1, tzinfo=pytz.UTC)
+    with tempfile.TemporaryDirectory() as db_dir:
+        data_store = AlchemyDatastore(f"sqlite:///{db_dir}/bench.db")
+        for idx, clinician in enumerate(clinicians):
+            # Half of the clinicians work in another department
+            department = DEPARTMENT if idx % 2 == 0 else "cardiology"
+            data_store.create_appointments(generate_clinician_appointments(count, clinician, seed=idx,
+                                                                           start=start, department=department))
+        day = start + timedelta(days=DAYS)
+        day_end = day + timedelta(days=1)
+        indexed = data_store.get_department_appointments(DEPARTMENT, day, day_end)
+        assert [appt.id for appt in indexed] == [appt.id for appt in _fan_out(data_store, clinicians, day, day_end)]
+
+        results = [
+            ("fan out over clinicians", _time(lambda: _fan_out(data_store, clinicians, day, day_end), 3)),
+            ("department range scan", _time(lambda: data_store.get_department_appointments(
+                DEPARTMENT, day, day_end), 100)),
+        ]
+        data_store.dispose()
+
+    print(f"{CLINICIANS} clinicians with {count} appointments each, {len(indexed)} on the day sheet")
+    print(f"{'query':<28}{'ms':>10}")
+    for name, secs in results:
+        print(f"{name:<28}{secs * 1e3:>10.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,49 @@
+import json
+import sys
+
+from connexion.apps.flask_app import FlaskJSONEncoder
+
+from application import appointment_to_dict
+from benchmark import time_per_call
+from benchmark.data import generate_clinician_appointments
+from serialisation import JSON_BACKENDS
+from serialisation import ResponseJsonifier
+from serialisation import iter_json_array
+from serialisation import set_json_backend
+
+
+"""
+Serialising an appointment list response: Flask's JSON provider with connexion's
+encoder, as responses were serialised before, compared with each installed
+JsonBackend as a full response and as a streamed response
+python -m benchmark.bench_json [APPOINTMENTS]
+"""
+
+DEFAULT_COUNT = 10000
+NUMBER = 5
+
+
+def main(count: int) -> None:
+    # Naive datetimes, as read back from SQLite
+    appointments = [appointment_to_dict(appt) for appt in generate_clinician_appointments(count, "Francis Stewart")]
+    for appointment in appointments:
+        appointment["time"] = appointment["time"].replace(tzinfo=None)
+    jsonifier = ResponseJsonifier(indent=True, sort_keys=True)
+
+    results = [("flask json encoder", time_per_call(
+        lambda: json.dumps(appointments, cls=FlaskJSONEncoder, indent=2, sort_keys=True), NUMBER))]
+    for name in JSON_BACKENDS:
+        set_json_backend(name)
+        results.append((f"{name} response", time_per_call(lambda: jsonifier.dumps(appointments), NUMBER)))
+        results.append((f"{name} streamed", time_per_call(lambda: "".join(iter_json_array(appointments)), NUMBER)))
+    set_json_backend(None)
+
+    print(f"{count} appointments")
+    print(f"{'serialiser':<24}{'ms':>10}{'speed-up':>10}")
+    before = results[0][1]
+    for name, secs in results:
+        print(f"{name:<24}{secs * 1e3:>10.2f}{before / secs:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,91 @@
+import random
+import sys
+import tempfile
+import time
+from itertools import islice
+from typing import Callable
+from typing import List
+
+from sqlalchemy import text
+
+from benchmark.data import add_typo
+from benchmark.data import iter_generated_patients
+from datastore import Patient
+from orm import AlchemyDatastore
+from utils import NameMatch
+from utils import normalise_name
+
+
+"""
+Patient name searches on SQLite: exact, prefix and fuzzy searches through
+AlchemyDatastore.findPatient, with a prefix search scanning lower(name) for
+comparison. Fuzzy searches are for names with a typo in them, recall is the
+proportion which find the patient that was meant
+python -m benchmark.bench_names [PATIENTS]
+"""
+
+DEFAULT_COUNT = 5000000
+LOAD_BATCH_SIZE = 10000
+QUERIES = 100
+LIMIT = 100
+
+
+def _time_per_query(func: Callable[[Patient], object], patients: List[Patient]) -> float:
+    start = time.perf_counter()
+    for patient in patients:
+        func(patient)
+    return (time.perf_counter() - start) / len(patients)
+
+
+def main(count: int) -> None:
+    rng = random.Random(2)
+    sample_every = max(1, count // QUERIES)
+    queries: List[Patient] = []
+    with tempfile.TemporaryDirectory() as db_dir:
+        data_store = AlchemyDatastore(f"sqlite:///{db_dir}/bench.db")
+        load_start = time.perf_counter()
+        patients = iter_generated_patients(count)
+        while True:
+            batch = list(islice(patients, LOAD_BATCH_SIZE))
+            if not batch:
+                break
+            data_store.create_patients(batch)
+            queries.extend(patient for patient in batch if int(patient.nhs_num) % sample_every == 0)
+        load_secs = time.perf_counter() - load_start
+        queries = queries[:QUERIES]
+        typos = {patient.nhs_num: add_typo(patient.name, rng) for patient in queries}
+
+        def scan_prefix(patient: Patient) -> list:
+            with data_store.engine.connect() as connection:
+                return connection.execute(text("SELECT * FROM patient WHERE lower(name) LIKE :prefix LIMIT :limit"),
+                                          {"prefix": patient.name[:5].lower() + "%", "limit": LIMIT}).all()
+
+        def fuzzy(patient: Patient, with_date_of_birth: bool) -> bool:
+            found = data_store.findPatient(typos[patient.nhs_num],
+                                           patient.date_of_birth if with_date_of_birth else None,
+                                           NameMatch.FUZZY.value, limit=LIMIT)
+            return patient.nhs_num in {match.nhs_num for match in found}
+
+        results = [
+            ("exact name", _time_per_query(lambda p: data_store.findPatient(p.name, None), queries)),
+            ("exact name and DOB", _time_per_query(lambda p: data_store.findPatient(p.name, p.date_of_birth),
+                                                   queries)),
+            ("prefix, lower(name) scan", _time_per_query(scan_prefix, queries[:10])),
+            ("prefix", _time_per_query(lambda p: data_store.findPatient(
+                normalise_name(p.name)[:5], None, NameMatch.PREFIX.value, limit=LIMIT), queries)),
+            ("fuzzy", _time_per_query(lambda p: fuzzy(p, False), queries[:20])),
+            ("fuzzy and DOB", _time_per_query(lambda p: fuzzy(p, True), queries)),
+        ]
+        recall = sum(fuzzy(patient, False) for patient in queries[:20]) / len(queries[:20])
+        recall_dob = sum(fuzzy(patient, True) for patient in queries) / len(queries)
+        data_store.dispose()
+
+    print(f"{count} patients loaded in {load_secs:.1f}s")
+    print(f"{'search':<28}{'ms':>10}")
+    for name, secs in results:
+        print(f"{name:<28}{secs * 1e3:>10.2f}")
+    print(f"fuzzy recall {recall:.2f}, with DOB {recall_dob:.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,48 @@
+import sys
+import time
+from typing import Callable
+
+import numpy as np
+
+from dev_tools import generate_nhs_num
+from dev_tools import generate_nhs_nums
+from utils import validate_patient_id
+from utils import validate_patient_ids
+
+
+"""
+NHS Number validation and generation: the vectorised batch functions compared
+with calling the per-number functions in a loop
+python -m benchmark.bench_nhs_numbers [COUNT]
+"""
+
+DEFAULT_COUNT = 1000000
+
+
+def _time(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(count: int) -> None:
+    nhs_nums = generate_nhs_nums(count, np.random.default_rng(1))
+    # Make roughly 1 in 10 invalid
+    nhs_nums = [nhs_num if idx % 10 else nhs_num[:9] + str((int(nhs_num[9]) + 1) % 10)
+                for idx, nhs_num in enumerate(nhs_nums)]
+    assert validate_patient_ids(nhs_nums).tolist() == [validate_patient_id(nhs_num) for nhs_num in nhs_nums]
+
+    results = [
+        ("validate_patient_id loop", _time(lambda: [validate_patient_id(nhs_num) for nhs_num in nhs_nums])),
+        ("validate_patient_ids", _time(lambda: validate_patient_ids(nhs_nums))),
+        ("generate_nhs_num loop", _time(lambda: [generate_nhs_num() for _ in range(count)])),
+        ("generate_nhs_nums", _time(lambda: generate_nhs_nums(count))),
+    ]
+    print(f"{count} NHS Numbers")
+    print(f"{'implementation':<28}{'secs':>8}{'numbers/s':>14}")
+    for name, secs in results:
+        print(f"{name:<28}{secs:>8.2f}{count / secs:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,58 @@
+import re
+import sys
+import time
+from typing import Callable
+from typing import List
+
+from benchmark.data import generate_postcodes
+from utils import normalise_postcodes
+from utils import validate_postcode
+
+
+"""
+Postcode validation: the compiled single pass validator and batch API in utils,
+compared with the previous implementation
+python -m benchmark.bench_postcodes [COUNT]
+"""
+
+DEFAULT_COUNT = 1000000
+
+# The previous implementation of utils.validate_postcode
+LEGACY_POSTCODE_REGEX = \
+    r"^([A-PR-UWYZ0-9][A-HK-Y0-9][AEHMNPRTVXY0-9]?[ABEHMNPRVWXY0-9]? {1,2}[0-9][ABD-HJLN-UW-Z]{2}|GIR 0AA)$"
+
+
+def legacy_validate_postcode(postcode: str) -> bool:
+    no_space = postcode.replace(" ", "")
+    if len(no_space) < 5:
+        return False
+    for permitted_space_idx in [4, 3, 2]:
+        if re.match(LEGACY_POSTCODE_REGEX, f"{no_space[:permitted_space_idx]} {no_space[permitted_space_idx:]}"):
+            return True
+    return False
+
+
+def _time(func: Callable[[], List]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(count: int) -> None:
+    postcodes = generate_postcodes(count)
+    legacy = [legacy_validate_postcode(postcode) for postcode in postcodes]
+    assert [normalised is not None for normalised in normalise_postcodes(postcodes)] == legacy
+
+    results = [
+        ("legacy validate_postcode", _time(lambda: [legacy_validate_postcode(p) for p in postcodes])),
+        ("validate_postcode", _time(lambda: [validate_postcode(p) for p in postcodes])),
+        ("normalise_postcodes (batch)", _time(lambda: normalise_postcodes(postcodes))),
+    ]
+    print(f"{count} postcodes, {sum(legacy)} valid")
+    print(f"{'implementation':<30}{'secs':>8}{'postcodes/s':>14}")
+    for name, secs in results:
+        print(f"{name:<30}{secs:>8.2f}{count / secs:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,69 @@
+import sys
+import tempfile
+import time
+from typing import Callable
+from typing import List
+
+from application import appointment_row_to_dict
+from application import appointment_to_dict
+from application import patient_row_to_dict
+from application import patient_to_dict
+from benchmark.data import generate_clinician_appointments
+from benchmark.data import generate_patients
+from orm import AlchemyDatastore
+
+
+"""
+List endpoint responses from SQLite: ORM entities copied into response dicts,
+compared with the Core column select whose rows are mapped straight to the
+dicts. Each list has the given number of rows
+python -m benchmark.bench_rows [ROWS ...]
+"""
+
+DEFAULT_COUNTS = [10000, 100000]
+CLINICIAN = "Francis Stewart"
+PATIENT_NAME = "Chloe Cooney"
+
+
+def _rows_per_sec(func: Callable[[], List[dict]], number: int) -> float:
+    start = time.perf_counter()
+    rows = 0
+    for _ in range(number):
+        rows += len(func())
+    return rows / (time.perf_counter() - start)
+
+
+def main(counts: List[int]) -> None:
+    print(f"{'rows':>8}  {'list':<24}{'ORM rows/s':>14}{'Core rows/s':>14}{'speed up':>10}")
+    for count in counts:
+        number = max(1, 200000 // count)
+        with tempfile.TemporaryDirectory() as db_dir:
+            data_store = AlchemyDatastore(f"sqlite:///{db_dir}/bench.db")
+            data_store.create_appointments(generate_clinician_appointments(count, CLINICIAN))
+            patients = generate_patients(count)
+            for patient in patients:
+                patient.name = PATIENT_NAME
+            data_store.create_patients(patients)
+
+            lists = [
+                ("patient appointments",
+                 lambda: [appointment_to_dict(appt) for appt in data_store.get_appointments("1953262716")],
+                 lambda: [appointment_row_to_dict(row) for row in data_store.get_appointment_rows("1953262716")]),
+                ("clinician appointments",
+                 lambda: [appointment_to_dict(appt) for appt in data_store.get_clinician_appointments(CLINICIAN)],
+                 lambda: [appointment_row_to_dict(row)
+                          for row in data_store.get_clinician_appointment_rows(CLINICIAN)]),
+                ("find patient",
+                 lambda: [patient_to_dict(patient) for patient in data_store.findPatient(PATIENT_NAME, None)],
+                 lambda: [patient_row_to_dict(row) for row in data_store.find_patient_rows(PATIENT_NAME, None)]),
+            ]
+            for name, orm_path, core_path in lists:
+                assert orm_path() == core_path()
+                orm_rate = _rows_per_sec(orm_path, number)
+                core_rate = _rows_per_sec(core_path, number)
+                print(f"{count:>8}  {name:<24}{orm_rate:>14,.0f}{core_rate:>14,.0f}{core_rate / orm_rate:>9.1f}x")
+            data_store.dispose()
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_COUNTS)
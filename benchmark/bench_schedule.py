@@ -0,0 +1,100 @@
+import random
+import sys
+import tempfile
+import time
+from datetime import timedelta
+from typing import Callable
+from typing import List
+
+from application import PatientAppointmentsApp
+from benchmark.data import generate_clinician_appointments
+from cache import CachingDatastore
+from datastore import Appointment
+from memory_datastore import MemoryDatastore
+from orm import AlchemyDatastore
+from schedule import ClinicianSchedule
+from schedule import appointment_end
+from schedule import free_slots
+from schedule import overlaps
+
+
+"""
+Double-booking checks against one clinician's diary: the sorted-interval
+ClinicianSchedule compared with scanning every appointment, and the DataStores'
+get_overlapping_appointments. Then a week's free slot search: fetching the
+clinician's whole history as the booking screens used to, compared with the free
+slot search with and without the clinician day cache
+python -m benchmark.bench_schedule [APPOINTMENTS_PER_CLINICIAN]
+"""
+
+DEFAULT_COUNT = 100000
+CHECKS = 1000
+FREE_SLOT_SEARCHES = 20
+CLINICIAN = "Francis Stewart"
+
+
+def _time_per_check(func: Callable[[object, object], object], probes: list) -> float:
+    start = time.perf_counter()
+    for probe_start, probe_end in probes:
+        func(probe_start, probe_end)
+    return (time.perf_counter() - start) / len(probes)
+
+
+def _scan(appointments: List[Appointment], start, end) -> List[str]:
+    return [appointment.id for appointment in appointments if overlaps(appointment, start, end)]
+
+
+def main(count: int) -> None:
+    appointments = generate_clinician_appointments(count, CLINICIAN)
+    rng = random.Random(2)
+    probes = []
+    for _ in range(CHECKS):
+        appointment = rng.choice(appointments)
+        probe_start = appointment.time + timedelta(minutes=rng.randrange(-60, 60))
+        probes.append((probe_start, probe_start + timedelta(minutes=30)))
+
+    schedule = ClinicianSchedule()
+    for appointment in appointments:
+        schedule.add(appointment.id, appointment.time, appointment_end(appointment))
+    assert all(schedule.overlapping(*probe) == _scan(appointments, *probe) for probe in probes[:20])
+
+    memory = MemoryDatastore()
+    memory.create_appointments(appointments)
+    with tempfile.TemporaryDirectory() as db_dir:
+        alchemy = AlchemyDatastore(f"sqlite:///{db_dir}/bench.db")
+        alchemy.create_appointments(appointments)
+        results = [
+            ("scan every appointment", _time_per_check(lambda s, e: _scan(appointments, s, e), probes[:50])),
+            ("ClinicianSchedule", _time_per_check(schedule.overlapping, probes)),
+            ("MemoryDatastore", _time_per_check(
+                lambda s, e: memory.get_overlapping_appointments(CLINICIAN, s, e), probes)),
+            ("AlchemyDatastore SQLite", _time_per_check(
+                lambda s, e: alchemy.get_overlapping_appointments(CLINICIAN, s, e), probes)),
+        ]
+        week = [(probe_start, probe_start + timedelta(days=7)) for probe_start, _ in probes[:FREE_SLOT_SEARCHES]]
+        uncached = PatientAppointmentsApp(alchemy)
+        cached = PatientAppointmentsApp(CachingDatastore(alchemy))
+        for search_start, search_end in week:
+            cached.get_clinician_free_slots(CLINICIAN, search_start, search_end)
+        searches = [
+            ("fetch whole history", _time_per_check(
+                lambda s, e: free_slots([appt for appt in alchemy.get_clinician_appointments(CLINICIAN)
+                                         if overlaps(appt, s, e)], s, e, timedelta(minutes=15)), week[:3])),
+            ("free slot search", _time_per_check(
+                lambda s, e: uncached.get_clinician_free_slots(CLINICIAN, s, e), week)),
+            ("free slot search, cached", _time_per_check(
+                lambda s, e: cached.get_clinician_free_slots(CLINICIAN, s, e), week)),
+        ]
+        alchemy.dispose()
+
+    print(f"{count} appointments for one clinician")
+    print(f"{'check':<28}{'us per check':>14}")
+    for name, secs in results:
+        print(f"{name:<28}{secs * 1e6:>14.2f}")
+    print(f"{'week of free slots, SQLite':<28}{'ms per search':>14}")
+    for name, secs in searches:
+        print(f"{name:<28}{secs * 1e3:>14.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT)
@@ -0,0 +1,231 @@
+import random
+import string
+import uuid
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Iterator
+from typing import List
+from typing import Sequence
+
+import numpy as np
+import pytz
+
+from datastore import Appointment
+from datastore import Patient
+from utils import DURATION_TO_MINS
+from utils import NHS_NUM_WEIGHTS
+from utils import Status
+
+
+"""
+Synthetic data for the benchmarks
+Generators take a seed so that runs can be repeated with the same data
+The iter_ generators yield one record at a time, so millions can be loaded without holding them all
+"""
+
+DEPARTMENTS = ["oncology", "paediatrics", "orthopaedics", "gastroentology"]
+
+# The first 9 digits of the NHS Numbers from iter_nhs_nums are a permutation of 0..10**9 - 1, idx * multiplier + offset
+# The multiplier is coprime with 10**9 so no number repeats
+_NHS_NUM_BASES = 10 ** 9
+_NHS_NUM_MULTIPLIER = 3 ** 18
+_DIGIT_PLACES = 10 ** np.arange(8, -1, -1, dtype=np.int64)
+
+# Characters allowed at each position of the outward code, see utils.POSTCODE_PATTERN
+_AREA_1 = "ABCDEFGHIJKLMNOPRSTUWYZ"
+_AREA_2 = "ABCDEFGHKLMNOPQRSTUVWXY"
+_DISTRICT_LETTER_3 = "AEHMNPRTVXY"
+_DISTRICT_LETTER_4 = "ABEHMNPRVWXY"
+_INWARD_LETTERS = "ABDEFGHJLNPQRSTUWXYZ"
+# Outward code formats, A is a letter, 9 a digit
+_OUTWARD_FORMATS = ["A9", "A99", "AA9", "AA99", "A9A", "AA9A"]
+
+_FIRST_NAMES = ["Abigail", "Adam", "Aisha", "Alan", "Amelia", "Andrew", "Anna", "Arjun", "Barbara", "Ben", "Bryan",
+                "Carol", "Charlotte", "Chloe", "Chloé", "Daniel", "David", "Deborah", "Dylan", "Eleanor", "Emily",
+                "Emma", "Ewan", "Fatima", "Fiona", "Francis", "George", "Glenn", "Grace", "Hannah", "Harry", "Ian",
+                "Isla", "Jack", "James", "Jane", "Joseph", "Karen", "Kevin", "Laura", "Lawrence", "Leah", "Liam",
+                "Lucy", "Marian", "Mark", "Mary", "Mohammed", "Noah", "Olivia", "Oscar", "Patrick", "Paul", "Priya",
+                "Rachel", "Richard", "Ruth", "Sarah", "Seán", "Sophie", "Stephen", "Susan", "Thomas", "Zoë"]
+_SURNAME_SYLLABLES = ["ab", "al", "an", "ash", "bar", "ber", "brook", "by", "car", "chester", "clark", "coo", "dal",
+                      "den", "dun", "el", "er", "ey", "ford", "gar", "ham", "har", "hill", "ing", "kin", "lan", "ley",
+                      "low", "mar", "mor", "ney", "nor", "o", "par", "ridge", "ros", "sav", "ston", "tay", "ter", "ton",
+                      "wal", "well", "wick", "win", "wood"]
+_TITLES = ["", "", "", "", "Mr ", "Mrs ", "Miss ", "Dr "]
+
+
+def _outward_code(rng: random.Random) -> str:
+    fmt = rng.choice(_OUTWARD_FORMATS)
+    if fmt == "A9":
+        return rng.choice(_AREA_1) + rng.choice(string.digits)
+    if fmt == "A99":
+        return rng.choice(_AREA_1) + rng.choice(string.digits) + rng.choice(string.digits)
+    if fmt == "AA9":
+        return rng.choice(_AREA_1) + rng.choice(_AREA_2) + rng.choice(string.digits)
+    if fmt == "AA99":
+        return rng.choice(_AREA_1) + rng.choice(_AREA_2) + rng.choice(string.digits) + rng.choice(string.digits)
+    if fmt == "A9A":
+        return rng.choice(_AREA_1) + rng.choice(string.digits) + rng.choice(_DISTRICT_LETTER_3)
+    return rng.choice(_AREA_1) + rng.choice(_AREA_2) + rng.choice(string.digits) + rng.choice(_DISTRICT_LETTER_4)
+
+
+def generate_postcode(rng: random.Random) -> str:
+    """
+    :return: A postcode in canonical form, with a single space before the inward code
+    """
+    inward = rng.choice(string.digits) + rng.choice(_INWARD_LETTERS) + rng.choice(_INWARD_LETTERS)
+    return f"{_outward_code(rng)} {inward}"
+
+
+def generate_postcodes(count: int, seed: int = 1, distinct: int = 50000,
+                       no_space_rate: float = 0.1, invalid_rate: float = 0.02) -> List[str]:
+    """
+    Generate postcodes as they might arrive in a bulk import
+    :param count: Number of postcodes
+    :param seed: Random seed
+    :param distinct: Size of the pool of postcodes drawn from, real data repeats postcodes
+    :param no_space_rate: Proportion of postcodes with the space left out
+    :param invalid_rate: Proportion of postcodes which are invalid
+    :return: postcodes
+    """
+    rng = random.Random(seed)
+    pool = [generate_postcode(rng) for _ in range(distinct)]
+    postcodes = []
+    for _ in range(count):
+        postcode = rng.choice(pool)
+        roll = rng.random()
+        if roll < invalid_rate:
+            # Inward code cut short
+            postcode = postcode[:-1]
+        elif roll < invalid_rate + no_space_rate:
+            postcode = postcode.replace(" ", "")
+        postcodes.append(postcode)
+    return postcodes
+
+
+def generate_clinician_appointments(count: int, clinician: str, seed: int = 1,
+                                    start: datetime = datetime(2030, 1, 1, tzinfo=pytz.UTC),
+                                    department: str = "gastroentology") -> List[Appointment]:
+    """
+    Generate one clinician's diary, appointments follow each other with random gaps so none overlap
+    :param count: Number of appointments
+    :param clinician: Clinician booked for every appointment
+    :param seed: Random seed
+    :param start: Time of the first appointment
+    :param department: Department of every appointment
+    :return: Active appointments in time order, each with an id
+    """
+    rng = random.Random(seed)
+    durations = list(DURATION_TO_MINS.values())
+    appointments = []
+    time = start
+    for idx in range(count):
+        duration_mins = rng.choice(durations)
+        appointments.append(Appointment(f"{clinician}-{idx}", "1953262716", Status.ACTIVE.value, time,
+                                        duration_mins, clinician, department, "LS1 5XT"))
+        time += timedelta(minutes=duration_mins + rng.choice((0, 15, 30, 60)))
+    return appointments
+
+
+def generate_surnames(count: int, rng: random.Random) -> List[str]:
+    """
+    :return: count distinct made up surnames
+    """
+    surnames = set()
+    while len(surnames) < count:
+        surname = "".join(rng.choice(_SURNAME_SYLLABLES) for _ in range(rng.randint(2, 3))).capitalize()
+        # Some double barrelled and apostrophe names
+        roll = rng.random()
+        if roll < 0.02:
+            surname = f"O'{surname}"
+        elif roll < 0.04:
+            surname = f"{surname}-{rng.choice(_SURNAME_SYLLABLES).capitalize()}{rng.choice(_SURNAME_SYLLABLES)}"
+        surnames.add(surname)
+    return sorted(surnames)
+
+
+def iter_nhs_nums(seed: int = 1, chunk: int = 100000) -> Iterator[str]:
+    """
+    Generate distinct valid NHS Numbers in a scrambled order
+    Unlike dev_tools.generate_nhs_nums numbers never repeat, so they can be used as keys however many are drawn
+    :param seed: Random seed, picks where in the permutation the numbers start
+    :param chunk: Numbers generated at a time with NumPy
+    :return: NHS Numbers, about 900 million of them before they run out
+    """
+    offset = random.Random(seed).randrange(_NHS_NUM_BASES)
+    for start in range(0, _NHS_NUM_BASES, chunk):
+        idx = np.arange(start, min(start + chunk, _NHS_NUM_BASES), dtype=np.int64)
+        bases = (idx * _NHS_NUM_MULTIPLIER + offset) % _NHS_NUM_BASES
+        digits = bases[:, None] // _DIGIT_PLACES % 10
+        chk_digit = 11 - (digits @ NHS_NUM_WEIGHTS) % 11
+        csum = np.where(chk_digit == 11, 0, chk_digit)
+        # 1 in 11 bases has no valid check digit
+        valid = csum != 10
+        yield from (f"{nhs_num:010d}" for nhs_num in (bases[valid] * 10 + csum[valid]).tolist())
+
+
+def iter_generated_patients(count: int, seed: int = 1, surnames: int = 50000) -> Iterator[Patient]:
+    """
+    Generate patients with realistic looking names, names and dates of birth repeat as in real data
+    NHS Numbers are valid and unique, see iter_nhs_nums, postcodes are valid
+    :param count: Number of patients
+    :param seed: Random seed
+    :param surnames: Number of distinct surnames
+    :return: patients
+    """
+    rng = random.Random(seed)
+    surname_pool = generate_surnames(surnames, rng)
+    first_born = date(1920, 1, 1).toordinal()
+    days = date(2020, 1, 1).toordinal() - first_born
+    for _, nhs_num in zip(range(count), iter_nhs_nums(seed)):
+        yield Patient(nhs_num, f"{rng.choice(_TITLES)}{rng.choice(_FIRST_NAMES)} {rng.choice(surname_pool)}",
+                      date.fromordinal(first_born + rng.randrange(days)), generate_postcode(rng))
+
+
+def generate_patients(count: int, seed: int = 1, surnames: int = 50000) -> List[Patient]:
+    """
+    :return: count patients, see iter_generated_patients
+    """
+    return list(iter_generated_patients(count, seed, surnames))
+
+
+def iter_generated_appointments(count: int, patient_ids: Sequence[str], seed: int = 1, clinicians: int = 100,
+                                start: datetime = datetime(2030, 1, 1, tzinfo=pytz.UTC)) -> Iterator[Appointment]:
+    """
+    Generate appointments spread over patients, clinicians and departments
+    Each clinician works in one department, a clinician's appointments follow each other with random gaps so none
+    overlap. Most are active, the rest cancelled, attended or missed
+    :param count: Number of appointments
+    :param patient_ids: NHS Numbers of the patients to book, each appointment is for a random one
+    :param seed: Random seed
+    :param clinicians: Number of clinicians, named Clinician 0, Clinician 1, ...
+    :param start: Time of each clinician's first appointment
+    :return: appointments, each with an id, in the order clinicians' diaries are filled
+    """
+    rng = random.Random(seed)
+    durations = list(DURATION_TO_MINS.values())
+    inactive = [status.value for status in Status if status != Status.ACTIVE]
+    names = [f"Clinician {idx}" for idx in range(clinicians)]
+    next_free = [start] * clinicians
+    for idx in range(count):
+        clinician = idx % clinicians
+        duration_mins = rng.choice(durations)
+        time = next_free[clinician]
+        next_free[clinician] = time + timedelta(minutes=duration_mins + rng.choice((0, 15, 30, 60)))
+        status = Status.ACTIVE.value if rng.random() < 0.85 else rng.choice(inactive)
+        yield Appointment(str(uuid.UUID(int=rng.getrandbits(128), version=4)), rng.choice(patient_ids), status, time,
+                          duration_mins, names[clinician], DEPARTMENTS[clinician % len(DEPARTMENTS)],
+                          generate_postcode(rng))
+
+
+def add_typo(name: str, rng: random.Random) -> str:
+    """
+    :return: name with one character dropped, doubled or swapped with the next, as a user might type it
+    """
+    idx = rng.randrange(1, len(name) - 1)
+    typo = rng.randrange(3)
+    if typo == 0:
+        return name[:idx] + name[idx + 1:]
+    if typo == 1:
+        return name[:idx] + name[idx] + name[idx:]
+    return name[:idx] + name[idx + 1] + name[idx] + name[idx + 2:]
@@ -0,0 +1,438 @@
+import argparse
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pytz
+
+from application import NAME_SEARCH_LIMIT
+from application import PatientAppointmentsApp
+from benchmark import time_per_call
+from benchmark.data import add_typo
+from benchmark.data import generate_postcodes
+from benchmark.data import iter_generated_appointments
+from benchmark.data import iter_generated_patients
+from benchmark.data import iter_nhs_nums
+from cache import CachingDatastore
+from datastore import Appointment
+from datastore import DataStore
+from datastore import Patient
+from memory_datastore import MemoryDatastore
+from orm import AlchemyDatastore
+from utils import Duration
+from utils import NameMatch
+from utils import Status
+from utils import name_trigrams
+from utils import normalise_name
+from utils import normalise_postcode
+from utils import normalise_postcodes
+from utils import parse_date
+from utils import parse_datetime
+from utils import validate_patient_id
+from utils import validate_patient_ids
+from utils import validate_postcode
+
+utc = pytz.UTC
+
+
+"""
+Benchmark suite: the validators in utils.py, each DataStore backend and each
+PatientAppointmentsApp method, against synthetic data at the given scales, i.e.
+the number of patients and of appointments loaded. Results are printed and written
+as JSON with the commit they were run on; pass an earlier run's JSON as the baseline
+to report what got slower or faster.
+python -m benchmark.suite [--scale N ...] [--backend memory|sqlite|cached ...] [--output FILE] [--baseline FILE]
+
+e.g. python -m benchmark.suite --scale 10000 1000000 --backend sqlite --output after.json --baseline before.json
+Scales from 10k to 10M work, loading 10M patients and appointments takes tens of minutes and, for the memory and
+cached backends, several GB.
+"""
+
+BACKENDS = ["memory", "sqlite", "cached"]
+GROUPS = ["validators", "datastore", "app"]
+DEFAULT_SCALES = [10000]
+DEFAULT_OUTPUT = "bench_results.json"
+# Records passed to create_patients and create_appointments at a time while loading
+LOAD_CHUNK = 10000
+# Patients who are booked appointments, and patients and appointments looked up by the benchmarks
+PATIENT_POOL = 100000
+SAMPLE_SIZE = 1000
+BATCH_SIZE = 100
+PAGE_SIZE = 100
+VALIDATOR_INPUTS = 10000
+# Each benchmark is timed over REPEAT runs of enough calls to take about TARGET_RUN_SECS
+REPEAT = 3
+TARGET_RUN_SECS = 0.2
+MAX_CALLS_PER_RUN = 100000
+# A benchmark more than this much slower than the baseline is reported as a regression
+DEFAULT_THRESHOLD = 0.2
+
+# A benchmark: its name, the function called and how many times it can be called, None if there is no limit
+Case = Tuple[str, Callable[[], object], Optional[int]]
+
+
+class Dataset:
+    """
+    What was loaded into a DataStore, for the benchmarks to look up
+    """
+    def __init__(self, scale: int, seed: int):
+        self.scale = scale
+        self.seed = seed
+        self.patients: List[Patient] = []
+        self.appointments: List[Appointment] = []
+        self.load_secs: Dict[str, float] = {}
+        # NHS Numbers after the loaded ones, for the benchmarks creating patients
+        self.new_nhs_nums = itertools.islice(iter_nhs_nums(seed), scale, None)
+
+
+def _every(items: Iterator, step: int, keep: List) -> Iterator:
+    for idx, item in enumerate(items):
+        if idx % step == 0:
+            keep.append(item)
+        yield item
+
+
+def _load(data_store: DataStore, scale: int, seed: int) -> Dataset:
+    dataset = Dataset(scale, seed)
+    pool: List[Patient] = []
+    start = time.perf_counter()
+    patients = _every(iter_generated_patients(scale, seed), max(1, scale // PATIENT_POOL), pool)
+    while chunk := list(itertools.islice(patients, LOAD_CHUNK)):
+        data_store.create_patients(chunk)
+    dataset.load_secs["create_patients"] = time.perf_counter() - start
+
+    rng = random.Random(seed)
+    dataset.patients = rng.sample(pool, min(SAMPLE_SIZE, len(pool)))
+    sampled: List[Appointment] = []
+    start = time.perf_counter()
+    appointments = _every(iter_generated_appointments(scale, [patient.nhs_num for patient in pool], seed,
+                                                      clinicians=max(10, min(1000, scale // 1000))),
+                          max(1, scale // (2 * SAMPLE_SIZE)), sampled)
+    while chunk := list(itertools.islice(appointments, LOAD_CHUNK)):
+        data_store.create_appointments(chunk)
+    dataset.load_secs["create_appointments"] = time.perf_counter() - start
+    dataset.appointments = sampled
+    return dataset
+
+
+def _calls(func: Callable[..., object], args: List[tuple]) -> Callable[[], object]:
+    """
+    :return: Function calling func with each of args in turn, round and round
+    """
+    cycle = itertools.cycle(args)
+    return lambda: func(*next(cycle))
+
+
+def _day(time: datetime) -> Tuple[datetime, datetime]:
+    start = datetime(time.year, time.month, time.day, tzinfo=utc)
+    return start, start + timedelta(days=1)
+
+
+def _new_patients(dataset: Dataset) -> Iterator[Tuple[str, date, str, str]]:
+    """
+    :return: create_patient arguments of patients who aren't in the DataStore
+    """
+    return ((nhs_num, date(1990, 1, 1), "Chloe Cooney", "LS1 5XT") for nhs_num in dataset.new_nhs_nums)
+
+
+def _deletable_patients(data_store: DataStore, dataset: Dataset) -> Iterator[str]:
+    """
+    Create SAMPLE_SIZE patients for the delete benchmarks
+    :return: Their NHS Numbers
+    """
+    patients = [Patient(nhs_num, name, date_of_birth, postcode)
+                for nhs_num, date_of_birth, name, postcode in itertools.islice(_new_patients(dataset), SAMPLE_SIZE)]
+    data_store.create_patients(patients)
+    return iter([patient.nhs_num for patient in patients])
+
+
+def _active_appointments(dataset: Dataset, half: int) -> Tuple[Iterator[str], int]:
+    """
+    The datastore and app benchmarks each change the status of half of the sampled active appointments
+    :return: Tuple of: ids of the active appointments in one half, how many there are
+    """
+    active = [appt.id for appt in dataset.appointments if appt.status == Status.ACTIVE.value]
+    active = active[:len(active) // 2] if half == 0 else active[len(active) // 2:]
+    return iter(active), len(active)
+
+
+def _lookups(dataset: Dataset) -> dict:
+    rng = random.Random(dataset.seed)
+    patients = dataset.patients
+    appointments = dataset.appointments
+    return {
+        "patient_ids": [(patient.nhs_num,) for patient in patients],
+        "patient_batch": [patient.nhs_num for patient in patients[:BATCH_SIZE]],
+        "exact": [(patient.name, None) for patient in patients],
+        "prefix": [(patient.name[:-3], None) for patient in patients],
+        "fuzzy": [(add_typo(patient.name, rng), patient.date_of_birth) for patient in patients],
+        "appointment_ids": [(appt.id,) for appt in appointments],
+        "appointment_batch": [appt.id for appt in appointments[:BATCH_SIZE]],
+        "booked_patients": [(appt.patient_id,) for appt in appointments],
+        "clinicians": [(appt.clinician,) for appt in appointments],
+        "department_days": [(appt.department, *_day(appt.time)) for appt in appointments],
+        "clinician_days": [(appt.clinician, appt.time.date()) for appt in appointments],
+        "clinician_spans": [(appt.clinician, appt.time, appt.time + timedelta(hours=2)) for appt in appointments],
+        "postcodes": [(patient.nhs_num, None, None, "LS2 7UE") for patient in patients],
+    }
+
+
+def _datastore_cases(data_store: DataStore, dataset: Dataset) -> List[Case]:
+    lookups = _lookups(dataset)
+    new_patients = _new_patients(dataset)
+    deletable = _deletable_patients(data_store, dataset)
+    status_changes, status_change_count = _active_appointments(dataset, 0)
+    return [
+        ("get_patient", _calls(data_store.get_patient, lookups["patient_ids"]), None),
+        (f"get_patients_by_id x{BATCH_SIZE}", lambda: data_store.get_patients_by_id(lookups["patient_batch"]), None),
+        ("find_patient_rows exact", _calls(data_store.find_patient_rows, lookups["exact"]), None),
+        ("find_patient_rows prefix", _calls(lambda name, dob: data_store.find_patient_rows(
+            name, dob, match=NameMatch.PREFIX.value, limit=NAME_SEARCH_LIMIT), lookups["prefix"]), None),
+        ("find_patient_rows fuzzy with dob", _calls(lambda name, dob: data_store.find_patient_rows(
+            name, dob, match=NameMatch.FUZZY.value, limit=NAME_SEARCH_LIMIT), lookups["fuzzy"]), None),
+        ("get_appointment", _calls(data_store.get_appointment, lookups["appointment_ids"]), None),
+        (f"get_appointments_by_id x{BATCH_SIZE}",
+         lambda: data_store.get_appointments_by_id(lookups["appointment_batch"]), None),
+        ("get_appointment_rows", _calls(data_store.get_appointment_rows, lookups["booked_patients"]), None),
+        (f"get_clinician_appointment_rows limit {PAGE_SIZE}", _calls(
+            lambda clinician: data_store.get_clinician_appointment_rows(clinician, limit=PAGE_SIZE),
+            lookups["clinicians"]), None),
+        (f"get_department_appointment_rows day limit {PAGE_SIZE}", _calls(
+            lambda department, start, end: data_store.get_department_appointment_rows(
+                department, start, end, limit=PAGE_SIZE), lookups["department_days"]), None),
+        ("get_overlapping_appointments", _calls(data_store.get_overlapping_appointments,
+                                                lookups["clinician_spans"]), None),
+        ("get_clinician_day", _calls(data_store.get_clinician_day, lookups["clinician_days"]), None),
+        ("update_patient", _calls(data_store.update_patient, lookups["postcodes"]), None),
+        ("update_appointment_status",
+         lambda: data_store.update_appointment_status(next(status_changes), Status.ATTENDED.value),
+         status_change_count),
+        ("create_patient", lambda: data_store.create_patient(*next(new_patients)), None),
+        ("delete_patient", lambda: data_store.delete_patient(next(deletable)), SAMPLE_SIZE),
+    ]
+
+
+def _app_cases(patient_app: PatientAppointmentsApp, dataset: Dataset) -> List[Case]:
+    lookups = _lookups(dataset)
+    new_patients = _new_patients(dataset)
+    deletable = _deletable_patients(patient_app.dataStore, dataset)
+    status_changes, status_change_count = _active_appointments(dataset, 1)
+    # A clinician with no appointments, booked back to back
+    slots = (datetime(2029, 1, 1, tzinfo=utc) + timedelta(minutes=30 * idx) for idx in itertools.count())
+    department_days = [(department, start, end, None, PAGE_SIZE)
+                       for department, start, end in lookups["department_days"]]
+    return [
+        ("get_patient", _calls(patient_app.get_patient, lookups["patient_ids"]), None),
+        (f"get_patients_by_id x{BATCH_SIZE}", lambda: patient_app.get_patients_by_id(lookups["patient_batch"]), None),
+        ("find_patient exact", _calls(patient_app.find_patient, lookups["exact"]), None),
+        ("find_patient prefix", _calls(lambda name, dob: patient_app.find_patient(name, dob, NameMatch.PREFIX),
+                                       lookups["prefix"]), None),
+        ("find_patient fuzzy with dob", _calls(lambda name, dob: patient_app.find_patient(name, dob, NameMatch.FUZZY),
+                                               lookups["fuzzy"]), None),
+        ("create_patient", lambda: patient_app.create_patient(*next(new_patients)), None),
+        ("update_patient", _calls(lambda nhs_num, dob, name, postcode: patient_app.update_patient(
+            nhs_num, postcode=postcode), lookups["postcodes"]), None),
+        ("delete_patient", lambda: patient_app.delete_patient(next(deletable)), SAMPLE_SIZE),
+        ("create_appointment", lambda: patient_app.create_appointment(
+            dataset.patients[0].nhs_num, next(slots), Duration.MINS_30, "Bench Clinician", "oncology",
+            "LS1 5XT"), None),
+        ("get_appointment", _calls(patient_app.get_appointment, lookups["appointment_ids"]), None),
+        (f"get_appointments_by_id x{BATCH_SIZE}",
+         lambda: patient_app.get_appointments_by_id(lookups["appointment_batch"]), None),
+        ("update_appointment status",
+         lambda: patient_app.update_appointment(next(status_changes), status=Status.CANCELLED.value),
+         status_change_count),
+        ("get_patient_appointments", _calls(patient_app.get_patient_appointments, lookups["booked_patients"]), None),
+        (f"get_clinician_appointments_page {PAGE_SIZE}", _calls(
+            lambda clinician: patient_app.get_clinician_appointments_page(clinician, PAGE_SIZE),
+            lookups["clinicians"]), None),
+        (f"get_department_appointments_page day {PAGE_SIZE}",
+         _calls(patient_app.get_department_appointments_page, department_days), None),
+        ("get_clinician_free_slots day", _calls(
+            lambda clinician, day: patient_app.get_clinician_free_slots(
+                clinician, datetime(day.year, day.month, day.day, tzinfo=utc),
+                datetime(day.year, day.month, day.day, tzinfo=utc) + timedelta(days=1)),
+            lookups["clinician_days"]), None),
+    ]
+
+
+def _validator_cases(seed: int) -> List[Case]:
+    nhs_nums = list(itertools.islice(iter_nhs_nums(seed), VALIDATOR_INPUTS))
+    # Make roughly 1 in 10 invalid
+    nhs_nums = [nhs_num if idx % 10 else nhs_num[:9] + str((int(nhs_num[9]) + 1) % 10)
+                for idx, nhs_num in enumerate(nhs_nums)]
+    postcodes = generate_postcodes(VALIDATOR_INPUTS, seed)
+    names = [patient.name for patient in iter_generated_patients(VALIDATOR_INPUTS, seed)]
+    normalised_names = [normalise_name(name) for name in names]
+    iso_dates = [str(date(1940, 1, 1) + timedelta(days=idx)) for idx in range(VALIDATOR_INPUTS)]
+    iso_datetimes = [f"{day}T09:30:00Z" for day in iso_dates]
+    return [
+        ("validate_patient_id", _calls(validate_patient_id, [(nhs_num,) for nhs_num in nhs_nums]), None),
+        (f"validate_patient_ids x{VALIDATOR_INPUTS}", lambda: validate_patient_ids(nhs_nums), None),
+        ("validate_postcode", _calls(validate_postcode, [(postcode,) for postcode in postcodes]), None),
+        ("normalise_postcode", _calls(normalise_postcode, [(postcode,) for postcode in postcodes]), None),
+        (f"normalise_postcodes x{VALIDATOR_INPUTS}", lambda: normalise_postcodes(postcodes), None),
+        ("normalise_name", _calls(normalise_name, [(name,) for name in names]), None),
+        ("name_trigrams", _calls(name_trigrams, [(name,) for name in normalised_names]), None),
+        ("parse_date iso", _calls(parse_date, [(value,) for value in iso_dates]), None),
+        ("parse_datetime iso", _calls(parse_datetime, [(value,) for value in iso_datetimes]), None),
+        ("parse_datetime lenient", _calls(parse_datetime, [("10 June 2030 9:30am",), ("2030/06/10 09:30",)]), None),
+    ]
+
+
+def _measure(func: Callable[[], object], max_calls: Optional[int]) -> Optional[float]:
+    """
+    :return: Seconds per call, None if func can't be called often enough to time it
+    """
+    if max_calls is not None and max_calls < REPEAT + 1:
+        return None
+    start = time.perf_counter()
+    func()
+    once = time.perf_counter() - start
+    number = max(1, min(MAX_CALLS_PER_RUN, int(TARGET_RUN_SECS / max(once, 1e-7))))
+    if max_calls is not None:
+        number = min(number, (max_calls - 1) // REPEAT)
+    return time_per_call(func, number, REPEAT)
+
+
+def _result(group: str, backend: Optional[str], scale: Optional[int], name: str, secs: float) -> dict:
+    result = {"group": group, "backend": backend, "scale": scale, "name": name,
+              "secs_per_call": secs, "calls_per_sec": 1 / secs if secs > 0 else None}
+    print(f"{group:<12}{backend or '':<8}{scale or '':>10}  {name:<48}{secs * 1e6:>14.1f}")
+    return result
+
+
+def _run_cases(group: str, backend: Optional[str], scale: Optional[int], cases: List[Case]) -> List[dict]:
+    results = []
+    for name, func, max_calls in cases:
+        secs = _measure(func, max_calls)
+        if secs is not None:
+            results.append(_result(group, backend, scale, name, secs))
+    return results
+
+
+def _create_data_store(backend: str, db_dir: str) -> Tuple[DataStore, Optional[AlchemyDatastore]]:
+    """
+    :return: Tuple of: DataStore, the SQLAlchemy DataStore to dispose of afterwards if there is one
+    """
+    if backend == "memory":
+        return MemoryDatastore(), None
+    alchemy = AlchemyDatastore(f"sqlite:///{db_dir}/bench.db")
+    if backend == "cached":
+        return CachingDatastore(alchemy), alchemy
+    return alchemy, alchemy
+
+
+def run(scales: List[int], backends: List[str], groups: List[str], seed: int = 1) -> List[dict]:
+    """
+    Run the benchmarks
+    :param scales: Numbers of patients, and of appointments, to load
+    :param backends: DataStores to benchmark, see BACKENDS
+    :param groups: Benchmarks to run, see GROUPS
+    :param seed: Random seed for the synthetic data
+    :return: Results, seconds per call of each benchmark
+    """
+    print(f"{'group':<12}{'backend':<8}{'scale':>10}  {'benchmark':<48}{'us per call':>14}")
+    results = []
+    if "validators" in groups:
+        results.extend(_run_cases("validators", None, None, _validator_cases(seed)))
+    if "datastore" not in groups and "app" not in groups:
+        return results
+
+    for scale in scales:
+        for backend in backends:
+            with tempfile.TemporaryDirectory() as db_dir:
+                data_store, alchemy = _create_data_store(backend, db_dir)
+                dataset = _load(data_store, scale, seed)
+                for name, secs in dataset.load_secs.items():
+                    results.append(_result("load", backend, scale, f"{name} per record", secs / scale))
+                if "datastore" in groups:
+                    results.extend(_run_cases("datastore", backend, scale, _datastore_cases(data_store, dataset)))
+                if "app" in groups:
+                    results.extend(_run_cases("app", backend, scale,
+                                              _app_cases(PatientAppointmentsApp(data_store), dataset)))
+                if alchemy is not None:
+                    alchemy.dispose()
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _result_key(result: dict) -> Tuple:
+    return result["group"], result["backend"], result["scale"], result["name"]
+
+
+def compare(results: List[dict], baseline: List[dict], threshold: float = DEFAULT_THRESHOLD) -> List[dict]:
+    """
+    Print the benchmarks whose time per call changed by more than threshold since the baseline
+    :param results: Results of this run
+    :param baseline: Results of an earlier run
+    :param threshold: Proportional change to report, e.g. 0.2 for 20%
+    :return: Results which are slower than the baseline by more than threshold
+    """
+    before = {_result_key(result): result["secs_per_call"] for result in baseline}
+    regressions = []
+    print(f"\n{'group':<12}{'backend':<8}{'scale':>10}  {'benchmark':<48}{'change':>10}")
+    for result in results:
+        old = before.get(_result_key(result))
+        if not old:
+            continue
+        ratio = result["secs_per_call"] / old
+        if abs(ratio - 1) <= threshold:
+            continue
+        if ratio > 1:
+            regressions.append(result)
+        group, backend, scale, name = _result_key(result)
+        print(f"{group:<12}{backend or '':<8}{scale or '':>10}  {name:<48}{ratio - 1:>+10.0%}")
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmark.suite", description=__doc__)
+    parser.add_argument("--scale", type=int, nargs="+", default=DEFAULT_SCALES,
+                        help="patients, and appointments, to load, e.g. 10000 1000000")
+    parser.add_argument("--backend", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--group", nargs="+", choices=GROUPS, default=GROUPS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="proportional change in time per call to report, default 0.2")
+    args = parser.parse_args(argv)
+
+    results = run(args.scale, args.backend, args.group, args.seed)
+    report = {"commit": _git_commit(), "created": datetime.now(utc).isoformat(),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "seed": args.seed, "results": results}
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as baseline:
+        regressions = compare(results, json.load(baseline)["results"], args.threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,385 @@
+import time
+from collections import OrderedDict
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from threading import Lock
+from typing import Callable
+from typing import Dict
+from typing import Hashable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from datastore import DataStore
+from datastore import Appointment
+from datastore import AppointmentBooking
+from datastore import AppointmentKey
+from datastore import AppointmentRow
+from datastore import Patient
+from datastore import PatientRow
+from schedule import utc_days
+from utils import NameMatch
+
+
+"""
+Read-through entity cache
+
+CachingDatastore wraps any DataStore and serves get_patient and get_appointment,
+and their batch versions, from memory. Entries are dropped when the wrapped
+DataStore is written to through the wrapper, and expire after a TTL so that
+writes made by other processes are picked up eventually. Lookups which find
+nothing are cached too, so repeatedly asking for an unknown NHS Number doesn't
+reach the database each time. A batch lookup reads all of its misses with one
+call to the wrapped DataStore.
+
+get_clinician_day is cached per clinician and day for the free slot search. An
+entry is dropped when an appointment on that day is created, moved or changed
+through the wrapper. Deleting patients drops every cached appointment and day.
+get_overlapping_appointments is not cached, it is used for double-booking checks
+which must see writes made by other processes.
+
+All other DataStore methods are passed straight through.
+"""
+
+# Cached in place of None for lookups that found nothing
+_NOT_FOUND = object()
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache with a time to live on each entry
+    """
+    def __init__(self, max_size: int, ttl_secs: float):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        self.lock = Lock()
+        # key -> (expiry time, value), least recently used first
+        self.entries: OrderedDict = OrderedDict()
+        # Incremented by every invalidation, see get_or_load
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], object]) -> object:
+        """
+        Get the value for key, calling loader to get it on a miss
+        :param key: cache key
+        :param loader: called on a miss, its result is cached
+        :return: cached or loaded value
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            generation = self.generation
+
+        value = loader()
+
+        with self.lock:
+            # If there was a write while loading the value might already be stale, so don't keep it
+            if generation == self.generation:
+                self.entries[key] = (now + self.ttl_secs, value)
+                self.entries.move_to_end(key)
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def get_many_or_load(self, keys: List[Hashable],
+                         loader: Callable[[List[Hashable]], Dict[Hashable, object]]) -> Dict[Hashable, object]:
+        """
+        get_or_load for many keys with one call to loader for all of the misses
+        :param keys: cache keys
+        :param loader: called with the keys which missed, returns the value of each of them
+        :return: key -> cached or loaded value
+        """
+        now = time.monotonic()
+        values: Dict[Hashable, object] = {}
+        missed: List[Hashable] = []
+        with self.lock:
+            for key in keys:
+                if key in values:
+                    continue
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if entry[0] > now:
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        values[key] = entry[1]
+                        continue
+                    del self.entries[key]
+                    self.expirations += 1
+                self.misses += 1
+                # Placeholder so a repeated key is only counted and loaded once, replaced below
+                values[key] = None
+                missed.append(key)
+            generation = self.generation
+        if not missed:
+            return values
+
+        loaded = loader(missed)
+
+        with self.lock:
+            keep = generation == self.generation
+            for key in missed:
+                values[key] = loaded[key]
+                if keep:
+                    self.entries[key] = (now + self.ttl_secs, loaded[key])
+                    self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return values
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            self.generation += 1
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+class CachingDatastore(DataStore):
+
+    def __init__(self, data_store: DataStore, max_size: int = 10000, ttl_secs: float = 60.0):
+        """
+        :param data_store: DataStore to cache
+        :param max_size: Maximum number of patients, and separately appointments, to cache
+        :param ttl_secs: How long an entry is served from the cache before it is reloaded
+        """
+        self.data_store = data_store
+        self.patients = LRUCache(max_size, ttl_secs)
+        self.appointments = LRUCache(max_size, ttl_secs)
+        # (clinician, day) -> the clinician's active appointments that day
+        self.clinician_days = LRUCache(max_size, ttl_secs)
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: hit, miss, eviction etc. counters for each entity cache
+        """
+        return {"patients": self.patients.stats(), "appointments": self.appointments.stats(),
+                "clinician_days": self.clinician_days.stats()}
+
+    def _invalidate_days(self, clinician: str, start: datetime, duration_mins: int) -> None:
+        for day in utc_days(start, start + timedelta(minutes=duration_mins)):
+            self.clinician_days.invalidate((clinician, day))
+
+    @staticmethod
+    def _get(cache: LRUCache, key: str, loader: Callable[[], object]):
+        def load() -> object:
+            value = loader()
+            return _NOT_FOUND if value is None else value
+
+        value = cache.get_or_load(key, load)
+        return None if value is _NOT_FOUND else value
+
+    @staticmethod
+    def _get_many(cache: LRUCache, keys: List[str], loader: Callable[[List[str]], list],
+                  key_of: Callable[[object], str]) -> list:
+        # The misses are read with one call to the wrapped DataStore, ones it doesn't find are cached as not found
+        def load(missed: List[str]) -> Dict[str, object]:
+            found = {key_of(value): value for value in loader(missed)}
+            return {key: found.get(key, _NOT_FOUND) for key in missed}
+
+        values = cache.get_many_or_load(keys, load)
+        return [value for value in values.values() if value is not _NOT_FOUND]
+
+    def create_appointment(self, patient: str, appointment_time: datetime, duration_mins: int,
+                           clinician: str, department: str, postcode: str, appointment_id: Optional[str] = None) -> str:
+        appointment_id = self.data_store.create_appointment(patient, appointment_time, duration_mins, clinician,
+                                                            department, postcode, appointment_id=appointment_id)
+        # May have been cached as not found
+        self.appointments.invalidate(appointment_id)
+        self._invalidate_days(clinician, appointment_time, duration_mins)
+        return appointment_id
+
+    def create_appointments(self, appointments: List[Appointment]) -> List[str]:
+        created = self.data_store.create_appointments(appointments)
+        for appointment_id in created:
+            self.appointments.invalidate(appointment_id)
+        created_ids = set(created)
+        for appointment in appointments:
+            if appointment.id in created_ids:
+                self._invalidate_days(appointment.clinician, appointment.time, appointment.duration_mins)
+        return created
+
+    def get_appointment(self, appointment_id: str) -> Appointment:
+        return self._get(self.appointments, appointment_id, lambda: self.data_store.get_appointment(appointment_id))
+
+    def get_appointments_by_id(self, appointment_ids: List[str]) -> List[Appointment]:
+        return self._get_many(self.appointments, appointment_ids, self.data_store.get_appointments_by_id,
+                              lambda appt: appt.id)
+
+    def get_appointments(self, patient_id: str, limit: Optional[int] = None,
+                         after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return self.data_store.get_appointments(patient_id, limit=limit, after=after)
+
+    def get_clinician_appointments(self, clinician: str, limit: Optional[int] = None,
+                                   after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return self.data_store.get_clinician_appointments(clinician, limit=limit, after=after)
+
+    def get_overlapping_appointments(self, clinician: str, start: datetime, end: datetime) -> List[Appointment]:
+        return self.data_store.get_overlapping_appointments(clinician, start, end)
+
+    def get_department_appointments(self, department: str, start: datetime, end: datetime,
+                                    status: Optional[str] = None, limit: Optional[int] = None,
+                                    after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return self.data_store.get_department_appointments(department, start, end, status=status, limit=limit,
+                                                           after=after)
+
+    def get_clinician_day(self, clinician: str, day: date) -> List[Appointment]:
+        key: Tuple[str, date] = (clinician, day)
+        return self.clinician_days.get_or_load(key, lambda: self.data_store.get_clinician_day(clinician, day))
+
+    def iter_appointments(self, patient_id: str) -> Iterator[Appointment]:
+        return self.data_store.iter_appointments(patient_id)
+
+    def iter_clinician_appointments(self, clinician: str) -> Iterator[Appointment]:
+        return self.data_store.iter_clinician_appointments(clinician)
+
+    def get_appointment_rows(self, patient_id: str, limit: Optional[int] = None,
+                             after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return self.data_store.get_appointment_rows(patient_id, limit=limit, after=after)
+
+    def get_clinician_appointment_rows(self, clinician: str, limit: Optional[int] = None,
+                                       after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return self.data_store.get_clinician_appointment_rows(clinician, limit=limit, after=after)
+
+    def get_department_appointment_rows(self, department: str, start: datetime, end: datetime,
+                                        status: Optional[str] = None, limit: Optional[int] = None,
+                                        after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return self.data_store.get_department_appointment_rows(department, start, end, status=status, limit=limit,
+                                                               after=after)
+
+    def iter_appointment_rows(self, patient_id: str) -> Iterator[AppointmentRow]:
+        return self.data_store.iter_appointment_rows(patient_id)
+
+    def iter_clinician_appointment_rows(self, clinician: str) -> Iterator[AppointmentRow]:
+        return self.data_store.iter_clinician_appointment_rows(clinician)
+
+    def update_appointment(self, appointment_id: str, appointment_time: Optional[datetime] = None,
+                           duration_mins: Optional[int] = None, clinician: Optional[str] = None,
+                           status: Optional[str] = None) -> str:
+        # The days it was booked on before the update have to be invalidated as well as the new ones
+        before = self.data_store.get_appointment(appointment_id)
+        try:
+            return self.data_store.update_appointment(appointment_id, appointment_time=appointment_time,
+                                                      duration_mins=duration_mins, clinician=clinician,
+                                                      status=status)
+        finally:
+            self.appointments.invalidate(appointment_id)
+            if before is not None:
+                self._invalidate_days(before.clinician, before.time, before.duration_mins)
+                self._invalidate_days(clinician if clinician is not None else before.clinician,
+                                      appointment_time if appointment_time is not None else before.time,
+                                      duration_mins if duration_mins is not None else before.duration_mins)
+
+    def update_appointment_status(self, appointment_id: str, status: str) -> str:
+        self.update_appointment_status_returning(appointment_id, status)
+        return appointment_id
+
+    def update_appointment_status_returning(self, appointment_id: str, status: str) -> AppointmentBooking:
+        # A status change doesn't move the appointment, the update says where it is booked, nothing else is read
+        try:
+            clinician, time, duration_mins = self.data_store.update_appointment_status_returning(appointment_id,
+                                                                                               status)
+        finally:
+            # Invalidated whether or not the update worked, it may have changed the appointment before failing
+            self.appointments.invalidate(appointment_id)
+        self._invalidate_days(clinician, time, duration_mins)
+        return clinician, time, duration_mins
+
+    def create_patient(self, patient_id: str, date_of_birth: date, patient_name: str, postcode: str) -> str:
+        try:
+            return self.data_store.create_patient(patient_id, date_of_birth, patient_name, postcode)
+        finally:
+            self.patients.invalidate(patient_id)
+
+    def create_patients(self, patients: List[Patient]) -> List[str]:
+        created = self.data_store.create_patients(patients)
+        for patient_id in created:
+            self.patients.invalidate(patient_id)
+        return created
+
+    def update_patient(self, patient_id: str, date_of_birth: Optional[date] = None,
+                       patient_name: Optional[str] = None, postcode: Optional[str] = None) -> str:
+        try:
+            return self.data_store.update_patient(patient_id, date_of_birth=date_of_birth,
+                                                  patient_name=patient_name, postcode=postcode)
+        finally:
+            self.patients.invalidate(patient_id)
+
+    def get_patient(self, patient_id: str) -> Patient:
+        return self._get(self.patients, patient_id, lambda: self.data_store.get_patient(patient_id))
+
+    def get_patients_by_id(self, patient_ids: List[str]) -> List[Patient]:
+        return self._get_many(self.patients, patient_ids, self.data_store.get_patients_by_id,
+                              lambda patient: patient.nhs_num)
+
+    def findPatient(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                    limit: Optional[int] = None) -> List[Patient]:
+        return self.data_store.findPatient(patient_name, date_of_birth, match=match, limit=limit)
+
+    def iter_patients(self, patient_name: str, date_of_birth: Optional[date],
+                      match: str = NameMatch.EXACT.value) -> Iterator[Patient]:
+        return self.data_store.iter_patients(patient_name, date_of_birth, match=match)
+
+    def find_patient_rows(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                          limit: Optional[int] = None) -> List[PatientRow]:
+        return self.data_store.find_patient_rows(patient_name, date_of_birth, match=match, limit=limit)
+
+    def iter_patient_rows(self, patient_name: str, date_of_birth: Optional[date],
+                          match: str = NameMatch.EXACT.value) -> Iterator[PatientRow]:
+        return self.data_store.iter_patient_rows(patient_name, date_of_birth, match=match)
+
+    def delete_patient(self, patient_id: str) -> str:
+        try:
+            return self.data_store.delete_patient(patient_id)
+        finally:
+            self._invalidate_deleted_patients([patient_id])
+
+    def delete_patients(self, patient_ids: List[str]) -> List[str]:
+        try:
+            return self.data_store.delete_patients(patient_ids)
+        finally:
+            self._invalidate_deleted_patients(patient_ids)
+
+    def _invalidate_deleted_patients(self, patient_ids: List[str]) -> None:
+        for patient_id in patient_ids:
+            self.patients.invalidate(patient_id)
+        # The DataStore doesn't say which appointments went with the patients, and finding out would mean
+        # reading them all back, so drop every cached appointment rather than serve a deleted one
+        self.appointments.clear()
+        self.clinician_days.clear()
+
+    def is_db_empty(self) -> bool:
+        return self.data_store.is_db_empty()
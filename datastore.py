@@ -1,10 +1,18 @@
+import os
+import uuid
 from datetime import datetime
 from datetime import date
+from datetime import time
+from datetime import timedelta
+from datetime import timezone
 from typing import Protocol
 from typing import Optional
+from typing import Iterator
 from typing import List
+from typing import Tuple
 
 from exceptions import MissingDatastoreException
+from utils import NameMatch
 
 
 """
@@ -24,7 +32,7 @@ class Appointment:
     Data class containing Appointment information
     """
     def __init__(self, id: str, patient_id: str, status: str, time: datetime, duration_mins: int, clinician: str,
-                 department: str, postcode: str):
+                 department: str, postcode: str, version: int = 1, incarnation: Optional[str] = None):
         self.id = id
         self.patient_id = patient_id
         self.status = status
@@ -33,17 +41,56 @@ class Appointment:
         self.clinician = clinician
         self.department = department
         self.postcode = postcode
+        # Incremented each time the appointment is updated
+        self.version = version
+        # Stamped when the appointment is stored, see new_incarnation
+        self.incarnation = incarnation
 
 
 class Patient:
     """
     Data class containing Patient information
     """
-    def __init__(self, nhs_num: str, name: str, date_of_birth: date, postcode: str):
+    def __init__(self, nhs_num: str, name: str, date_of_birth: date, postcode: str, version: int = 1,
+                 incarnation: Optional[str] = None):
         self.nhs_num = nhs_num
         self.name = name
         self.date_of_birth = date_of_birth
         self.postcode = postcode
+        # Incremented each time the patient is updated
+        self.version = version
+        # Stamped when the patient is stored, see new_incarnation
+        self.incarnation = incarnation
+
+
+# Sort key for appointments, used for keyset pagination: (time, id)
+AppointmentKey = Tuple[datetime, str]
+
+# Read only list results as plain tuples, for list endpoints which go straight to response dicts
+# The fields are in the order of APPOINTMENT_ROW_FIELDS and PATIENT_ROW_FIELDS
+AppointmentRow = Tuple[str, str, str, datetime, int, str, str, str]
+PatientRow = Tuple[str, str, date, str]
+# Where an appointment is booked: (clinician, time, duration_mins)
+AppointmentBooking = Tuple[str, datetime, int]
+APPOINTMENT_ROW_FIELDS = ('id', 'patient_id', 'status', 'time', 'duration_mins', 'clinician', 'department', 'postcode')
+PATIENT_ROW_FIELDS = ('nhs_num', 'name', 'date_of_birth', 'postcode')
+
+
+def appointment_row(appointment: Appointment) -> AppointmentRow:
+    return (appointment.id, appointment.patient_id, appointment.status, appointment.time, appointment.duration_mins,
+            appointment.clinician, appointment.department, appointment.postcode)
+
+
+def patient_row(patient: Patient) -> PatientRow:
+    return patient.nhs_num, patient.name, patient.date_of_birth, patient.postcode
+
+
+def day_bounds(day: date) -> Tuple[datetime, datetime]:
+    """
+    :return: Start and end of a UTC day
+    """
+    start = datetime.combine(day, time.min, tzinfo=timezone.utc)
+    return start, start + timedelta(days=1)
 
 
 class DataStore(Protocol):
@@ -52,25 +99,182 @@ class DataStore(Protocol):
     """
     def create_appointment(self, patient: str, appointment_time: datetime, duration_mins: int,
                            clinician: str, department: str, postcode: str, appointment_id: Optional[str] = None) -> str:
+        """
+        Store an active appointment
+        The clinician's diary is checked for double-booking in the same transaction as the insert, with the
+        clinician's appointments locked, so that concurrent requests can't both book the same time
+        :raises AppointmentAlreadyExistsException: if appointment_id is already in use
+        :raises ClinicianUnavailableException: if the clinician has an active appointment overlapping it
+        :return: id of the appointment
+        """
+        ...
+
+    def create_appointments(self, appointments: List[Appointment]) -> List[str]:
+        """
+        Store many active appointments in one transaction
+        Appointments without an id are given one, appointments whose id is already in use are skipped, as are
+        appointments which would double-book their clinician, including with an earlier appointment in the batch,
+        checked as for create_appointment
+        :return: ids of the appointments that were stored
+        """
         ...
 
     def get_appointment(self, appointment_id: str) -> Appointment:
         ...
 
-    def get_appointments(self, patient_id: str) -> List[Appointment]:
+    def get_appointments_by_id(self, appointment_ids: List[str]) -> List[Appointment]:
+        """
+        Get many appointments at once
+        :return: The appointments found, in any order, ids with no appointment are left out
+        """
+        return [appt for appt in map(self.get_appointment, appointment_ids) if appt is not None]
+
+    def get_appointments(self, patient_id: str, limit: Optional[int] = None,
+                         after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        """
+        Get a patient's appointments ordered by (time, id)
+        :param limit: Maximum number of appointments to return, all of them if None
+        :param after: Only return appointments which sort after this (time, id) key
+        """
         ...
 
-    def get_clinician_appointments(self, clinician: str) -> List[Appointment]:
+    def get_clinician_appointments(self, clinician: str, limit: Optional[int] = None,
+                                   after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        """
+        Get a clinician's appointments ordered by (time, id)
+        :param limit: Maximum number of appointments to return, all of them if None
+        :param after: Only return appointments which sort after this (time, id) key
+        """
         ...
 
+    def get_overlapping_appointments(self, clinician: str, start: datetime, end: datetime) -> List[Appointment]:
+        """
+        Get a clinician's active appointments which overlap a time interval, using an index on clinician and time
+        :param clinician: Name of the clinician
+        :param start: Start of the interval
+        :param end: End of the interval, appointments which end at start or start at end don't overlap
+        :return: Active appointments overlapping [start, end)
+        """
+        ...
+
+    def get_department_appointments(self, department: str, start: datetime, end: datetime,
+                                    status: Optional[str] = None, limit: Optional[int] = None,
+                                    after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        """
+        Get a department's appointments starting in a time range ordered by (time, id), using an index on
+        department and time
+        :param department: Name of the department
+        :param start: Start of the range
+        :param end: End of the range, appointments starting at end are not included
+        :param status: Only return appointments with this status, any status if None
+        :param limit: Maximum number of appointments to return, all of them if None
+        :param after: Only return appointments which sort after this (time, id) key
+        """
+        ...
+
+    def get_clinician_day(self, clinician: str, day: date) -> List[Appointment]:
+        """
+        Get a clinician's active appointments which overlap a UTC day, used to find free slots
+        DataStores which cache may serve this from memory, so it must not be used for double-booking checks
+        :param clinician: Name of the clinician
+        :param day: The day
+        :return: Active appointments overlapping the day
+        """
+        return self.get_overlapping_appointments(clinician, *day_bounds(day))
+
+    def iter_appointments(self, patient_id: str) -> Iterator[Appointment]:
+        """
+        Iterate over a patient's appointments without loading them all into memory at once
+        """
+        ...
+
+    def iter_clinician_appointments(self, clinician: str) -> Iterator[Appointment]:
+        """
+        Iterate over a clinician's appointments without loading them all into memory at once
+        """
+        ...
+
+    def get_appointment_rows(self, patient_id: str, limit: Optional[int] = None,
+                             after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        """
+        get_appointments as AppointmentRows
+        The _rows methods are for read only list endpoints, DataStores can read the rows without building
+        Appointment or Patient objects
+        """
+        return [appointment_row(appt) for appt in self.get_appointments(patient_id, limit=limit, after=after)]
+
+    def get_clinician_appointment_rows(self, clinician: str, limit: Optional[int] = None,
+                                       after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        """
+        get_clinician_appointments as AppointmentRows
+        """
+        return [appointment_row(appt) for appt in self.get_clinician_appointments(clinician, limit=limit, after=after)]
+
+    def get_department_appointment_rows(self, department: str, start: datetime, end: datetime,
+                                        status: Optional[str] = None, limit: Optional[int] = None,
+                                        after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        """
+        get_department_appointments as AppointmentRows
+        """
+        return [appointment_row(appt) for appt in self.get_department_appointments(
+            department, start, end, status=status, limit=limit, after=after)]
+
+    def iter_appointment_rows(self, patient_id: str) -> Iterator[AppointmentRow]:
+        """
+        iter_appointments as AppointmentRows
+        """
+        return (appointment_row(appt) for appt in self.iter_appointments(patient_id))
+
+    def iter_clinician_appointment_rows(self, clinician: str) -> Iterator[AppointmentRow]:
+        """
+        iter_clinician_appointments as AppointmentRows
+        """
+        return (appointment_row(appt) for appt in self.iter_clinician_appointments(clinician))
+
     def update_appointment(self, appointment_id: str, appointment_time: Optional[datetime] = None,
                            duration_mins: Optional[int] = None, clinician: Optional[str] = None,
                            status: Optional[str] = None) -> str:
+        """
+        Changes to the time, duration or clinician of an active appointment are checked for double-booking as
+        for create_appointment
+        :raises AppointmentNotFoundException: if there is no such appointment
+        :raises InvalidStatusChangeException: if the status can't be changed to status, see utils.check_status_change
+        :raises ClinicianUnavailableException: if the moved appointment would overlap another active appointment
+        :raises ConcurrentUpdateException: if another request changed the appointment while this one was updating it
+        """
+        ...
+
+    def update_appointment_status(self, appointment_id: str, status: str) -> str:
+        """
+        Change an appointment's status, checking the status change rules in the same statement so that a
+        concurrent update can't slip in between the check and the change
+        :raises AppointmentNotFoundException: if there is no such appointment
+        :raises InvalidStatusChangeException: if the status can't be changed to status, see utils.check_status_change
+        :return: appointment_id
+        """
         ...
 
+    def update_appointment_status_returning(self, appointment_id: str, status: str) -> AppointmentBooking:
+        """
+        As update_appointment_status, for callers which also need to know where the appointment is booked
+        Override to get the booking from the update itself, rather than reading the appointment again
+        :return: The changed appointment's (clinician, time, duration_mins)
+        """
+        self.update_appointment_status(appointment_id, status)
+        appointment = self.get_appointment(appointment_id)
+        return appointment.clinician, appointment.time, appointment.duration_mins
+
     def create_patient(self, patient: str, date_of_birth: date, patient_name: str, postcode: str) -> str:
         ...
 
+    def create_patients(self, patients: List[Patient]) -> List[str]:
+        """
+        Store many patients in one transaction
+        Patients whose NHS Number is already in use are skipped rather than failing the batch
+        :return: NHS Numbers of the patients that were stored
+        """
+        ...
+
     def update_patient(self, patient: str, date_of_birth: Optional[date] = None,
                        patient_name: Optional[str] = None, postcode: Optional[str] = None) -> str:
         ...
@@ -78,16 +282,184 @@ class DataStore(Protocol):
     def get_patient(self, patient_id) -> Patient:
         ...
 
-    def findPatient(self, patient_name: str, date_of_birth: Optional[date]) -> List[Patient]:
+    def get_patients_by_id(self, patient_ids: List[str]) -> List[Patient]:
+        """
+        Get many patients at once
+        :return: The patients found, in any order, NHS Numbers with no patient are left out
+        """
+        return [patient for patient in map(self.get_patient, patient_ids) if patient is not None]
+
+    def findPatient(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                    limit: Optional[int] = None) -> List[Patient]:
+        """
+        Find patients by name, and date of birth if given
+        :param patient_name: Name, or for prefix matches the start of the name
+        :param date_of_birth: Only return patients born on this date, any date if None
+        :param match: A NameMatch value. exact: the name as entered. prefix: names starting with patient_name,
+        ignoring case, accents and punctuation, in name order. fuzzy: names similar to patient_name, allowing for
+        typos and word order, most similar first
+        :param limit: Maximum number of patients to return, all of them if None
+        """
         ...
 
+    def iter_patients(self, patient_name: str, date_of_birth: Optional[date],
+                      match: str = NameMatch.EXACT.value) -> Iterator[Patient]:
+        """
+        Iterate over the results of findPatient without loading them all into memory at once
+        """
+        ...
+
+    def find_patient_rows(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                          limit: Optional[int] = None) -> List[PatientRow]:
+        """
+        findPatient as PatientRows
+        """
+        return [patient_row(patient) for patient in self.findPatient(patient_name, date_of_birth, match=match,
+                                                                     limit=limit)]
+
+    def iter_patient_rows(self, patient_name: str, date_of_birth: Optional[date],
+                          match: str = NameMatch.EXACT.value) -> Iterator[PatientRow]:
+        """
+        iter_patients as PatientRows
+        """
+        return (patient_row(patient) for patient in self.iter_patients(patient_name, date_of_birth, match=match))
+
     def delete_patient(self, patient_id: str) -> str:
+        """
+        Delete a patient and all of their appointments
+        :raises PatientNotFoundException: if there is no such patient
+        """
+        ...
+
+    def delete_patients(self, patient_ids: List[str]) -> List[str]:
+        """
+        Delete many patients, and all of their appointments, in one transaction
+        NHS Numbers with no patient are skipped rather than failing the batch
+        :return: NHS Numbers of the patients that were deleted
+        """
         ...
 
     def is_db_empty(self) -> bool:
         ...
 
 
+class AsyncDataStore(Protocol):
+    """
+    Abstract asyncio Data Store Definition
+    The same as DataStore, for use by the async handlers in async_operations.py
+    """
+    async def create_appointment(self, patient: str, appointment_time: datetime, duration_mins: int,
+                                 clinician: str, department: str, postcode: str,
+                                 appointment_id: Optional[str] = None) -> str:
+        ...
+
+    async def create_appointments(self, appointments: List[Appointment]) -> List[str]:
+        ...
+
+    async def get_appointment(self, appointment_id: str) -> Appointment:
+        ...
+
+    async def get_appointments_by_id(self, appointment_ids: List[str]) -> List[Appointment]:
+        ...
+
+    async def get_appointments(self, patient_id: str, limit: Optional[int] = None,
+                               after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        ...
+
+    async def get_clinician_appointments(self, clinician: str, limit: Optional[int] = None,
+                                         after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        ...
+
+    async def get_overlapping_appointments(self, clinician: str, start: datetime,
+                                           end: datetime) -> List[Appointment]:
+        ...
+
+    async def get_department_appointments(self, department: str, start: datetime, end: datetime,
+                                          status: Optional[str] = None, limit: Optional[int] = None,
+                                          after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        ...
+
+    async def get_clinician_day(self, clinician: str, day: date) -> List[Appointment]:
+        return await self.get_overlapping_appointments(clinician, *day_bounds(day))
+
+    async def get_appointment_rows(self, patient_id: str, limit: Optional[int] = None,
+                                   after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return [appointment_row(appt) for appt in await self.get_appointments(patient_id, limit=limit, after=after)]
+
+    async def get_clinician_appointment_rows(self, clinician: str, limit: Optional[int] = None,
+                                             after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return [appointment_row(appt)
+                for appt in await self.get_clinician_appointments(clinician, limit=limit, after=after)]
+
+    async def get_department_appointment_rows(self, department: str, start: datetime, end: datetime,
+                                              status: Optional[str] = None, limit: Optional[int] = None,
+                                              after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return [appointment_row(appt) for appt in await self.get_department_appointments(
+            department, start, end, status=status, limit=limit, after=after)]
+
+    async def update_appointment(self, appointment_id: str, appointment_time: Optional[datetime] = None,
+                                 duration_mins: Optional[int] = None, clinician: Optional[str] = None,
+                                 status: Optional[str] = None) -> str:
+        ...
+
+    async def update_appointment_status(self, appointment_id: str, status: str) -> str:
+        ...
+
+    async def create_patient(self, patient: str, date_of_birth: date, patient_name: str, postcode: str) -> str:
+        ...
+
+    async def create_patients(self, patients: List[Patient]) -> List[str]:
+        ...
+
+    async def update_patient(self, patient: str, date_of_birth: Optional[date] = None,
+                             patient_name: Optional[str] = None, postcode: Optional[str] = None) -> str:
+        ...
+
+    async def get_patient(self, patient_id) -> Patient:
+        ...
+
+    async def get_patients_by_id(self, patient_ids: List[str]) -> List[Patient]:
+        ...
+
+    async def findPatient(self, patient_name: str, date_of_birth: Optional[date],
+                          match: str = NameMatch.EXACT.value, limit: Optional[int] = None) -> List[Patient]:
+        ...
+
+    async def find_patient_rows(self, patient_name: str, date_of_birth: Optional[date],
+                                match: str = NameMatch.EXACT.value, limit: Optional[int] = None) -> List[PatientRow]:
+        return [patient_row(patient) for patient in await self.findPatient(patient_name, date_of_birth, match=match,
+                                                                           limit=limit)]
+
+    async def delete_patient(self, patient_id: str) -> str:
+        ...
+
+    async def delete_patients(self, patient_ids: List[str]) -> List[str]:
+        ...
+
+    async def is_db_empty(self) -> bool:
+        ...
+
+
+def new_appointment_ids(count: int) -> List[str]:
+    """
+    Generate appointment ids in bulk
+    Equivalent to calling uuid.uuid4() count times but with a single read of random bytes
+    :param count: Number of ids required
+    :return: List of random (version 4) UUID strings
+    """
+    random_bytes = os.urandom(16 * count)
+    return [str(uuid.UUID(bytes=random_bytes[idx:idx + 16], version=4)) for idx in range(0, 16 * count, 16)]
+
+
+def new_incarnation() -> str:
+    """
+    A random token stamped on a patient or appointment once, when it is stored
+    Together with the version it identifies a state of the record, a record deleted and created again starts at
+    version 1 again but has a new incarnation, see utils.make_etag
+    """
+    return os.urandom(8).hex()
+
+
 # The DataStore Instance that the app will use
 DATA_STORE: Optional[DataStore] = None
 
@@ -111,3 +483,28 @@ def get_data_store() -> DataStore:
     if DATA_STORE is None:
         raise MissingDatastoreException("No DataStore instance has been set for PANDA")
     return DATA_STORE
+
+
+# The AsyncDataStore Instance that the async app will use
+ASYNC_DATA_STORE: Optional[AsyncDataStore] = None
+
+
+def set_async_data_store(data_store: AsyncDataStore) -> None:
+    """
+    Call this function to set the AsyncDataStore used by the async app
+    :param data_store: An implementation of AsyncDataStore
+    :return: None
+    """
+    global ASYNC_DATA_STORE
+    ASYNC_DATA_STORE = data_store
+
+
+def get_async_data_store() -> AsyncDataStore:
+    """
+    Call this function to get the AsyncDataStore for the async app to use
+    :return: An implementation of AsyncDataStore
+    """
+    global ASYNC_DATA_STORE
+    if ASYNC_DATA_STORE is None:
+        raise MissingDatastoreException("No AsyncDataStore instance has been set for PANDA")
+    return ASYNC_DATA_STORE
@@ -1,8 +1,14 @@
 from random import randint, seed
+from typing import List
+from typing import Optional
 from typing import Set
 from typing import Tuple
 import json
 
+import numpy as np
+
+from utils import NHS_NUM_WEIGHTS
+
 # Initialise pseudo-random number gen
 seed()
 
@@ -43,13 +49,44 @@ def generate_nhs_num() -> str:
     return nhs_num + str(csum)
 
 
-def generate_test_nhs_num(**kwargs) -> Tuple[dict, int]:
+def generate_nhs_nums(count: int, rng: Optional[np.random.Generator] = None) -> List[str]:
+    """
+    Generate many valid NHS Numbers at once, e.g. for synthetic test data
+    Numbers are drawn in vectorised batches and those with no valid check digit discarded
+    :param count: How many numbers to generate
+    :param rng: NumPy random generator, pass a seeded one for repeatable numbers
+    :return: NHS Numbers, there may be repeats
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    batches: List[np.ndarray] = []
+    remaining = count
+    while remaining > 0:
+        # 1 in 11 draws has no valid check digit, over-draw so one batch is usually enough
+        digits = rng.integers(0, 10, size=(remaining + remaining // 8 + 16, 10), dtype=np.uint8)
+        chk_digit = 11 - (digits[:, :9].astype(np.int64) @ NHS_NUM_WEIGHTS) % 11
+        csum = np.where(chk_digit == 11, 0, chk_digit)
+        digits = digits[csum != 10][:remaining]
+        digits[:, 9] = csum[csum != 10][:remaining]
+        batches.append(digits)
+        remaining -= len(digits)
+    if not batches:
+        return []
+    # Each row of ASCII digits is viewed as one 10 byte string
+    ascii_digits = np.concatenate(batches) + ord("0")
+    return ascii_digits.view("S10").reshape(-1).astype("U10").tolist()
+
+
+def generate_test_nhs_num(count: Optional[int] = None, **kwargs) -> Tuple[dict, int]:
     """
     Function to generate HNS numbers to make testing of FE
     a bit easier
+    :param count: Number of NHS Numbers to generate, if absent a single number is generated
     :param kwargs: - unused
-    :return: Tuple of: dict containing NHS number, response code
+    :return: Tuple of: dict containing NHS number(s), response code
     """
+    if count is not None:
+        return {"nhs_numbers": generate_nhs_nums(count)}, 200
     return {"nhs_number": generate_nhs_num()}, 200
 
 
@@ -17,6 +17,12 @@ class InvalidStatusChangeException(DataEntryFieldException):
         super(InvalidStatusChangeException, self).__init__(msg)
 
 
+class ConcurrentUpdateException(DataEntryFieldException):
+    def __init__(self, field_name: str):
+        super(ConcurrentUpdateException, self).__init__(f"{msgs.MSG_CONCURRENT_UPDATE} {field_name}")
+        self.field_name = field_name
+
+
 class NoResultsException(DataEntryFieldException):
     def __init__(self, field_name: str):
         super(NoResultsException, self).__init__(f"{msgs.MSG_APPT_NOT_FOUND} {field_name}")
@@ -98,3 +104,56 @@ class PatientNotFoundException(InvalidFieldException):
     def __init__(self, field: str):
         super(PatientNotFoundException, self).__init__(f"{msgs.MSG_PATIENT_NOT_FOUND} {field}")
         self.field = field
+
+
+class AppointmentAlreadyExistsException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(AppointmentAlreadyExistsException, self).__init__(f"{msgs.MSG_FIELD_APPOINTMENT_EXISTS} {field}")
+        self.field = field
+
+
+class InvalidBulkBodyException(InvalidFieldException):
+    def __init__(self):
+        super(InvalidBulkBodyException, self).__init__(msgs.MSG_INVALID_BULK_BODY)
+
+
+class InvalidRecordException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(InvalidRecordException, self).__init__(f"{msgs.MSG_INVALID_RECORD} {field}")
+        self.field = field
+
+
+class InvalidCursorException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(InvalidCursorException, self).__init__(f"{msgs.MSG_FIELD_INVALID_CURSOR} {field}")
+        self.field = field
+
+
+class ClinicianUnavailableException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(ClinicianUnavailableException, self).__init__(f"{msgs.MSG_CLINICIAN_UNAVAILABLE} {field}")
+        self.field = field
+
+
+class InvalidTimeRangeException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(InvalidTimeRangeException, self).__init__(f"{msgs.MSG_INVALID_TIME_RANGE} {field}")
+        self.field = field
+
+
+class TimeRangeTooLongException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(TimeRangeTooLongException, self).__init__(f"{msgs.MSG_TIME_RANGE_TOO_LONG} {field}")
+        self.field = field
+
+
+class BatchTooLargeException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(BatchTooLargeException, self).__init__(f"{msgs.MSG_BATCH_TOO_LARGE} {field}")
+        self.field = field
+
+
+class InvalidNameMatchException(InvalidFieldException):
+    def __init__(self, field: str):
+        super(InvalidNameMatchException, self).__init__(f"{msgs.MSG_FIELD_INVALID_NAME_MATCH} {field}")
+        self.field = field
@@ -0,0 +1,34 @@
+import multiprocessing
+import os
+
+"""
+gunicorn configuration for the production WSGI app, see wsgi.py
+gunicorn -c gunicorn.conf.py
+
+PANDA_WORKERS sets the number of worker processes, default one per core plus one
+PANDA_THREADS sets the request threads per worker, default 1
+PANDA_BIND sets the address to listen on, default 0.0.0.0:8090
+
+Each worker has its own entity cache, which a write made by another worker
+doesn't clear, so wsgi.py turns the cache off unless there is only one worker.
+PANDA_CACHE_SIZE turns it on anyway, other workers can then serve an entity
+for up to PANDA_CACHE_TTL_SECS after it was changed.
+"""
+
+wsgi_app = 'wsgi:create_app()'
+bind = os.environ.get('PANDA_BIND', '0.0.0.0:8090')
+workers = int(os.environ.get('PANDA_WORKERS') or multiprocessing.cpu_count() + 1)
+threads = int(os.environ.get('PANDA_THREADS') or 1)
+# The app is created in each worker after it is forked, so no DB engine or connection is shared between workers
+preload_app = False
+# Restart workers now and then to bound the effect of any memory growth
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def on_starting(server) -> None:
+    # Runs once in the master process before any workers are forked
+    # Workers inherit the environment, so they see the worker count however it was set, e.g. with -w
+    os.environ['PANDA_WORKERS'] = str(server.cfg.workers)
+    from wsgi import prepare_database
+    prepare_database()
@@ -1,8 +1,34 @@
 import connexion
 import sys
+from typing import Optional
 
+from connexion.apis.flask_api import FlaskApi
+from connexion.resolver import Resolver
+from connexion.utils import get_function_from_name
+
+from cache import CachingDatastore
+from datastore import DataStore
 from datastore import set_data_store
+from memory_datastore import MemoryDatastore
+from metrics import InstrumentedDatastore
+from metrics import instrumented_resolver
+from operations import populate_sample_data_if_empty
 from orm import AlchemyDatastore
+from serialisation import ResponseJsonifier
+from serialisation import set_json_backend
+from sql_profiler import SLOW_QUERY_SECS
+from sql_profiler import SQL_PROFILER
+from sql_profiler import profiled
+
+
+class PandaFlaskApi(FlaskApi):
+    """
+    FlaskApi serialising responses with the selected JSON backend, see serialisation.py
+    Indented with sorted keys, as Flask's JSON provider does
+    """
+    @classmethod
+    def _set_jsonifier(cls):
+        cls.jsonifier = ResponseJsonifier(indent=True, sort_keys=True)
 
 
 def get_port() -> int:
@@ -14,16 +40,79 @@ def get_port() -> int:
         return 8090
 
 
+def create_data_store(data_store_type: str, db_url: str, pool_size: Optional[int] = None, echo: bool = False,
+                      sqlite_wal: bool = True, profile_sql: bool = False,
+                      slow_query_secs: float = SLOW_QUERY_SECS) -> DataStore:
+    """
+    Create the DataStore implementation selected by data_store_type
+    :param data_store_type: 'alchemy' for the SQLAlchemy DataStore, 'memory' for the in-memory DataStore
+    :param db_url: SQLAlchemy DB URL, ignored by the in-memory DataStore
+    :param pool_size: DB connections kept open, None for the SQLAlchemy default, ignored by the in-memory DataStore
+    :param echo: Log every SQL statement, ignored by the in-memory DataStore
+    :param sqlite_wal: Put file based SQLite databases in WAL mode, ignored by the in-memory DataStore
+    :param profile_sql: Time every statement with SQL_PROFILER, see sql_profiler.py, ignored by the in-memory DataStore
+    :param slow_query_secs: Statements taking at least this long are logged when profile_sql is set
+    :return: An implementation of DataStore
+    """
+    if data_store_type == 'memory':
+        return MemoryDatastore()
+    SQL_PROFILER.slow_query_secs = slow_query_secs
+    return AlchemyDatastore(db_url, pool_size=pool_size, echo=echo, sqlite_wal=sqlite_wal,
+                            profiler=SQL_PROFILER if profile_sql else None)
+
+
+def create_app(data_store: DataStore, entity_cache_size: int = 0, entity_cache_ttl_secs: float = 60.0,
+               load_sample_data: bool = True, json_backend: Optional[str] = None,
+               metrics: bool = True) -> connexion.FlaskApp:
+    """
+    Configure the DataStore used by the request handlers and create the connexion app serving the API
+    :param data_store: DataStore for the handlers to use
+    :param entity_cache_size: Patients and appointments to cache, 0 to turn the cache off
+    :param entity_cache_ttl_secs: How long a cached entity is served before it is reloaded
+    :param load_sample_data: Populate the DataStore with sample data if it is empty
+    :param json_backend: Library responses are serialised with, 'orjson' or 'json', None for the fastest installed
+    :param metrics: Record request handler and DataStore latencies, served from GET /metrics, see metrics.py
+    :return: connexion app, its WSGI app is attribute app
+    """
+    set_json_backend(json_backend)
+    if metrics:
+        # Inside the cache, so only calls which reach the underlying DataStore are timed
+        data_store = InstrumentedDatastore(data_store)
+    if entity_cache_size > 0:
+        data_store = CachingDatastore(data_store, max_size=entity_cache_size, ttl_secs=entity_cache_ttl_secs)
+    set_data_store(data_store)
+    if load_sample_data:
+        populate_sample_data_if_empty()
+
+    app = connexion.App(__name__, specification_dir='apidef/')
+    app.api_cls = PandaFlaskApi
+    # Handlers count the SQL statements each request runs, see GET /admin/sql
+    resolve = profiled(get_function_from_name)
+    app.add_api('patient-app.yml', resolver=instrumented_resolver(resolve) if metrics else Resolver(resolve))
+    return app
+
+
 if __name__ == '__main__':
     # Application DataStore Initialisation
     # Modify DB_URL to use different DB
     # See: https://docs.sqlalchemy.org/en/20/core/engines.html
     DB_URL = 'sqlite:///PANDA.db'
-    dataStore = AlchemyDatastore(DB_URL)
-    set_data_store(dataStore)
+    # Modify DATA_STORE_TYPE to 'memory' to keep all data in process memory instead
+    # Nothing is persisted when using the in-memory DataStore
+    DATA_STORE_TYPE = 'alchemy'
+    # Modify ECHO_SQL to True to log every SQL statement
+    ECHO_SQL = False
+    # Statements slower than SLOW_SQL_SECS are logged, timings of the most expensive are served from GET /admin/sql
+    PROFILE_SQL = True
+    SLOW_SQL_SECS = 0.1
+    dataStore = create_data_store(DATA_STORE_TYPE, DB_URL, echo=ECHO_SQL, profile_sql=PROFILE_SQL,
+                                  slow_query_secs=SLOW_SQL_SECS)
+    # Patients and appointments fetched by id are cached, modify ENTITY_CACHE_SIZE to 0 to turn the cache off
+    # ENTITY_CACHE_TTL_SECS limits how long changes made by other processes can go unseen
+    ENTITY_CACHE_SIZE = 10000
+    ENTITY_CACHE_TTL_SECS = 60
 
     # This is just using the test server included with connexion
-    # In production an industrial-strength WSGI server would be used
-    app = connexion.App(__name__, specification_dir='apidef/')
-    app.add_api('patient-app.yml')
+    # In production use the WSGI app in wsgi.py, see gunicorn.conf.py
+    app = create_app(dataStore, entity_cache_size=ENTITY_CACHE_SIZE, entity_cache_ttl_secs=ENTITY_CACHE_TTL_SECS)
     app.run(port=get_port())
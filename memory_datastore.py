@@ -0,0 +1,431 @@
+import uuid
+from bisect import bisect_left
+from bisect import bisect_right
+from bisect import insort
+from copy import copy
+from datetime import date
+from datetime import datetime
+from threading import RLock
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+
+from datastore import DataStore
+from datastore import Appointment
+from datastore import AppointmentBooking
+from datastore import AppointmentKey
+from datastore import Patient
+from datastore import new_appointment_ids
+from datastore import new_incarnation
+from exceptions import AppointmentAlreadyExistsException
+from exceptions import AppointmentNotFoundException
+from exceptions import ClinicianUnavailableException
+from exceptions import PatientNotFoundException
+from exceptions import PatientAlreadyExistsException
+from schedule import ScheduleIndex
+from schedule import appointment_end
+from schedule import moved_appointment
+from schedule import naive_utc
+from utils import NameMatch
+from utils import Status
+from utils import check_status_change
+from utils import min_shared_trigrams
+from utils import name_trigrams
+from utils import normalise_name
+from utils import rank_by_similarity
+
+
+"""
+In-memory DataStore implementation
+
+Keeps patients and appointments in process memory with a primary dict
+per entity and secondary indexes for each of the DataStore lookups, so
+every query is a dict access rather than a database round trip.
+
+Behaves like AlchemyDatastore, including the exceptions raised, so the two
+can be swapped in main.py. Times are stored as naive UTC, as the databases store
+them, so responses format them the same way. Nothing is persisted between runs.
+"""
+
+
+def _add_to_index(index: Dict[str, Dict[str, object]], key: str, entity_id: str, entity: object) -> None:
+    index.setdefault(key, {})[entity_id] = entity
+
+
+def _remove_from_index(index: Dict[str, Dict[str, object]], key: str, entity_id: str) -> None:
+    bucket = index.get(key)
+    if bucket is None:
+        return
+    bucket.pop(entity_id, None)
+    if not bucket:
+        del index[key]
+
+
+def _appointment_key(appointment: Appointment) -> AppointmentKey:
+    return appointment.time, appointment.id
+
+
+class AppointmentIndex:
+    """
+    One patient's, clinician's or department's appointments, sorted by (time, id) so that a page or time range
+    starts with a binary search rather than a sort of all of them
+    Not thread safe, callers hold their own lock
+    """
+    def __init__(self):
+        self.keys: List[AppointmentKey] = []
+        self.appointments: Dict[str, Appointment] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def add(self, appointment: Appointment) -> None:
+        insort(self.keys, _appointment_key(appointment))
+        self.appointments[appointment.id] = appointment
+
+    def remove(self, appointment: Appointment) -> None:
+        """
+        Remove an appointment, must be called with the appointment's time as it was added
+        """
+        key = _appointment_key(appointment)
+        idx = bisect_left(self.keys, key)
+        if idx < len(self.keys) and self.keys[idx] == key:
+            del self.keys[idx]
+            del self.appointments[appointment.id]
+
+    def page(self, limit: Optional[int], after: Optional[AppointmentKey]) -> List[Appointment]:
+        start = 0 if after is None else bisect_right(self.keys, (naive_utc(after[0]), after[1]))
+        end = len(self.keys) if limit is None else start + limit
+        return [copy(self.appointments[appointment_id]) for _, appointment_id in self.keys[start:end]]
+
+    def time_range(self, start: datetime, end: datetime, status: Optional[str], limit: Optional[int],
+                   after: Optional[AppointmentKey]) -> List[Appointment]:
+        """
+        :return: The appointments starting in [start, end) with the status, if given, which sort after after
+        """
+        lo = bisect_left(self.keys, (naive_utc(start),))
+        if after is not None:
+            lo = max(lo, bisect_right(self.keys, (naive_utc(after[0]), after[1])))
+        hi = bisect_left(self.keys, (naive_utc(end),))
+        found: List[Appointment] = []
+        for idx in range(lo, hi):
+            if limit is not None and len(found) >= limit:
+                break
+            appointment = self.appointments[self.keys[idx][1]]
+            if status is None or appointment.status == status:
+                found.append(copy(appointment))
+        return found
+
+
+def _add_to_sorted_index(index: Dict[str, AppointmentIndex], key: str, appointment: Appointment) -> None:
+    index.setdefault(key, AppointmentIndex()).add(appointment)
+
+
+def _remove_from_sorted_index(index: Dict[str, AppointmentIndex], key: str, appointment: Appointment) -> None:
+    bucket = index.get(key)
+    if bucket is None:
+        return
+    bucket.remove(appointment)
+    if not bucket:
+        del index[key]
+
+
+class MemoryDatastore(DataStore):
+
+    def __init__(self):
+        # Guards all of the dicts below, the dev server handles requests on multiple threads
+        self.lock = RLock()
+        # Primary indexes
+        self.appointments: Dict[str, Appointment] = {}
+        self.patients: Dict[str, Patient] = {}
+        # Secondary indexes, key -> appointments sorted by (time, id) for paging and time ranges
+        self.appointments_by_patient: Dict[str, AppointmentIndex] = {}
+        self.appointments_by_clinician: Dict[str, AppointmentIndex] = {}
+        self.appointments_by_department: Dict[str, AppointmentIndex] = {}
+        # Secondary indexes, key -> {primary key: entity} so insertion order is kept and removal is O(1)
+        self.patients_by_name: Dict[str, Dict[str, Patient]] = {}
+        self.patients_by_normalised_name: Dict[str, Dict[str, Patient]] = {}
+        self.patients_by_date_of_birth: Dict[date, Dict[str, Patient]] = {}
+        # Trigram -> NHS Numbers of the patients whose normalised names contain it, for fuzzy searches
+        self.patients_by_name_trigram: Dict[str, Set[str]] = {}
+        # Sorted keys of patients_by_normalised_name for prefix searches, rebuilt on first use after a change
+        self.sorted_normalised_names: Optional[List[str]] = []
+        # Active appointments by clinician, sorted by time, for overlap checks
+        self.schedules = ScheduleIndex()
+
+    def create_appointment(self, patient: str, appointment_time: datetime, duration_mins: int,
+                           clinician: str, department: str, postcode: str, appointment_id: Optional[str] = None) -> str:
+        if appointment_id is None:
+            appointment_id = str(uuid.uuid4())
+        appointment = Appointment(appointment_id, patient, Status.ACTIVE.value, naive_utc(appointment_time),
+                                  duration_mins, clinician, department, postcode, incarnation=new_incarnation())
+        with self.lock:
+            if appointment_id in self.appointments:
+                raise AppointmentAlreadyExistsException(appointment_id)
+            # Checked under the same lock as the insert, so two requests can't both book the time
+            clashes = self.schedules.overlapping(clinician, appointment.time, appointment_end(appointment))
+            if clashes:
+                raise ClinicianUnavailableException(clashes[0])
+            self.appointments[appointment_id] = appointment
+            _add_to_sorted_index(self.appointments_by_patient, patient, appointment)
+            _add_to_sorted_index(self.appointments_by_clinician, clinician, appointment)
+            _add_to_sorted_index(self.appointments_by_department, department, appointment)
+            self.schedules.add(appointment)
+        return appointment_id
+
+    def create_appointments(self, appointments: List[Appointment]) -> List[str]:
+        new_ids = iter(new_appointment_ids(sum(1 for appt in appointments if appt.id is None)))
+        created: List[str] = []
+        with self.lock:
+            for appt in appointments:
+                if appt.id is None:
+                    appt.id = next(new_ids)
+                elif appt.id in self.appointments:
+                    continue
+                appointment = Appointment(appt.id, appt.patient_id, Status.ACTIVE.value, naive_utc(appt.time),
+                                          appt.duration_mins, appt.clinician, appt.department, appt.postcode,
+                                          incarnation=new_incarnation())
+                if self.schedules.overlapping(appointment.clinician, appointment.time, appointment_end(appointment)):
+                    continue
+                self.appointments[appointment.id] = appointment
+                _add_to_sorted_index(self.appointments_by_patient, appointment.patient_id, appointment)
+                _add_to_sorted_index(self.appointments_by_clinician, appointment.clinician, appointment)
+                _add_to_sorted_index(self.appointments_by_department, appointment.department, appointment)
+                self.schedules.add(appointment)
+                created.append(appointment.id)
+        return created
+
+    def get_appointment(self, appointment_id: str) -> Appointment:
+        appointment = self.appointments.get(appointment_id)
+        # Hand out copies so callers can't modify stored state
+        return copy(appointment) if appointment is not None else None
+
+    def get_appointments_by_id(self, appointment_ids: List[str]) -> List[Appointment]:
+        with self.lock:
+            found = (self.appointments.get(appointment_id) for appointment_id in dict.fromkeys(appointment_ids))
+            return [copy(appt) for appt in found if appt is not None]
+
+    def get_appointments(self, patient_id: str, limit: Optional[int] = None,
+                         after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        with self.lock:
+            appointments = self.appointments_by_patient.get(patient_id)
+            return appointments.page(limit, after) if appointments is not None else []
+
+    def get_clinician_appointments(self, clinician: str, limit: Optional[int] = None,
+                                   after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        with self.lock:
+            appointments = self.appointments_by_clinician.get(clinician)
+            return appointments.page(limit, after) if appointments is not None else []
+
+    def get_department_appointments(self, department: str, start: datetime, end: datetime,
+                                    status: Optional[str] = None, limit: Optional[int] = None,
+                                    after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        with self.lock:
+            appointments = self.appointments_by_department.get(department)
+            return appointments.time_range(start, end, status, limit, after) if appointments is not None else []
+
+    def get_overlapping_appointments(self, clinician: str, start: datetime, end: datetime) -> List[Appointment]:
+        with self.lock:
+            return [copy(self.appointments[appointment_id])
+                    for appointment_id in self.schedules.overlapping(clinician, start, end)]
+
+    def iter_appointments(self, patient_id: str) -> Iterator[Appointment]:
+        # Nothing to gain from streaming out of memory, just iterate over a snapshot
+        return iter(self.get_appointments(patient_id))
+
+    def iter_clinician_appointments(self, clinician: str) -> Iterator[Appointment]:
+        return iter(self.get_clinician_appointments(clinician))
+
+    def update_appointment(self, appointment_id: str, appointment_time: Optional[datetime] = None,
+                           duration_mins: Optional[int] = None, clinician: Optional[str] = None,
+                           status: Optional[str] = None) -> str:
+        with self.lock:
+            appt = self.appointments.get(appointment_id)
+            if appt is None:
+                raise AppointmentNotFoundException(appointment_id)
+            if status is not None:
+                check_status_change(appt.status, status)
+            moved = moved_appointment(appt, appointment_time, duration_mins, clinician, status)
+            if moved is not None:
+                clashes = self.schedules.overlapping(moved.clinician, moved.time, appointment_end(moved),
+                                                     exclude_id=appointment_id)
+                if clashes:
+                    raise ClinicianUnavailableException(clashes[0])
+            # Removed and added back so the indexes see the new time, duration, clinician and status
+            self.schedules.remove(appt)
+            _remove_from_sorted_index(self.appointments_by_patient, appt.patient_id, appt)
+            _remove_from_sorted_index(self.appointments_by_clinician, appt.clinician, appt)
+            _remove_from_sorted_index(self.appointments_by_department, appt.department, appt)
+            if appointment_time is not None:
+                appt.time = naive_utc(appointment_time)
+            if duration_mins is not None:
+                appt.duration_mins = duration_mins
+            if clinician is not None:
+                appt.clinician = clinician
+            if status is not None:
+                appt.status = status
+            _add_to_sorted_index(self.appointments_by_patient, appt.patient_id, appt)
+            _add_to_sorted_index(self.appointments_by_clinician, appt.clinician, appt)
+            _add_to_sorted_index(self.appointments_by_department, appt.department, appt)
+            self.schedules.add(appt)
+            if any(value is not None for value in (appointment_time, duration_mins, clinician, status)):
+                appt.version += 1
+        return appointment_id
+
+    def update_appointment_status(self, appointment_id: str, status: str) -> str:
+        self.update_appointment_status_returning(appointment_id, status)
+        return appointment_id
+
+    def update_appointment_status_returning(self, appointment_id: str, status: str) -> AppointmentBooking:
+        with self.lock:
+            appt = self.appointments.get(appointment_id)
+            if appt is None:
+                raise AppointmentNotFoundException(appointment_id)
+            check_status_change(appt.status, status)
+            self.schedules.remove(appt)
+            appt.status = status
+            self.schedules.add(appt)
+            appt.version += 1
+            return appt.clinician, appt.time, appt.duration_mins
+
+    def create_patient(self, patient_id: str, date_of_birth: date, patient_name: str, postcode: str) -> str:
+        patient = Patient(patient_id, patient_name, date_of_birth, postcode, incarnation=new_incarnation())
+        with self.lock:
+            if patient_id in self.patients:
+                raise PatientAlreadyExistsException(patient_id)
+            self.patients[patient_id] = patient
+            self._add_patient_to_indexes(patient)
+        return patient_id
+
+    def create_patients(self, patients: List[Patient]) -> List[str]:
+        created: List[str] = []
+        with self.lock:
+            for patient in patients:
+                if patient.nhs_num in self.patients:
+                    continue
+                patient = copy(patient)
+                patient.incarnation = new_incarnation()
+                self.patients[patient.nhs_num] = patient
+                self._add_patient_to_indexes(patient)
+                created.append(patient.nhs_num)
+        return created
+
+    def update_patient(self, patient_id: str, date_of_birth: Optional[date] = None,
+                       patient_name: Optional[str] = None, postcode: Optional[str] = None) -> str:
+        with self.lock:
+            patient = self.patients.get(patient_id)
+            if patient is None:
+                raise PatientNotFoundException(patient_id)
+            # Removed and added back so the indexes see the new name and date of birth
+            self._remove_patient_from_indexes(patient)
+            if date_of_birth is not None:
+                patient.date_of_birth = date_of_birth
+            if patient_name is not None:
+                patient.name = patient_name
+            if postcode is not None:
+                patient.postcode = postcode
+            self._add_patient_to_indexes(patient)
+            if any(value is not None for value in (date_of_birth, patient_name, postcode)):
+                patient.version += 1
+        return patient_id
+
+    def get_patient(self, patient_id: str) -> Patient:
+        patient = self.patients.get(patient_id)
+        return copy(patient) if patient is not None else None
+
+    def get_patients_by_id(self, patient_ids: List[str]) -> List[Patient]:
+        with self.lock:
+            found = (self.patients.get(patient_id) for patient_id in dict.fromkeys(patient_ids))
+            return [copy(patient) for patient in found if patient is not None]
+
+    def findPatient(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                    limit: Optional[int] = None) -> List[Patient]:
+        with self.lock:
+            if match == NameMatch.PREFIX.value:
+                found = self._find_by_prefix(normalise_name(patient_name), date_of_birth, limit)
+            elif match == NameMatch.FUZZY.value:
+                if date_of_birth is None:
+                    trigrams = name_trigrams(normalise_name(patient_name))
+                    shared: Dict[str, int] = {}
+                    for trigram in trigrams:
+                        for nhs_num in self.patients_by_name_trigram.get(trigram, ()):
+                            shared[nhs_num] = shared.get(nhs_num, 0) + 1
+                    needed = min_shared_trigrams(trigrams)
+                    candidates = [self.patients[nhs_num] for nhs_num, count in shared.items() if count >= needed]
+                else:
+                    candidates = list(self.patients_by_date_of_birth.get(date_of_birth, {}).values())
+                found = rank_by_similarity(patient_name, [(normalise_name(patient.name), patient)
+                                                          for patient in candidates])[:limit]
+            else:
+                found = [patient for patient in self.patients_by_name.get(patient_name, {}).values()
+                         if date_of_birth is None or patient.date_of_birth == date_of_birth][:limit]
+            return [copy(patient) for patient in found]
+
+    def _find_by_prefix(self, prefix: str, date_of_birth: Optional[date], limit: Optional[int]) -> List[Patient]:
+        if self.sorted_normalised_names is None:
+            self.sorted_normalised_names = sorted(self.patients_by_normalised_name)
+        found: List[Patient] = []
+        for idx in range(bisect_left(self.sorted_normalised_names, prefix), len(self.sorted_normalised_names)):
+            name = self.sorted_normalised_names[idx]
+            if not name.startswith(prefix) or (limit is not None and len(found) >= limit):
+                break
+            found.extend(patient for patient in self.patients_by_normalised_name[name].values()
+                         if date_of_birth is None or patient.date_of_birth == date_of_birth)
+        return found[:limit]
+
+    def _add_patient_to_indexes(self, patient: Patient) -> None:
+        normalised = normalise_name(patient.name)
+        _add_to_index(self.patients_by_name, patient.name, patient.nhs_num, patient)
+        if normalised not in self.patients_by_normalised_name:
+            self.sorted_normalised_names = None
+        _add_to_index(self.patients_by_normalised_name, normalised, patient.nhs_num, patient)
+        _add_to_index(self.patients_by_date_of_birth, patient.date_of_birth, patient.nhs_num, patient)
+        for trigram in name_trigrams(normalised):
+            self.patients_by_name_trigram.setdefault(trigram, set()).add(patient.nhs_num)
+
+    def _remove_patient_from_indexes(self, patient: Patient) -> None:
+        normalised = normalise_name(patient.name)
+        _remove_from_index(self.patients_by_name, patient.name, patient.nhs_num)
+        _remove_from_index(self.patients_by_normalised_name, normalised, patient.nhs_num)
+        if normalised not in self.patients_by_normalised_name:
+            self.sorted_normalised_names = None
+        _remove_from_index(self.patients_by_date_of_birth, patient.date_of_birth, patient.nhs_num)
+        for trigram in name_trigrams(normalised):
+            nhs_nums = self.patients_by_name_trigram[trigram]
+            nhs_nums.discard(patient.nhs_num)
+            if not nhs_nums:
+                del self.patients_by_name_trigram[trigram]
+
+    def iter_patients(self, patient_name: str, date_of_birth: Optional[date],
+                      match: str = NameMatch.EXACT.value) -> Iterator[Patient]:
+        return iter(self.findPatient(patient_name, date_of_birth, match))
+
+    def delete_patient(self, patient_id: str) -> str:
+        with self.lock:
+            if patient_id not in self.patients:
+                raise PatientNotFoundException(patient_id)
+            self._delete_patient(patient_id)
+        return patient_id
+
+    def delete_patients(self, patient_ids: List[str]) -> List[str]:
+        deleted: List[str] = []
+        with self.lock:
+            for patient_id in patient_ids:
+                if patient_id in self.patients:
+                    self._delete_patient(patient_id)
+                    deleted.append(patient_id)
+        return deleted
+
+    def _delete_patient(self, patient_id: str) -> None:
+        patient = self.patients.pop(patient_id)
+        self._remove_patient_from_indexes(patient)
+        appointments = self.appointments_by_patient.pop(patient_id, None)
+        for appointment_id, appt in (appointments.appointments.items() if appointments is not None else ()):
+            del self.appointments[appointment_id]
+            _remove_from_sorted_index(self.appointments_by_clinician, appt.clinician, appt)
+            _remove_from_sorted_index(self.appointments_by_department, appt.department, appt)
+            self.schedules.remove(appt)
+
+    def is_db_empty(self) -> bool:
+        return len(self.appointments) == 0 and len(self.patients) == 0
@@ -12,3 +12,13 @@ MSG_FIELD_INVALID_APPOINTMENT = "The appointment does not exist: "
 MSG_FIELD_PATIENT_EXISTS = "Patient already exists with this NHS Number:"
 MSG_PATIENT_NOT_FOUND = "Could not find patient with NHS Number:"
 MSG_FIELD_TIME_FUTURE = "Date/time field is in the future:"
+MSG_FIELD_APPOINTMENT_EXISTS = "Appointment already exists with this id:"
+MSG_INVALID_BULK_BODY = "Request body is not a JSON array or newline delimited JSON"
+MSG_INVALID_RECORD = "Record is not a JSON object:"
+MSG_FIELD_INVALID_CURSOR = "Field is not a valid page cursor:"
+MSG_CLINICIAN_UNAVAILABLE = "Clinician is already booked at this time by appointment:"
+MSG_FIELD_INVALID_NAME_MATCH = "Field is not a valid name match:"
+MSG_INVALID_TIME_RANGE = "Time range must end after it starts:"
+MSG_TIME_RANGE_TOO_LONG = "Time range is longer than the maximum of 31 days:"
+MSG_BATCH_TOO_LARGE = "Too many records requested at once, the maximum is 5000:"
+MSG_CONCURRENT_UPDATE = "Record was changed by another request at the same time, fetch it and try again:"
@@ -0,0 +1,224 @@
+import functools
+import inspect
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from connexion.resolver import Resolver
+from connexion.utils import get_function_from_name
+
+
+"""
+Request handler and DataStore metrics in the Prometheus text exposition format
+
+Every request handler, resolved through instrumented_resolver, and every method of
+a DataStore wrapped in InstrumentedDatastore records its calls, errors by exception
+type and a latency histogram. GET /metrics renders them for Prometheus to scrape.
+
+Handlers turn DataEntryFieldExceptions into 400 responses themselves, they call
+note_error with the exception so that it is still counted. Methods returning
+iterators are timed until the iterator is returned, not until it is used up.
+
+The metrics are kept per process, so each gunicorn worker reports its own.
+"""
+
+# Upper bounds of the latency histogram buckets in seconds, Prometheus adds +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class OperationMetrics:
+    """
+    Thread safe calls, errors and latency histogram of a set of named operations
+    """
+    def __init__(self, calls_name: str, errors_name: str, duration_name: str, label: str, description: str,
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        :param calls_name: Name of the calls counter
+        :param errors_name: Name of the errors counter
+        :param duration_name: Name of the latency histogram
+        :param label: Label holding the operation name
+        :param description: What an operation is, for the HELP lines
+        :param buckets: Upper bounds of the latency buckets in seconds, ascending
+        """
+        self.calls_name = calls_name
+        self.errors_name = errors_name
+        self.duration_name = duration_name
+        self.label = label
+        self.description = description
+        self.buckets = buckets
+        self.lock = Lock()
+        # operation -> calls in each bucket, not cumulative, the last one is +Inf
+        self.bucket_counts: Dict[str, List[int]] = {}
+        self.duration_sums: Dict[str, float] = {}
+        # (operation, exception type) -> count
+        self.errors: Dict[Tuple[str, str], int] = {}
+
+    def observe(self, operation: str, duration_secs: float, error: Optional[str] = None) -> None:
+        """
+        Record one call
+        :param operation: Name of the operation
+        :param duration_secs: How long the call took
+        :param error: Name of the exception type if the call failed
+        """
+        idx = bisect_left(self.buckets, duration_secs)
+        with self.lock:
+            counts = self.bucket_counts.get(operation)
+            if counts is None:
+                counts = self.bucket_counts[operation] = [0] * (len(self.buckets) + 1)
+                self.duration_sums[operation] = 0.0
+            counts[idx] += 1
+            self.duration_sums[operation] += duration_secs
+            if error is not None:
+                self.errors[(operation, error)] = self.errors.get((operation, error), 0) + 1
+
+    def reset(self) -> None:
+        with self.lock:
+            self.bucket_counts.clear()
+            self.duration_sums.clear()
+            self.errors.clear()
+
+    def render(self) -> List[str]:
+        """
+        :return: Lines of the Prometheus text format for these metrics
+        """
+        with self.lock:
+            bucket_counts = {operation: list(counts) for operation, counts in self.bucket_counts.items()}
+            duration_sums = dict(self.duration_sums)
+            errors = dict(self.errors)
+
+        lines = [f"# HELP {self.calls_name} Calls by {self.description}",
+                 f"# TYPE {self.calls_name} counter"]
+        lines.extend(f'{self.calls_name}{{{self.label}="{_label_value(operation)}"}} {sum(counts)}'
+                     for operation, counts in sorted(bucket_counts.items()))
+        lines.extend([f"# HELP {self.errors_name} Failed calls by {self.description} and exception type",
+                      f"# TYPE {self.errors_name} counter"])
+        lines.extend(f'{self.errors_name}{{{self.label}="{_label_value(operation)}",'
+                     f'exception="{_label_value(error)}"}} {count}'
+                     for (operation, error), count in sorted(errors.items()))
+        lines.extend([f"# HELP {self.duration_name} Latency by {self.description}",
+                      f"# TYPE {self.duration_name} histogram"])
+        for operation, counts in sorted(bucket_counts.items()):
+            labels = f'{self.label}="{_label_value(operation)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else format(bound, "g")
+                lines.append(f'{self.duration_name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.duration_name}_sum{{{labels}}} {duration_sums[operation]:.6f}")
+            lines.append(f"{self.duration_name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+HANDLER_METRICS = OperationMetrics("panda_requests_total", "panda_request_errors_total",
+                                   "panda_request_duration_seconds", "operation", "request handler")
+DATASTORE_METRICS = OperationMetrics("panda_datastore_calls_total", "panda_datastore_errors_total",
+                                     "panda_datastore_duration_seconds", "method", "DataStore method")
+
+# Exceptions noted by the handler which is running, see note_error
+_noted_errors: ContextVar[Optional[List[str]]] = ContextVar("_noted_errors", default=None)
+
+
+def note_error(exception: Exception) -> None:
+    """
+    Count an exception which a request handler caught and turned into an error response
+    """
+    noted = _noted_errors.get()
+    if noted is not None:
+        noted.append(type(exception).__name__)
+
+
+def instrument(metrics: OperationMetrics, operation: str, func: Callable, note_errors: bool = False) -> Callable:
+    """
+    Wrap a function, or coroutine function, so that each call is recorded in metrics
+    :param metrics: Where calls are recorded
+    :param operation: Name the calls are recorded under
+    :param func: Function to wrap
+    :param note_errors: Also count the exceptions passed to note_error during the call
+    :return: The wrapped function, with func's signature
+    """
+    def finish(start: float, error: Optional[str], noted: Optional[List[str]]) -> None:
+        if error is None and noted:
+            error = noted[-1]
+        metrics.observe(operation, time.perf_counter() - start, error)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            noted = [] if note_errors else None
+            token = _noted_errors.set(noted) if note_errors else None
+            start = time.perf_counter()
+            error = None
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                if token is not None:
+                    _noted_errors.reset(token)
+                finish(start, error, noted)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        noted = [] if note_errors else None
+        token = _noted_errors.set(noted) if note_errors else None
+        start = time.perf_counter()
+        error = None
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if token is not None:
+                _noted_errors.reset(token)
+            finish(start, error, noted)
+    return wrapper
+
+
+def instrumented_resolver(resolve: Callable[[str], Callable] = get_function_from_name) -> Resolver:
+    """
+    connexion Resolver recording the calls of every request handler in HANDLER_METRICS
+    :param resolve: Resolves an operationId to its handler
+    :return: Resolver for add_api
+    """
+    def resolve_instrumented(operation_id: str) -> Callable:
+        return instrument(HANDLER_METRICS, operation_id.rsplit('.', 1)[-1], resolve(operation_id), note_errors=True)
+
+    return Resolver(resolve_instrumented)
+
+
+class InstrumentedDatastore:
+    """
+    Wraps a DataStore, or AsyncDataStore, recording the calls of each of its methods in DATASTORE_METRICS
+    Attributes other than methods are passed straight through
+    """
+    def __init__(self, data_store):
+        self.data_store = data_store
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.data_store, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        wrapped = instrument(DATASTORE_METRICS, name, attr)
+        # Kept on the instance so later lookups don't reach __getattr__
+        setattr(self, name, wrapped)
+        return wrapped
+
+
+def render_metrics() -> str:
+    """
+    :return: All of the metrics in the Prometheus text exposition format
+    """
+    return "\n".join(HANDLER_METRICS.render() + DATASTORE_METRICS.render()) + "\n"
@@ -0,0 +1,188 @@
+import sys
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+from sqlalchemy import bindparam
+from sqlalchemy import Column
+from sqlalchemy import Connection
+from sqlalchemy import create_engine
+from sqlalchemy import Engine
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import insert
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import text
+from sqlalchemy import update
+from sqlalchemy.schema import CreateColumn
+
+from utils import name_trigrams
+from utils import normalise_name
+
+
+"""
+Versioned Schema Migrations
+
+Base.metadata.create_all only creates tables which don't exist, it never alters
+existing ones. Changes to existing tables (new indexes, new columns) are made by
+the migrations listed in MIGRATIONS, which are applied in version order to databases
+created by earlier versions of the app.
+
+The version of a database is recorded in table schema_version. New databases are
+created with the current schema and marked as being at the latest version.
+
+To add a migration: change the ORM model, then append a function making the
+equivalent change to an existing database to MIGRATIONS with the next version number.
+
+Existing databases can be upgraded from the command line:
+python -m migrations sqlite:///PANDA.db
+"""
+
+version_metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(100)),
+)
+
+
+def _create_indexes(connection: Connection, metadata: MetaData, table_name: str, *index_names: str) -> None:
+    """
+    Create indexes which are declared on an ORM model but missing from the database
+    """
+    indexes = {index.name: index for index in metadata.tables[table_name].indexes}
+    for index_name in index_names:
+        indexes[index_name].create(connection, checkfirst=True)
+
+
+def _add_column(connection: Connection, metadata: MetaData, table_name: str, column_name: str) -> None:
+    """
+    Add a column which is declared on an ORM model but missing from the database
+    Columns added this way need a server_default if they are NOT NULL
+    """
+    column_ddl = CreateColumn(metadata.tables[table_name].c[column_name]).compile(dialect=connection.dialect)
+    connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_ddl}"))
+
+
+def _add_secondary_indexes(connection: Connection, metadata: MetaData) -> None:
+    _create_indexes(connection, metadata, 'appointments',
+                    'ix_appointments_patient_id_time', 'ix_appointments_clinician_time', 'ix_appointments_time')
+    _create_indexes(connection, metadata, 'patient', 'ix_patient_name_date_of_birth')
+
+
+def _add_version_columns(connection: Connection, metadata: MetaData) -> None:
+    _add_column(connection, metadata, 'patient', 'version')
+    _add_column(connection, metadata, 'appointments', 'version')
+
+
+def _add_department_index(connection: Connection, metadata: MetaData) -> None:
+    _create_indexes(connection, metadata, 'appointments', 'ix_appointments_department_time')
+
+
+# Patients read at a time when filling in the name search columns
+BACKFILL_BATCH_SIZE = 10000
+
+
+def _add_name_search(connection: Connection, metadata: MetaData) -> None:
+    # The patient_name_trigram table has already been made by create_all
+    _add_column(connection, metadata, 'patient', 'name_normalised')
+    patient = metadata.tables['patient']
+    trigrams = metadata.tables['patient_name_trigram']
+    last_nhs_num = ''
+    while True:
+        rows = connection.execute(select(patient.c.nhs_num, patient.c.name)
+                                  .where(patient.c.nhs_num > last_nhs_num)
+                                  .order_by(patient.c.nhs_num).limit(BACKFILL_BATCH_SIZE)).all()
+        if not rows:
+            break
+        normalised = [(nhs_num, normalise_name(name or '')) for nhs_num, name in rows]
+        connection.execute(update(patient).where(patient.c.nhs_num == bindparam('nhs_num_key'))
+                           .values(name_normalised=bindparam('name_normalised_value')),
+                           [{"nhs_num_key": nhs_num, "name_normalised_value": name} for nhs_num, name in normalised])
+        trigram_rows = [{"trigram": trigram, "nhs_num": nhs_num}
+                        for nhs_num, name in normalised for trigram in name_trigrams(name)]
+        if trigram_rows:
+            connection.execute(insert(trigrams), trigram_rows)
+        last_nhs_num = rows[-1][0]
+    _create_indexes(connection, metadata, 'patient',
+                    'ix_patient_name_normalised_date_of_birth', 'ix_patient_date_of_birth')
+
+
+def _add_incarnation_columns(connection: Connection, metadata: MetaData) -> None:
+    # Existing rows get '', rows created from now on get their own, so none of them can be mistaken for another
+    _add_column(connection, metadata, 'patient', 'incarnation')
+    _add_column(connection, metadata, 'appointments', 'incarnation')
+
+
+# (version, description, function applying the migration), in version order
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection, MetaData], None]]] = [
+    (1, "Add secondary indexes for appointment and patient queries", _add_secondary_indexes),
+    (2, "Add version columns to patient and appointments", _add_version_columns),
+    (3, "Add department index for appointment time range queries", _add_department_index),
+    (4, "Add normalised patient names and name trigrams for name searches", _add_name_search),
+    (5, "Add incarnation columns to patient and appointments for ETags", _add_incarnation_columns),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(connection: Connection) -> int:
+    """
+    :return: Version of the schema, 0 for databases which predate versioning
+    """
+    return connection.scalar(select(func.max(schema_version.c.version))) or 0
+
+
+def upgrade_connection(connection: Connection, metadata: MetaData) -> int:
+    """
+    Create any missing tables and apply outstanding migrations using connection, which should be in a transaction
+    Used directly with connections from an asyncio engine, via AsyncConnection.run_sync
+    :param connection: Connection to the database to upgrade
+    :param metadata: Metadata of the ORM models
+    :return: Schema version after the upgrade
+    """
+    # Checked before create_all, afterwards every database would look new
+    is_new_database = not inspect(connection).has_table('patient')
+    metadata.create_all(connection)
+    schema_version.create(connection, checkfirst=True)
+    current_version = get_schema_version(connection)
+
+    if is_new_database:
+        # create_all has just made the latest schema, nothing to migrate
+        connection.execute(insert(schema_version),
+                           [{"version": version, "description": description}
+                            for version, description, _ in MIGRATIONS])
+        return LATEST_VERSION
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        migration(connection, metadata)
+        connection.execute(insert(schema_version).values(version=version, description=description))
+        current_version = version
+    return current_version
+
+
+def upgrade_schema(engine: Engine, metadata: MetaData) -> int:
+    """
+    Create any missing tables and apply outstanding migrations, all in one transaction
+    :param engine: Engine connected to the database to upgrade
+    :param metadata: Metadata of the ORM models
+    :return: Schema version after the upgrade
+    """
+    with engine.begin() as connection:
+        return upgrade_connection(connection, metadata)
+
+
+if __name__ == "__main__":
+    from orm import Base
+
+    if len(sys.argv) != 2:
+        print("Usage: python -m migrations DB_URL")
+        sys.exit(1)
+    print(f"Schema version: {upgrade_schema(create_engine(sys.argv[1]), Base.metadata)}")
@@ -1,32 +1,62 @@
 import json
+import os
 
+from flask import request
+from flask import Response
+
+from cache import CachingDatastore
 from datastore import get_data_store
+from datastore import Appointment
+from datastore import Patient
 from datetime import date
 from datetime import datetime
+from typing import Callable
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Union
 from typing import Tuple
+from typing import TypeVar
 
+from exceptions import ConcurrentUpdateException
 from exceptions import DataEntryFieldException
 from exceptions import InvalidFieldException
 from exceptions import MissingFieldException
+from metrics import note_error
+from metrics import render_metrics
+from sql_profiler import SQL_PROFILER
+from application import APPOINTMENT_ID_FIELD
 from application import PatientAppointmentsApp
+from serialisation import iter_json_array
 
 from utils import get_patient_id
+from utils import get_patient_id_list
+from utils import get_str_list_field
 from utils import get_duration_field
 from utils import get_status_field
 from utils import get_datetime_field
 from utils import get_str_field
 from utils import get_postcode_str
 from utils import get_date_field
+from utils import iter_bulk_records
 from utils import Duration
+from utils import DURATION_TO_MINS
+from utils import NameMatch
 from utils import Status
+from utils import strToNameMatch
+
+# Directory containing the sample data loaded into empty databases
+SAMPLE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_data')
+
+# Number of valid records passed to the App in each call by the bulk handlers
+BULK_CHUNK_SIZE = 500
+
+# Page size used when a cursor is given without a limit
+DEFAULT_PAGE_SIZE = 100
+# Response header containing the cursor for the next page of results
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
 
-# Get the configured DataStore
-data_store = get_data_store()
-# Use configure DataStore to initialise App class instance
-appointments_app = PatientAppointmentsApp(data_store)
+T = TypeVar('T')
 
 
 """
@@ -44,8 +74,34 @@ The main purpose of these functions:
 All the functions operate in a similar way so I have not commented them individually
 
 I have provided comments for any code which might appear unusual 
+
+Nothing is done when this module is imported, the App is created on first use
+from the DataStore set with set_data_store, see get_app
 """
 
+# App class instance, created by get_app
+_appointments_app: Optional[PatientAppointmentsApp] = None
+
+
+def get_app() -> PatientAppointmentsApp:
+    """
+    :return: App class instance using the configured DataStore, replaced if a different DataStore is configured
+    """
+    global _appointments_app
+    data_store = get_data_store()
+    if _appointments_app is None or _appointments_app.dataStore is not data_store:
+        _appointments_app = PatientAppointmentsApp(data_store)
+    return _appointments_app
+
+
+def _error_response(fe: DataEntryFieldException) -> Tuple[str, int]:
+    # Counted against the handler, see metrics.note_error
+    note_error(fe)
+    # Nothing was wrong with the request, it lost a race with another one and can be retried
+    if isinstance(fe, ConcurrentUpdateException):
+        return fe.user_message, 409
+    return fe.user_message, 400
+
 
 #######################
 # APPOINTMENT HANDLERS
@@ -66,34 +122,147 @@ def create_appointment(**kwargs) -> Tuple[Union[dict, str], int]:
         clinician = get_str_field(kwargs, 'clinician')
         department = get_str_field(kwargs, 'department')
         postcode = get_postcode_str(kwargs, 'postcode')
-        return appointments_app.create_appointment(patient, appointment_time, duration,
-                                                   clinician, department, postcode, existing_id=existing_id), 200
+        return get_app().create_appointment(patient, appointment_time, duration,
+                                            clinician, department, postcode, existing_id=existing_id), 200
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
+
+
+def _appointment_from_record(record: dict) -> Appointment:
+    existing_id: Optional[str] = None
+    try:
+        existing_id = get_str_field(record, "id")
+    except MissingFieldException:
+        # that's ok, it's optional
+        pass
+    return Appointment(existing_id,
+                       get_patient_id(record, 'patient'),
+                       Status.ACTIVE.value,
+                       get_datetime_field(record, 'time'),
+                       DURATION_TO_MINS[get_duration_field(record, 'duration')],
+                       get_str_field(record, 'clinician'),
+                       get_str_field(record, 'department'),
+                       get_postcode_str(record, 'postcode'))
+
+
+def bulk_create_appointments(body: bytes = b'', **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        created, errors = _bulk_apply(body, _appointment_from_record, get_app().create_appointments)
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+    return {"created": len(created),
+            "appointments": [{"line": line_no, APPOINTMENT_ID_FIELD: appt.id} for line_no, appt in created],
+            "errors": errors}, 200
+
+
+def _conditional_response(result: Tuple[Optional[dict], str]) -> Tuple[Optional[dict], int, dict]:
+    # No body is built when the client's copy is current
+    body, etag = result
+    return body, 200 if body is not None else 304, {'ETag': etag}
+
+
+def batch_get_appointments(body: dict, **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        return get_app().get_appointments_by_id(get_str_list_field(body, 'ids')), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
 
 
 def get_appointment(**kwargs) -> Tuple[Union[dict, str], int]:
     try:
         appointment_id = get_str_field(kwargs, 'id')
-        return appointments_app.get_appointment(appointment_id), 200
+        return _conditional_response(
+            get_app().get_appointment_if_changed(appointment_id, request.headers.get('If-None-Match')))
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
+
+
+def _get_page_args(kwargs: dict) -> Tuple[Optional[int], Optional[str]]:
+    """
+    Get the optional paging query parameters
+    A cursor on its own gets a page of DEFAULT_PAGE_SIZE
+    :return: Tuple of: limit (None if the results should not be paged), cursor
+    """
+    limit: Optional[int] = kwargs.get('limit')
+    cursor: Optional[str] = kwargs.get('cursor')
+    if limit is None and cursor is not None:
+        limit = DEFAULT_PAGE_SIZE
+    return limit, cursor
+
+
+def _page_response(page: Tuple[List[dict], Optional[str]]) -> Tuple[List[dict], int, dict]:
+    # The body stays a plain list, the cursor for the next page is returned in a header
+    appointments, next_cursor = page
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor is not None else {}
+    return appointments, 200, headers
+
+
+def _stream_response(items: Iterator[dict]) -> Response:
+    # The body is serialised and sent as the rows are read, rather than built up in memory first
+    return Response(iter_json_array(items), status=200, mimetype='application/json')
 
 
 def get_patient_appointments(**kwargs) -> Tuple[Union[List[dict], str], int]:
     try:
         patient = get_patient_id(kwargs, 'patient')
-        return appointments_app.get_patient_appointments(patient), 200
+        limit, cursor = _get_page_args(kwargs)
+        if limit is not None:
+            return _page_response(get_app().get_patient_appointments_page(patient, limit, cursor))
+        if kwargs.get('stream'):
+            return _stream_response(get_app().iter_patient_appointments(patient))
+        return get_app().get_patient_appointments(patient), 200
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
 
 
 def get_clinician_appointments(**kwargs) -> Tuple[Union[List[dict], str], int]:
     try:
         clinician = get_str_field(kwargs, 'clinician')
-        return appointments_app.get_clinician_appointments(clinician), 200
+        limit, cursor = _get_page_args(kwargs)
+        if limit is not None:
+            return _page_response(get_app().get_clinician_appointments_page(clinician, limit, cursor))
+        if kwargs.get('stream'):
+            return _stream_response(get_app().iter_clinician_appointments(clinician))
+        return get_app().get_clinician_appointments(clinician), 200
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
+
+
+def get_department_appointments(**kwargs) -> Tuple[Union[List[dict], str], int]:
+    status: Optional[Status] = None
+
+    try:
+        department = get_str_field(kwargs, 'department')
+        start = get_datetime_field(kwargs, 'from')
+        end = get_datetime_field(kwargs, 'to')
+        try:
+            status = get_status_field(kwargs, 'status')
+        except MissingFieldException:
+            # that's ok, it's optional
+            pass
+        # Always paged, a department can have any number of appointments in a range
+        limit, cursor = _get_page_args(kwargs)
+        return _page_response(get_app().get_department_appointments_page(
+            department, start, end, status.value if status is not None else None, limit or DEFAULT_PAGE_SIZE, cursor))
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+def get_clinician_free_slots(**kwargs) -> Tuple[Union[List[dict], str], int]:
+    duration: Optional[Duration] = None
+
+    try:
+        clinician = get_str_field(kwargs, 'clinician')
+        start = get_datetime_field(kwargs, 'from')
+        end = get_datetime_field(kwargs, 'to')
+        try:
+            duration = get_duration_field(kwargs, 'duration')
+        except MissingFieldException:
+            # that's ok, it's optional
+            pass
+        return get_app().get_clinician_free_slots(clinician, start, end, duration=duration), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
 
 
 def update_appointment(**kwargs) -> Tuple[Union[dict, str], int]:
@@ -122,14 +291,15 @@ def update_appointment(**kwargs) -> Tuple[Union[dict, str], int]:
             pass
         # However, we do want to capture invalid fields if they've been included
     except InvalidFieldException as ife:
-        return ife.user_message, 400
+        return _error_response(ife)
 
     try:
         appointment_id = get_str_field(kwargs, 'id')
-        return appointments_app.update_appointment(appointment_id, appointment_time=appointment_time,
-                                                   duration=duration, clinician=clinician, status=status), 200
+        return get_app().update_appointment(appointment_id, appointment_time=appointment_time,
+                                            duration=duration, clinician=clinician,
+                                            status=status.value if status is not None else None), 200
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
 
 
 #######################
@@ -141,9 +311,28 @@ def create_patient(**kwargs) -> Tuple[Union[dict, str], int]:
         date_of_birth = get_date_field(kwargs, 'date_of_birth')
         patient_name = get_str_field(kwargs, 'name')
         postcode = get_postcode_str(kwargs, 'postcode')
-        return appointments_app.create_patient(patient, date_of_birth, patient_name, postcode), 200
+        return get_app().create_patient(patient, date_of_birth, patient_name, postcode), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+def _patient_from_record(record: dict) -> Patient:
+    return Patient(get_patient_id(record, 'nhs_number'),
+                   get_str_field(record, 'name'),
+                   get_date_field(record, 'date_of_birth'),
+                   get_postcode_str(record, 'postcode'))
+
+
+def _patient_id_from_record(record: dict) -> str:
+    return get_patient_id(record, 'nhs_number')
+
+
+def bulk_create_patients(body: bytes = b'', **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        created, errors = _bulk_apply(body, _patient_from_record, get_app().create_patients)
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
+    return {"created": len(created), "errors": errors}, 200
 
 
 def update_patient(**kwargs) -> Tuple[Union[dict, str], int]:
@@ -167,22 +356,30 @@ def update_patient(**kwargs) -> Tuple[Union[dict, str], int]:
             pass
         # However, we do want to capture invalid fields if they've been included
     except InvalidFieldException as ife:
-        return ife.user_message, 400
+        return _error_response(ife)
 
     try:
         patient_id = get_patient_id(kwargs, 'nhs_number')
-        return appointments_app.update_patient(patient_id, date_of_birth=date_of_birth,
-                                               patient_name=patient_name, postcode=postcode), 200
+        return get_app().update_patient(patient_id, date_of_birth=date_of_birth,
+                                        patient_name=patient_name, postcode=postcode), 200
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
+
+
+def batch_get_patients(body: dict, **kwargs) -> Tuple[Union[dict, str], int]:
+    try:
+        return get_app().get_patients_by_id(get_patient_id_list(body, 'nhs_numbers')), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
 
 
 def get_patient(**kwargs) -> Tuple[Union[dict, str], int]:
     try:
         patient_id = get_patient_id(kwargs, 'nhs_number')
-        return appointments_app.get_patient(patient_id), 200
+        return _conditional_response(
+            get_app().get_patient_if_changed(patient_id, request.headers.get('If-None-Match')))
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
 
 
 def find_patient(**kwargs) -> Tuple[Union[List[dict], str], int]:
@@ -195,21 +392,112 @@ def find_patient(**kwargs) -> Tuple[Union[List[dict], str], int]:
         pass
     # However, we do want to capture invalid fields if they've been included
     except InvalidFieldException as ife:
-        return ife.user_message, 400
+        return _error_response(ife)
 
     try:
         patient_name = get_str_field(kwargs, 'name')
-        return appointments_app.find_patient(patient_name, date_of_birth), 200
+        match = strToNameMatch(kwargs.get('match', NameMatch.EXACT.value))
+        if kwargs.get('stream'):
+            return _stream_response(get_app().iter_find_patient(patient_name, date_of_birth, match))
+        return get_app().find_patient(patient_name, date_of_birth, match), 200
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
 
 
 def delete_patient(**kwargs) -> Tuple[Union[dict, str], int]:
     try:
         patient_id = get_str_field(kwargs, 'nhs_number')
-        return appointments_app.delete_patient(patient_id), 200
+        return get_app().delete_patient(patient_id), 200
+    except DataEntryFieldException as fe:
+        return _error_response(fe)
+
+
+def bulk_delete_patients(**kwargs) -> Tuple[Union[dict, str], int]:
+    # connexion only passes request bodies to POST, PUT and PATCH handlers, so read it here
+    body = request.get_data()
+    try:
+        deleted, errors = _bulk_apply(body, _patient_id_from_record, get_app().delete_patients)
     except DataEntryFieldException as fe:
-        return fe.user_message, 400
+        return _error_response(fe)
+    return {"deleted": len(deleted), "errors": errors}, 200
+
+
+#######################
+# ADMIN HANDLERS
+#######################
+def get_cache_stats(**kwargs) -> Tuple[dict, int]:
+    # Empty when the DataStore isn't cached
+    data_store = get_data_store()
+    if isinstance(data_store, CachingDatastore):
+        return data_store.cache_stats(), 200
+    return {}, 200
+
+
+def get_metrics(**kwargs) -> Tuple[str, int]:
+    return render_metrics(), 200
+
+
+def get_sql_profile(**kwargs) -> Tuple[dict, int]:
+    return SQL_PROFILER.report(), 200
+
+
+#######################
+# BULK HELPERS
+#######################
+def _bulk_error(line_no: int, msg: str) -> dict:
+    return {"line": line_no, "error": msg}
+
+
+def _iter_bulk_chunks(body: bytes, record_to_entity: Callable[[dict], T],
+                      errors: List[dict]) -> Iterator[List[Tuple[int, T]]]:
+    """
+    Validate the records in a bulk request body, shared by the Flask and aiohttp handlers
+    :param body: JSON array or NDJSON request body
+    :param record_to_entity: Validates a record, raising DataEntryFieldException if it is invalid
+    :param errors: An error is added for each invalid record, by line number
+    :return: Chunks of at most BULK_CHUNK_SIZE (line number, entity) for the valid records
+    """
+    chunk: List[Tuple[int, T]] = []
+    for line_no, record in iter_bulk_records(body):
+        try:
+            if isinstance(record, DataEntryFieldException):
+                raise record
+            chunk.append((line_no, record_to_entity(record)))
+        except DataEntryFieldException as fe:
+            errors.append(_bulk_error(line_no, fe.user_message))
+        if len(chunk) == BULK_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _chunk_results(chunk: List[Tuple[int, T]], chunk_errors: List[Optional[str]],
+                   applied: List[Tuple[int, T]], errors: List[dict]) -> None:
+    for (line_no, entity), msg in zip(chunk, chunk_errors):
+        if msg is None:
+            applied.append((line_no, entity))
+        else:
+            errors.append(_bulk_error(line_no, msg))
+
+
+def _bulk_apply(body: bytes, record_to_entity: Callable[[dict], T],
+                apply_to_entities: Callable[[List[T]], List[Optional[str]]]) -> Tuple[List[Tuple[int, T]], List[dict]]:
+    """
+    Validate the records in a bulk request body and apply an app method to them in chunks of BULK_CHUNK_SIZE,
+    e.g. to create or delete them
+    Invalid records are reported by line number, they don't stop the valid records being applied
+    :param body: JSON array or NDJSON request body
+    :param record_to_entity: Validates a record, raising DataEntryFieldException if it is invalid
+    :param apply_to_entities: App method taking a chunk of entities, returns an error (or None) per entity
+    :return: Tuple of: (line number, entity) for each entity applied without error, errors sorted by line number
+    """
+    applied: List[Tuple[int, T]] = []
+    errors: List[dict] = []
+    for chunk in _iter_bulk_chunks(body, record_to_entity, errors):
+        _chunk_results(chunk, apply_to_entities([entity for _, entity in chunk]), applied, errors)
+    errors.sort(key=lambda error: error["line"])
+    return applied, errors
 
 
 def populate_sample_data() -> None:
@@ -218,18 +506,20 @@ def populate_sample_data() -> None:
     Intended to only be called on startup if the database is found to be empty
     :return:
     """
-    with open("./sample_data/example_patients.json", "r") as json_file:
+    with open(os.path.join(SAMPLE_DATA_DIR, "example_patients.json"), "r") as json_file:
         contents = json.load(json_file)
         for jDict in contents:
             create_patient(**jDict)
-    with open("./sample_data/example_appointments.json", "r") as json_file:
+    with open(os.path.join(SAMPLE_DATA_DIR, "example_appointments.json"), "r") as json_file:
         contents = json.load(json_file)
         for jDict in contents:
             create_appointment(**jDict)
 
 
-# Application Evaluation Facility
-# Populate empty database with sample data
-if data_store.is_db_empty():
-    populate_sample_data()
-
+def populate_sample_data_if_empty() -> None:
+    """
+    Application Evaluation Facility
+    Populate the configured DataStore with sample data if it is empty
+    """
+    if get_data_store().is_db_empty():
+        populate_sample_data()
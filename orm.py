@@ -1,32 +1,87 @@
+import os
 import uuid
+import weakref
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
 
+from sqlalchemy import and_
+from sqlalchemy import ColumnElement
+from sqlalchemy import Connection
 from sqlalchemy import create_engine
 from sqlalchemy import Column
 from sqlalchemy import Date
 from sqlalchemy import DateTime
+from sqlalchemy import Engine
+from sqlalchemy import delete
+from sqlalchemy import event
 from sqlalchemy import ForeignKey
+from sqlalchemy import func
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import insert
+from sqlalchemy import or_
 from sqlalchemy import select
+from sqlalchemy import Select
+from sqlalchemy import update
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
 
 from datastore import DataStore
 from datastore import Appointment
+from datastore import AppointmentBooking
+from datastore import AppointmentKey
+from datastore import AppointmentRow
 from datastore import Patient
+from datastore import PatientRow
+from datastore import APPOINTMENT_ROW_FIELDS
+from datastore import PATIENT_ROW_FIELDS
+from datastore import new_appointment_ids
+from datastore import new_incarnation
+from migrations import upgrade_schema
+from exceptions import AppointmentAlreadyExistsException
 from exceptions import AppointmentNotFoundException
+from exceptions import ClinicianUnavailableException
+from exceptions import ConcurrentUpdateException
 from exceptions import PatientNotFoundException
 from exceptions import PatientAlreadyExistsException
+from schedule import ScheduleIndex
+from schedule import appointment_end
+from schedule import as_utc
+from schedule import book_batch
+from schedule import clinician_spans
+from schedule import moved_appointment
+from schedule import overlaps
+from sql_profiler import SqlProfiler
+from utils import MAX_DURATION_MINS
+from utils import NameMatch
 from utils import Status
+from utils import check_status_change
+from utils import min_shared_trigrams
+from utils import name_trigrams
+from utils import normalise_name
+from utils import rank_by_similarity
+from utils import statuses_changeable_to
 
 Base = declarative_base()
 
+# Number of rows fetched from the DB cursor at a time by the iter_ methods
+YIELD_PER = 500
+# Maximum number of bound parameters used in one IN clause, keeps within the SQLite default limit
+MAX_IN_PARAMS = 500
+
 
 class ORMPatient(Base, Patient):
     __tablename__ = 'patient'
@@ -34,9 +89,45 @@ class ORMPatient(Base, Patient):
     name = Column('name', String(50))
     date_of_birth = Column('date_of_birth', Date)
     postcode = Column('postcode', String(8))
+    version = Column('version', Integer, nullable=False, default=1, server_default='1')
+    # Rows which predate the column share '', any row created since has its own, see new_incarnation
+    incarnation = Column('incarnation', String(16), nullable=False, default=new_incarnation, server_default='')
+    # Name in the form used by prefix and fuzzy searches, see utils.normalise_name
+    name_normalised = Column('name_normalised', String(50))
+
+    # Existing databases get new indexes and columns through a migration, see migrations.py
+    __table_args__ = (
+        Index('ix_patient_name_date_of_birth', 'name', 'date_of_birth'),
+        Index('ix_patient_name_normalised_date_of_birth', 'name_normalised', 'date_of_birth'),
+        Index('ix_patient_date_of_birth', 'date_of_birth'),
+    )
+    # SQLAlchemy increments version on every ORM update
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, nhs_num: str, name: str, date_of_birth: date, postcode: str):
-        super(ORMPatient, self).__init__(nhs_num=nhs_num, name=name, date_of_birth=date_of_birth, postcode=postcode)
+        super(ORMPatient, self).__init__(nhs_num=nhs_num, name=name, date_of_birth=date_of_birth, postcode=postcode,
+                                         name_normalised=normalise_name(name))
+
+
+class ORMPatientNameTrigram(Base):
+    """
+    Trigram index of patient names for fuzzy searches, one row per distinct trigram of each patient's name
+    The primary key gives the lookup by trigram
+    """
+    __tablename__ = 'patient_name_trigram'
+    trigram = Column(String(3), primary_key=True)
+    nhs_num = Column(String(10), ForeignKey('patient.nhs_num'), primary_key=True)
+
+    __table_args__ = (
+        Index('ix_patient_name_trigram_nhs_num', 'nhs_num'),
+    )
+
+
+def name_trigram_rows(nhs_num: str, name: str) -> List[dict]:
+    """
+    :return: patient_name_trigram rows for a patient's name
+    """
+    return [{"trigram": trigram, "nhs_num": nhs_num} for trigram in name_trigrams(normalise_name(name))]
 
 
 class ORMAppointment(Base, Appointment):
@@ -49,8 +140,20 @@ class ORMAppointment(Base, Appointment):
     clinician = Column('clinician', String(50))
     department = Column('department', String(20))
     postcode = Column('postcode', String(8))
+    version = Column('version', Integer, nullable=False, default=1, server_default='1')
+    incarnation = Column('incarnation', String(16), nullable=False, default=new_incarnation, server_default='')
     patient = relationship('ORMPatient')
 
+    # Existing databases get new indexes and columns through a migration, see migrations.py
+    __table_args__ = (
+        Index('ix_appointments_patient_id_time', 'patient_id', 'title'),
+        Index('ix_appointments_clinician_time', 'clinician', 'title'),
+        Index('ix_appointments_time', 'title'),
+        Index('ix_appointments_department_time', 'department', 'title'),
+    )
+    # SQLAlchemy increments version on every ORM update
+    __mapper_args__ = {'version_id_col': version}
+
     def __init__(self, id: str, patient_id: str, status: str, time: datetime, duration_mins: int, clinician: str,
                  department: str, postcode: str):
         super(ORMAppointment, self).__init__(id=id, patient_id=patient_id, status=status, time=time,
@@ -58,11 +161,81 @@ class ORMAppointment(Base, Appointment):
                                              postcode=postcode)
 
 
+class ORMClinicianLock(Base):
+    """
+    A row per clinician who has been booked, locked while a booking of the clinician is checked for
+    double-booking and made, see AlchemyDatastore._lock_clinicians
+    Not used on SQLite, which locks the whole database instead
+    """
+    __tablename__ = 'clinician_lock'
+    clinician = Column(String(50), primary_key=True)
+
+
+# Columns read by the _rows methods, in AppointmentRow and PatientRow order
+APPOINTMENT_ROW_COLUMNS = tuple(getattr(ORMAppointment, field) for field in APPOINTMENT_ROW_FIELDS)
+PATIENT_ROW_COLUMNS = tuple(getattr(ORMPatient, field) for field in PATIENT_ROW_FIELDS)
+
+
+# Engines created by AlchemyDatastore, see _dispose_engines_after_fork
+_ENGINES: 'weakref.WeakSet[Engine]' = weakref.WeakSet()
+
+
+def _dispose_engines_after_fork() -> None:
+    # Pooled connections must not be shared with a forked process, e.g. a pre-fork server worker
+    # The child drops the parent's connections without closing them and opens its own
+    for engine in list(_ENGINES):
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+
+def _set_sqlite_wal(dbapi_connection, _) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # Safe with WAL, only the last transactions can be lost on power failure
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 class AlchemyDatastore(DataStore):
 
-    def __init__(self, db_url: str):
-        self.engine = create_engine(db_url, echo=True)
-        Base.metadata.create_all(self.engine)
+    def __init__(self, db_url: str, pool_size: Optional[int] = None, echo: bool = False, sqlite_wal: bool = True,
+                 profiler: Optional[SqlProfiler] = None):
+        """
+        :param db_url: SQLAlchemy DB URL
+        :param pool_size: Number of connections kept open, None for the SQLAlchemy default
+        :param echo: Log every SQL statement
+        :param sqlite_wal: Put file based SQLite databases in WAL mode, so readers don't block the writer
+        :param profiler: Times every statement and logs slow ones, see sql_profiler.py
+        """
+        engine_args = {} if pool_size is None else {'pool_size': pool_size}
+        engine = create_engine(db_url, echo=echo, **engine_args)
+        if sqlite_wal and engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+            event.listen(engine, 'connect', _set_sqlite_wal)
+        if profiler is not None:
+            profiler.attach(engine)
+        _ENGINES.add(engine)
+        self.engine: Union[Engine, Connection] = engine
+        upgrade_schema(self.engine, Base.metadata)
+
+    def dispose(self) -> None:
+        """
+        Close all pooled connections
+        """
+        self.engine.dispose()
+
+    @classmethod
+    def for_connection(cls, connection: Connection) -> 'AlchemyDatastore':
+        """
+        Create an AlchemyDatastore which runs its queries on an existing connection rather than its own engine
+        Used by AsyncAlchemyDatastore to run these methods on connections from an asyncio engine
+        :param connection: Connection to use, the schema must already be up to date
+        :return: AlchemyDatastore using connection
+        """
+        data_store = cls.__new__(cls)
+        data_store.engine = connection
+        return data_store
 
     def create_appointment(self, patient: str, appointment_time: datetime, duration_mins: int,
                            clinician: str, department: str, postcode: str, appointment_id: Optional[str] = None) -> str:
@@ -70,25 +243,194 @@ class AlchemyDatastore(DataStore):
             appointment_id = str(uuid.uuid4())
         appointment = ORMAppointment(appointment_id, patient, Status.ACTIVE.value, appointment_time, duration_mins,
                                      clinician, department, postcode)
-        with Session(self.engine) as session:
-            session.add(appointment)
-            session.commit()
+        try:
+            with Session(self.engine) as session:
+                self._lock_clinicians(session, [clinician])
+                for booked in self._overlapping(session, clinician, appointment_time, appointment_end(appointment)):
+                    # An appointment with the same id is reported by the insert, as already existing
+                    if booked.id != appointment_id:
+                        raise ClinicianUnavailableException(booked.id)
+                session.add(appointment)
+                session.commit()
+        except IntegrityError as ie:
+            raise AppointmentAlreadyExistsException(appointment_id)
         return appointment_id
 
+    def create_appointments(self, appointments: List[Appointment]) -> List[str]:
+        new_ids = iter(new_appointment_ids(sum(1 for appt in appointments if appt.id is None)))
+        with Session(self.engine) as session:
+            self._lock_clinicians(session, {appt.clinician for appt in appointments})
+            existing = self._existing_keys(session, ORMAppointment.id,
+                                           [appt.id for appt in appointments if appt.id is not None])
+            new_appointments = []
+            for appt in appointments:
+                if appt.id is None:
+                    appt.id = next(new_ids)
+                elif appt.id in existing:
+                    continue
+                existing.add(appt.id)
+                new_appointments.append(appt)
+            # One range query per clinician in the batch, rather than one per appointment
+            schedules = ScheduleIndex()
+            for clinician, (start, end) in clinician_spans(new_appointments).items():
+                for booked in self._overlapping(session, clinician, start, end):
+                    schedules.add(booked)
+            rows = [{"id": appt.id, "patient_id": appt.patient_id, "status": Status.ACTIVE.value,
+                     "time": appt.time, "duration_mins": appt.duration_mins, "clinician": appt.clinician,
+                     "department": appt.department, "postcode": appt.postcode}
+                    for appt in book_batch(new_appointments, schedules)]
+            return self._bulk_insert(session, ORMAppointment, rows, "id")
+
     def get_appointment(self, appointment_id: str) -> Appointment:
         stmt = select(ORMAppointment).where(ORMAppointment.id == appointment_id)
         with Session(self.engine) as session:
             return session.scalar(stmt)
 
-    def get_appointments(self, patient_id: str) -> List[Appointment]:
-        stmt = select(ORMAppointment).where(ORMAppointment.patient_id == patient_id)
+    def get_appointments_by_id(self, appointment_ids: List[str]) -> List[Appointment]:
+        return self._get_by_keys(ORMAppointment, ORMAppointment.id, appointment_ids)
+
+    def get_appointments(self, patient_id: str, limit: Optional[int] = None,
+                         after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return self._appointments_page(ORMAppointment.patient_id == patient_id, limit, after)
+
+    def get_clinician_appointments(self, clinician: str, limit: Optional[int] = None,
+                                   after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return self._appointments_page(ORMAppointment.clinician == clinician, limit, after)
+
+    def get_overlapping_appointments(self, clinician: str, start: datetime, end: datetime) -> List[Appointment]:
         with Session(self.engine) as session:
-            return [appt for appt in session.scalars(stmt)]
+            return self._overlapping(session, clinician, start, end)
+
+    @staticmethod
+    def _overlapping(session: Session, clinician: str, start: datetime, end: datetime) -> List[Appointment]:
+        # A range scan of the (clinician, time) index, only appointments starting within the longest
+        # duration of start can overlap, the end of each candidate is checked here
+        stmt = select(ORMAppointment).where(ORMAppointment.clinician == clinician,
+                                            ORMAppointment.time >= start - timedelta(minutes=MAX_DURATION_MINS),
+                                            ORMAppointment.time < end,
+                                            ORMAppointment.status == Status.ACTIVE.value)
+        return [appt for appt in session.scalars(stmt) if overlaps(appt, as_utc(start), as_utc(end))]
+
+    @staticmethod
+    def _lock_clinicians(session: Session, clinicians: Iterable[str]) -> None:
+        """
+        Lock clinicians' diaries until the end of session's transaction, so that a double-booking check and the
+        write relying on it can't be interleaved with another booking of the same clinicians, from this process
+        or any other
+        SQLite locks the whole database, so this must come before any write in the transaction
+        """
+        connection = session.connection()
+        if connection.dialect.name == 'sqlite':
+            # The default deferred BEGIN only takes the write lock at the first write, which is after the check
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            return
+        # A consistent order, so that two batches can't each hold a lock the other is waiting for
+        clinicians = sorted(set(clinicians))
+        for idx in range(0, len(clinicians), MAX_IN_PARAMS):
+            chunk = clinicians[idx:idx + MAX_IN_PARAMS]
+            existing = set(session.scalars(select(ORMClinicianLock.clinician)
+                                           .where(ORMClinicianLock.clinician.in_(chunk))))
+            for clinician in chunk:
+                if clinician in existing:
+                    continue
+                try:
+                    with session.begin_nested():
+                        session.execute(insert(ORMClinicianLock).values(clinician=clinician))
+                except IntegrityError:
+                    # Added by a concurrent booking, locked below once that commits
+                    pass
+            session.execute(select(ORMClinicianLock.clinician).where(ORMClinicianLock.clinician.in_(chunk))
+                            .order_by(ORMClinicianLock.clinician).with_for_update())
+
+    def get_department_appointments(self, department: str, start: datetime, end: datetime,
+                                    status: Optional[str] = None, limit: Optional[int] = None,
+                                    after: Optional[AppointmentKey] = None) -> List[Appointment]:
+        return self._appointments_page(self._department_criterion(department, start, end, status), limit, after)
+
+    def iter_appointments(self, patient_id: str) -> Iterator[Appointment]:
+        stmt = select(ORMAppointment).where(ORMAppointment.patient_id == patient_id)
+        return self._iter_rows(stmt)
 
-    def get_clinician_appointments(self, clinician: str) -> List[Appointment]:
+    def iter_clinician_appointments(self, clinician: str) -> Iterator[Appointment]:
         stmt = select(ORMAppointment).where(ORMAppointment.clinician == clinician)
+        return self._iter_rows(stmt)
+
+    def get_appointment_rows(self, patient_id: str, limit: Optional[int] = None,
+                             after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return self._appointment_rows_page(ORMAppointment.patient_id == patient_id, limit, after)
+
+    def get_clinician_appointment_rows(self, clinician: str, limit: Optional[int] = None,
+                                       after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return self._appointment_rows_page(ORMAppointment.clinician == clinician, limit, after)
+
+    def get_department_appointment_rows(self, department: str, start: datetime, end: datetime,
+                                        status: Optional[str] = None, limit: Optional[int] = None,
+                                        after: Optional[AppointmentKey] = None) -> List[AppointmentRow]:
+        return self._appointment_rows_page(self._department_criterion(department, start, end, status), limit, after)
+
+    def iter_appointment_rows(self, patient_id: str) -> Iterator[AppointmentRow]:
+        stmt = select(*APPOINTMENT_ROW_COLUMNS).where(ORMAppointment.patient_id == patient_id)
+        return self._iter_core_rows(stmt)
+
+    def iter_clinician_appointment_rows(self, clinician: str) -> Iterator[AppointmentRow]:
+        stmt = select(*APPOINTMENT_ROW_COLUMNS).where(ORMAppointment.clinician == clinician)
+        return self._iter_core_rows(stmt)
+
+    def _iter_rows(self, stmt: Select) -> Iterator:
+        """
+        Yield the results of stmt YIELD_PER rows at a time, using a server side cursor where the DB supports one
+        The Session stays open until the iterator is exhausted or closed
+        """
+        with Session(self.engine) as session:
+            yield from session.scalars(stmt.execution_options(yield_per=YIELD_PER))
+
+    def _fetch_core_rows(self, stmt: Select) -> List[tuple]:
+        """
+        Run a select of columns as a Core statement, the rows are returned as tuples and no ORM objects are built
+        """
+        with Session(self.engine) as session:
+            return session.connection().execute(stmt).all()
+
+    def _iter_core_rows(self, stmt: Select) -> Iterator[tuple]:
+        """
+        _iter_rows for a select of columns, run as a Core statement
+        """
         with Session(self.engine) as session:
-            return [appt for appt in session.scalars(stmt)]
+            yield from session.connection().execute(stmt.execution_options(yield_per=YIELD_PER))
+
+    @staticmethod
+    def _department_criterion(department: str, start: datetime, end: datetime,
+                              status: Optional[str]) -> ColumnElement[bool]:
+        criterion = and_(ORMAppointment.department == department,
+                         ORMAppointment.time >= start, ORMAppointment.time < end)
+        if status is not None:
+            criterion = and_(criterion, ORMAppointment.status == status)
+        return criterion
+
+    @staticmethod
+    def _page_stmt(stmt: Select, criterion: ColumnElement[bool], limit: Optional[int],
+                   after: Optional[AppointmentKey]) -> Select:
+        """
+        Keyset pagination, the (patient_id/clinician/department, time) indexes give the order and
+        the start of the page without reading any of the rows before it
+        """
+        stmt = stmt.where(criterion).order_by(ORMAppointment.time, ORMAppointment.id)
+        if after is not None:
+            after_time, after_id = after
+            stmt = stmt.where(or_(ORMAppointment.time > after_time,
+                                  and_(ORMAppointment.time == after_time, ORMAppointment.id > after_id)))
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    def _appointments_page(self, criterion: ColumnElement[bool], limit: Optional[int],
+                           after: Optional[AppointmentKey]) -> List[Appointment]:
+        with Session(self.engine) as session:
+            return [appt for appt in session.scalars(self._page_stmt(select(ORMAppointment), criterion, limit, after))]
+
+    def _appointment_rows_page(self, criterion: ColumnElement[bool], limit: Optional[int],
+                               after: Optional[AppointmentKey]) -> List[AppointmentRow]:
+        return self._fetch_core_rows(self._page_stmt(select(*APPOINTMENT_ROW_COLUMNS), criterion, limit, after))
 
     def update_appointment(self, appointment_id: str, appointment_time: Optional[datetime] = None,
                            duration_mins: Optional[int] = None, clinician: Optional[str] = None,
@@ -99,6 +441,15 @@ class AlchemyDatastore(DataStore):
 
             if appt is None:
                 raise AppointmentNotFoundException(appointment_id)
+            if status is not None:
+                # The UPDATE is conditional on the version read here, so the status can't have changed since
+                check_status_change(appt.status, status)
+            moved = moved_appointment(appt, appointment_time, duration_mins, clinician, status)
+            if moved is not None:
+                self._lock_clinicians(session, [moved.clinician])
+                for booked in self._overlapping(session, moved.clinician, moved.time, appointment_end(moved)):
+                    if booked.id != appointment_id:
+                        raise ClinicianUnavailableException(booked.id)
             do_commit = False
             if appointment_time is not None:
                 appt.time = appointment_time
@@ -114,19 +465,74 @@ class AlchemyDatastore(DataStore):
                 do_commit = True
 
             if do_commit:
-                session.commit()
+                self._commit_versioned(session, appointment_id)
         return appointment_id
 
+    @staticmethod
+    def _commit_versioned(session: Session, key: str) -> None:
+        """
+        Commit changes to versioned rows, the UPDATE matches the version read, so it changes nothing if another
+        writer got there first
+        :raises ConcurrentUpdateException: if another writer changed the row since it was read
+        """
+        try:
+            session.commit()
+        except StaleDataError:
+            session.rollback()
+            raise ConcurrentUpdateException(key)
+
+    def update_appointment_status(self, appointment_id: str, status: str) -> str:
+        self.update_appointment_status_returning(appointment_id, status)
+        return appointment_id
+
+    def update_appointment_status_returning(self, appointment_id: str, status: str) -> AppointmentBooking:
+        # The status change rules are part of the WHERE clause, one statement checks and makes the change, and
+        # RETURNING saves reading the appointment again for where it was booked
+        stmt = (update(ORMAppointment.__table__)
+                .where(ORMAppointment.id == appointment_id,
+                       ORMAppointment.status.in_(statuses_changeable_to(status)))
+                .values(status=status, version=ORMAppointment.version + 1)
+                .returning(ORMAppointment.clinician, ORMAppointment.time, ORMAppointment.duration_mins))
+        with Session(self.engine) as session:
+            booking = session.connection().execute(stmt).first()
+            while booking is None:
+                # Only reached when nothing was updated, find out why
+                current = session.scalar(select(ORMAppointment.status).where(ORMAppointment.id == appointment_id))
+                if current is None:
+                    raise AppointmentNotFoundException(appointment_id)
+                check_status_change(current, status)
+                # The status was changed by another writer in between, to one which can be changed, try again
+                booking = session.connection().execute(stmt).first()
+            session.commit()
+        clinician, time, duration_mins = booking
+        return clinician, time, duration_mins
+
     def create_patient(self, patient_id: str, date_of_birth: date, patient_name: str, postcode: str) -> str:
         patient = ORMPatient(patient_id, patient_name, date_of_birth, postcode)
         try:
             with Session(self.engine) as session:
                 session.add(patient)
+                session.flush()
+                self._insert_name_trigrams(session, patient_id, patient_name)
                 session.commit()
         except IntegrityError as ie:
             raise PatientAlreadyExistsException(patient_id)
         return patient_id
 
+    def create_patients(self, patients: List[Patient]) -> List[str]:
+        with Session(self.engine) as session:
+            existing = self._existing_keys(session, ORMPatient.nhs_num, [patient.nhs_num for patient in patients])
+            rows = []
+            for patient in patients:
+                if patient.nhs_num in existing:
+                    continue
+                # Also skips repeats of the same NHS Number within the batch
+                existing.add(patient.nhs_num)
+                rows.append({"nhs_num": patient.nhs_num, "name": patient.name,
+                             "name_normalised": normalise_name(patient.name),
+                             "date_of_birth": patient.date_of_birth, "postcode": patient.postcode})
+            return self._bulk_insert(session, ORMPatient, rows, "nhs_num", self._name_trigram_inserts)
+
     def update_patient(self, patient_id: str, date_of_birth: Optional[date] = None,
                        patient_name: Optional[str] = None, postcode: Optional[str] = None):
         stmt = select(ORMPatient).where(ORMPatient.nhs_num == patient_id)
@@ -140,13 +546,16 @@ class AlchemyDatastore(DataStore):
                 do_commit = True
             if patient_name is not None:
                 patient.name = patient_name
+                patient.name_normalised = normalise_name(patient_name)
+                session.execute(delete(ORMPatientNameTrigram).where(ORMPatientNameTrigram.nhs_num == patient_id))
+                self._insert_name_trigrams(session, patient_id, patient_name)
                 do_commit = True
             if postcode is not None:
                 patient.postcode = postcode
                 do_commit = True
 
             if do_commit:
-                session.commit()
+                self._commit_versioned(session, patient_id)
         return patient_id
 
     def get_patient(self, patient_id: str) -> Patient:
@@ -154,25 +563,177 @@ class AlchemyDatastore(DataStore):
         with Session(self.engine) as session:
             return session.scalar(stmt)
 
-    def findPatient(self, patient_name: str, date_of_birth: Optional[date]) -> List[Patient]:
-        if date_of_birth is None:
-            stmt = select(ORMPatient).where(ORMPatient.name == patient_name)
+    def get_patients_by_id(self, patient_ids: List[str]) -> List[Patient]:
+        return self._get_by_keys(ORMPatient, ORMPatient.nhs_num, patient_ids)
+
+    def _get_by_keys(self, entity: type, column: Column, keys: List[str]) -> list:
+        """
+        Get the entities whose column is one of keys, in one Session with a query per MAX_IN_PARAMS keys
+        """
+        keys = list(dict.fromkeys(keys))
+        found = []
+        with Session(self.engine) as session:
+            for idx in range(0, len(keys), MAX_IN_PARAMS):
+                found.extend(session.scalars(select(entity).where(column.in_(keys[idx:idx + MAX_IN_PARAMS]))))
+        return found
+
+    @staticmethod
+    def _find_patient_stmt(patient_name: str, date_of_birth: Optional[date], match: str,
+                           columns: tuple = (ORMPatient,), limit: Optional[int] = None) -> Select:
+        """
+        :param columns: What to select, the ORMPatient entity or columns
+        :param limit: Applied here unless the search is fuzzy, fuzzy matches are limited after they are ranked
+        """
+        if match == NameMatch.PREFIX.value:
+            # A range of the name_normalised index, usable whatever the DB's LIKE and collation rules
+            prefix = normalise_name(patient_name)
+            stmt = select(*columns).where(ORMPatient.name_normalised >= prefix,
+                                            ORMPatient.name_normalised < prefix + "\U0010ffff")
+            # Index order, so a limited search stops early rather than sorting every match
+            stmt = stmt.order_by(ORMPatient.name_normalised)
+        elif match == NameMatch.FUZZY.value and date_of_birth is None:
+            # Only patients sharing enough trigrams with the name can be similar enough, see min_shared_trigrams
+            trigrams = name_trigrams(normalise_name(patient_name))
+            candidates = (select(ORMPatientNameTrigram.nhs_num)
+                          .where(ORMPatientNameTrigram.trigram.in_(trigrams))
+                          .group_by(ORMPatientNameTrigram.nhs_num)
+                          .having(func.count() >= min_shared_trigrams(trigrams)))
+            stmt = select(*columns).where(ORMPatient.nhs_num.in_(candidates))
+        elif match == NameMatch.FUZZY.value:
+            # Few patients share a date of birth, they are all compared with the name
+            stmt = select(*columns)
         else:
-            stmt = select(ORMPatient).where(ORMPatient.name == patient_name and
-                                            ORMPatient.date_of_birth == date_of_birth)
+            stmt = select(*columns).where(ORMPatient.name == patient_name)
+        if date_of_birth is not None:
+            stmt = stmt.where(ORMPatient.date_of_birth == date_of_birth)
+        if limit is not None and match != NameMatch.FUZZY.value:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    def findPatient(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                    limit: Optional[int] = None) -> List[Patient]:
+        stmt = self._find_patient_stmt(patient_name, date_of_birth, match, limit=limit)
         with Session(self.engine) as session:
-            return [patient for patient in session.scalars(stmt)]
+            patients = [patient for patient in session.scalars(stmt)]
+        if match == NameMatch.FUZZY.value:
+            patients = rank_by_similarity(patient_name, [(patient.name_normalised, patient) for patient in patients])
+        return patients[:limit] if limit is not None else patients
+
+    def iter_patients(self, patient_name: str, date_of_birth: Optional[date],
+                      match: str = NameMatch.EXACT.value) -> Iterator[Patient]:
+        if match == NameMatch.FUZZY.value:
+            # Results have to be ranked before any can be returned
+            return iter(self.findPatient(patient_name, date_of_birth, match))
+        return self._iter_rows(self._find_patient_stmt(patient_name, date_of_birth, match))
+
+    def find_patient_rows(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                          limit: Optional[int] = None) -> List[PatientRow]:
+        if match != NameMatch.FUZZY.value:
+            return self._fetch_core_rows(
+                self._find_patient_stmt(patient_name, date_of_birth, match, PATIENT_ROW_COLUMNS, limit))
+        # The normalised name is read as well to rank the matches
+        rows = self._fetch_core_rows(self._find_patient_stmt(
+            patient_name, date_of_birth, match, PATIENT_ROW_COLUMNS + (ORMPatient.name_normalised,)))
+        patients = rank_by_similarity(patient_name, [(row[-1], tuple(row[:-1])) for row in rows])
+        return patients[:limit] if limit is not None else patients
+
+    def iter_patient_rows(self, patient_name: str, date_of_birth: Optional[date],
+                          match: str = NameMatch.EXACT.value) -> Iterator[PatientRow]:
+        if match == NameMatch.FUZZY.value:
+            return iter(self.find_patient_rows(patient_name, date_of_birth, match))
+        return self._iter_core_rows(self._find_patient_stmt(patient_name, date_of_birth, match, PATIENT_ROW_COLUMNS))
 
     def delete_patient(self, patient_id: str) -> str:
-        stmt = select(ORMPatient).where(ORMPatient.nhs_num == patient_id)
         with Session(self.engine) as session:
-            patient = session.scalar(stmt)
-            if patient is None:
+            if self._delete_patient_rows(session, [patient_id]) == 0:
                 raise PatientNotFoundException(patient_id)
-            session.delete(patient)
             session.commit()
         return patient_id
 
+    def delete_patients(self, patient_ids: List[str]) -> List[str]:
+        with Session(self.engine) as session:
+            existing = self._existing_keys(session, ORMPatient.nhs_num, patient_ids)
+            # Keeps the request order and drops repeats
+            deleted = [patient_id for patient_id in dict.fromkeys(patient_ids) if patient_id in existing]
+            for idx in range(0, len(deleted), MAX_IN_PARAMS):
+                self._delete_patient_rows(session, deleted[idx:idx + MAX_IN_PARAMS])
+            session.commit()
+        return deleted
+
+    @staticmethod
+    def _delete_patient_rows(session: Session, patient_ids: List[str]) -> int:
+        """
+        Delete patients and everything which refers to them with set-based DELETEs, nothing is loaded into the session
+        Dependent rows go first so the foreign keys hold throughout
+        :param patient_ids: At most MAX_IN_PARAMS NHS Numbers
+        :return: Number of patients deleted
+        """
+        session.execute(delete(ORMAppointment).where(ORMAppointment.patient_id.in_(patient_ids)))
+        session.execute(delete(ORMPatientNameTrigram).where(ORMPatientNameTrigram.nhs_num.in_(patient_ids)))
+        return session.execute(delete(ORMPatient).where(ORMPatient.nhs_num.in_(patient_ids))).rowcount
+
+    @staticmethod
+    def _existing_keys(session: Session, column: Column, keys: List[str]) -> Set[str]:
+        """
+        Find which of keys are already present in column, querying in chunks of MAX_IN_PARAMS
+        """
+        existing = set()
+        for idx in range(0, len(keys), MAX_IN_PARAMS):
+            existing.update(session.scalars(select(column).where(column.in_(keys[idx:idx + MAX_IN_PARAMS]))))
+        return existing
+
+    @staticmethod
+    def _insert_name_trigrams(session: Session, patient_id: str, patient_name: str) -> None:
+        # A name of only punctuation has no trigrams, and an INSERT of no rows would be sent as DEFAULT VALUES
+        rows = name_trigram_rows(patient_id, patient_name)
+        if rows:
+            session.execute(insert(ORMPatientNameTrigram), rows)
+
+    @staticmethod
+    def _name_trigram_inserts(rows: List[dict]) -> Tuple[type, List[dict]]:
+        return ORMPatientNameTrigram, [trigram_row for row in rows
+                                       for trigram_row in name_trigram_rows(row["nhs_num"], row["name"])]
+
+    @staticmethod
+    def _bulk_insert(session: Session, entity: type, rows: List[dict], key: str,
+                     dependents: Optional[Callable[[List[dict]], Tuple[type, List[dict]]]] = None) -> List[str]:
+        """
+        Insert rows in one transaction with a single executemany
+        If another writer inserted a conflicting row in the meantime fall back to row by row inserts
+        The executemany is in a savepoint, so when it fails only it is rolled back, the transaction, and any locks
+        the caller took in it, e.g. with _lock_clinicians, are kept for the fallback
+        An executemany rather than chunks of insert().values([...]): the statement is compiled once, sqlite3 runs
+        it in process with no round trip per row, and SQLAlchemy already sends it to PostgreSQL as batches of
+        multi-row VALUES (insertmanyvalues). Chunked multi-row VALUES compiles a statement per chunk, it was about
+        7 times slower for 50k patients on SQLite
+        :param dependents: Gives the entity and rows of another table which are inserted along with rows
+        :return: Primary keys of the inserted rows
+        """
+        def insert_rows(batch: List[dict]) -> None:
+            session.execute(insert(entity), batch)
+            if dependents is not None:
+                dependent_entity, dependent_rows = dependents(batch)
+                if dependent_rows:
+                    session.execute(insert(dependent_entity), dependent_rows)
+
+        if not rows:
+            return []
+        try:
+            with session.begin_nested():
+                insert_rows(rows)
+            inserted = [row[key] for row in rows]
+        except IntegrityError:
+            inserted = []
+            for row in rows:
+                try:
+                    with session.begin_nested():
+                        insert_rows([row])
+                    inserted.append(row[key])
+                except IntegrityError:
+                    pass
+        session.commit()
+        return inserted
+
     def is_db_empty(self) -> bool:
         with Session(self.engine) as session:
             return session.query(ORMAppointment).count() == 0 and session.query(ORMPatient).count() == 0
@@ -0,0 +1,231 @@
+from bisect import bisect_left
+from bisect import insort
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+import pytz
+
+from datastore import Appointment
+from utils import Status
+
+utc = pytz.UTC
+
+
+"""
+Clinician schedules for double-booking checks
+
+ClinicianSchedule is a sorted-interval index of one clinician's active appointments.
+Intervals are kept sorted by start time, together with the longest duration in the
+index. Any appointment overlapping [start, end) must start after start minus that
+duration and before end, so an overlap check is two binary searches plus a look at
+the few appointments in between, rather than a scan of the whole schedule.
+
+The DataStores check for double-booking themselves, in the same transaction, or
+under the same lock, as the write, so that two requests can't both book the same
+time between the check and the write.
+"""
+
+
+def as_utc(time: datetime) -> datetime:
+    """
+    Times read back from some databases have lost their timezone, all stored times are UTC
+    """
+    return time.replace(tzinfo=utc) if time.tzinfo is None else time
+
+
+def naive_utc(time: datetime) -> datetime:
+    """
+    The inverse of as_utc, time in UTC without a timezone, as the databases store it
+    """
+    return time.astimezone(utc).replace(tzinfo=None) if time.tzinfo is not None else time
+
+
+def appointment_end(appointment: Appointment) -> datetime:
+    return as_utc(appointment.time) + timedelta(minutes=appointment.duration_mins)
+
+
+def overlaps(appointment: Appointment, start: datetime, end: datetime) -> bool:
+    """
+    :return: True if appointment overlaps [start, end), appointments which only touch don't overlap
+    """
+    return as_utc(appointment.time) < end and appointment_end(appointment) > start
+
+
+def blocks_time(appointment: Appointment) -> bool:
+    """
+    :return: True if the appointment occupies its clinician's time
+    """
+    return appointment.status == Status.ACTIVE.value
+
+
+def utc_days(start: datetime, end: datetime) -> Iterator[date]:
+    """
+    :return: The UTC days which overlap [start, end)
+    """
+    day = as_utc(start).astimezone(utc).date()
+    last = (as_utc(end).astimezone(utc) - timedelta(microseconds=1)).date()
+    while day <= last:
+        yield day
+        day += timedelta(days=1)
+
+
+def free_slots(booked: Iterable[Appointment], start: datetime, end: datetime,
+               min_duration: timedelta) -> List[Tuple[datetime, datetime]]:
+    """
+    Find the gaps between a clinician's appointments
+    :param booked: The clinician's active appointments overlapping [start, end), in any order, may repeat
+    :param start: Start of the search
+    :param end: End of the search
+    :param min_duration: Shortest gap to return
+    :return: (start, end) of each gap in [start, end) at least min_duration long, in time order
+    """
+    start = as_utc(start)
+    end = as_utc(end)
+    slots = []
+    free_from = start
+    for appointment in sorted(booked, key=lambda appt: as_utc(appt.time)):
+        gap_end = min(as_utc(appointment.time), end)
+        if gap_end - free_from >= min_duration:
+            slots.append((free_from, gap_end))
+        free_from = max(free_from, appointment_end(appointment))
+        if free_from >= end:
+            return slots
+    if end - free_from >= min_duration:
+        slots.append((free_from, end))
+    return slots
+
+
+class ClinicianSchedule:
+    """
+    Sorted-interval index of one clinician's active appointments
+    Not thread safe, callers hold their own lock
+    """
+    def __init__(self):
+        # (start, appointment id), sorted
+        self.starts: List[Tuple[datetime, str]] = []
+        self.ends: Dict[str, datetime] = {}
+        # Never reduced on removal, it only has to be at least the longest duration
+        self.max_duration = timedelta(0)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def add(self, appointment_id: str, start: datetime, end: datetime) -> None:
+        start = as_utc(start)
+        end = as_utc(end)
+        insort(self.starts, (start, appointment_id))
+        self.ends[appointment_id] = end
+        self.max_duration = max(self.max_duration, end - start)
+
+    def remove(self, appointment_id: str, start: datetime) -> None:
+        start = as_utc(start)
+        idx = bisect_left(self.starts, (start, appointment_id))
+        if idx < len(self.starts) and self.starts[idx] == (start, appointment_id):
+            del self.starts[idx]
+            del self.ends[appointment_id]
+
+    def overlapping(self, start: datetime, end: datetime, exclude_id: Optional[str] = None) -> List[str]:
+        """
+        :param start: Start of the interval
+        :param end: End of the interval
+        :param exclude_id: Appointment to leave out, e.g. the one being moved
+        :return: ids of the appointments which overlap [start, end), in start order
+        """
+        lo = bisect_left(self.starts, (start - self.max_duration,))
+        hi = bisect_left(self.starts, (end,))
+        return [appointment_id for _, appointment_id in self.starts[lo:hi]
+                if self.ends[appointment_id] > start and appointment_id != exclude_id]
+
+
+class ScheduleIndex:
+    """
+    A ClinicianSchedule per clinician
+    Not thread safe, callers hold their own lock
+    """
+    def __init__(self, appointments: Iterable[Appointment] = ()):
+        self.schedules: Dict[str, ClinicianSchedule] = {}
+        for appointment in appointments:
+            self.add(appointment)
+
+    def add(self, appointment: Appointment) -> None:
+        """
+        Add an appointment, ignored unless it is active
+        """
+        if blocks_time(appointment):
+            self.schedules.setdefault(appointment.clinician, ClinicianSchedule()).add(
+                appointment.id, appointment.time, appointment_end(appointment))
+
+    def remove(self, appointment: Appointment) -> None:
+        """
+        Remove an appointment, must be called with the appointment as it was added
+        """
+        schedule = self.schedules.get(appointment.clinician)
+        if schedule is None:
+            return
+        schedule.remove(appointment.id, appointment.time)
+        if not schedule:
+            del self.schedules[appointment.clinician]
+
+    def overlapping(self, clinician: str, start: datetime, end: datetime,
+                    exclude_id: Optional[str] = None) -> List[str]:
+        """
+        :return: ids of clinician's active appointments which overlap [start, end)
+        """
+        schedule = self.schedules.get(clinician)
+        if schedule is None:
+            return []
+        return schedule.overlapping(as_utc(start), as_utc(end), exclude_id)
+
+
+def moved_appointment(appointment: Appointment, appointment_time: Optional[datetime], duration_mins: Optional[int],
+                      clinician: Optional[str], status: Optional[str]) -> Optional[Appointment]:
+    """
+    :return: The appointment after an update, as a new Appointment, None if the update can't cause double-booking
+    """
+    if appointment_time is None and duration_mins is None and clinician is None:
+        return None
+    moved = Appointment(appointment.id, appointment.patient_id,
+                        status if status is not None else appointment.status,
+                        appointment_time if appointment_time is not None else appointment.time,
+                        duration_mins if duration_mins is not None else appointment.duration_mins,
+                        clinician if clinician is not None else appointment.clinician,
+                        appointment.department, appointment.postcode)
+    return moved if blocks_time(moved) else None
+
+
+def clinician_spans(appointments: Iterable[Appointment]) -> Dict[str, Tuple[datetime, datetime]]:
+    """
+    :return: For each clinician, the interval covering all of their appointments
+    """
+    spans: Dict[str, Tuple[datetime, datetime]] = {}
+    for appointment in appointments:
+        start, end = as_utc(appointment.time), appointment_end(appointment)
+        if appointment.clinician in spans:
+            span_start, span_end = spans[appointment.clinician]
+            start, end = min(start, span_start), max(end, span_end)
+        spans[appointment.clinician] = (start, end)
+    return spans
+
+
+def book_batch(appointments: Iterable[Appointment], schedules: ScheduleIndex) -> List[Appointment]:
+    """
+    Check a batch of new appointments for double-booking, in order
+    Each appointment which doesn't clash is added to schedules, so later appointments in the batch are checked
+    against it too
+    :param appointments: New appointments
+    :param schedules: Appointments already booked for the clinicians in the batch, across the batch's spans
+    :return: The appointments which don't clash, in order
+    """
+    booked: List[Appointment] = []
+    for appointment in appointments:
+        if not schedules.overlapping(appointment.clinician, appointment.time, appointment_end(appointment),
+                                     exclude_id=appointment.id):
+            schedules.add(appointment)
+            booked.append(appointment)
+    return booked
@@ -0,0 +1,141 @@
+import json
+from datetime import date
+from datetime import datetime
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+
+from connexion.jsonifier import Jsonifier
+
+try:
+    import orjson
+except ImportError:  # optional, responses are serialised with json without it
+    orjson = None
+
+
+"""
+JSON serialisation of API responses
+
+Responses built in full are serialised by connexion through ResponseJsonifier,
+streamed responses are serialised here with iter_json_array. Both use the
+selected JsonBackend: orjson when it is installed, otherwise the json module.
+Values are formatted the same way as connexion's encoder whichever backend is
+used, dates and datetimes are always formatted by json_default, so clients see
+identical values either way. The json backend escapes non-ASCII characters,
+orjson sends them as UTF-8.
+"""
+
+# Number of items serialised into each chunk of a streamed JSON array
+STREAM_CHUNK_ITEMS = 100
+
+
+def json_default(o: Any) -> Any:
+    """
+    Serialise values the json module doesn't handle, matching connexion's FlaskJSONEncoder
+    :param o: value to serialise
+    :return: JSON serialisable value
+    """
+    if isinstance(o, datetime):
+        if o.tzinfo:
+            return o.isoformat('T')
+        # No timezone present - assume UTC
+        return o.isoformat('T') + 'Z'
+    if isinstance(o, date):
+        return o.isoformat()
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+class JsonBackend:
+    """
+    Serialises with the json module, always available
+    """
+    name = 'json'
+
+    def dumps(self, data: Any, indent: bool = False, sort_keys: bool = False) -> str:
+        return json.dumps(data, default=json_default, indent=2 if indent else None, sort_keys=sort_keys)
+
+
+class OrjsonBackend(JsonBackend):
+    """
+    Serialises with orjson, which is several times quicker than json
+    """
+    name = 'orjson'
+
+    def dumps(self, data: Any, indent: bool = False, sort_keys: bool = False) -> str:
+        # Dates and datetimes are passed to json_default, orjson's own formats differ, e.g. naive datetimes have no Z
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, default=json_default, option=option).decode()
+
+
+# Installed backends by name, fastest first
+JSON_BACKENDS: Dict[str, JsonBackend] = {backend.name: backend for backend in (
+    ([OrjsonBackend()] if orjson is not None else []) + [JsonBackend()])}
+
+_backend: JsonBackend = next(iter(JSON_BACKENDS.values()))
+
+
+def set_json_backend(name: Optional[str]) -> None:
+    """
+    Select the library responses are serialised with
+    :param name: 'orjson' or 'json', None for the fastest installed
+    """
+    global _backend
+    if name is None:
+        _backend = next(iter(JSON_BACKENDS.values()))
+        return
+    if name not in JSON_BACKENDS:
+        raise ValueError(f"JSON backend {name} is not installed, installed: {', '.join(JSON_BACKENDS)}")
+    _backend = JSON_BACKENDS[name]
+
+
+def get_json_backend() -> JsonBackend:
+    return _backend
+
+
+def dumps(data: Any) -> str:
+    return _backend.dumps(data)
+
+
+class ResponseJsonifier(Jsonifier):
+    """
+    connexion Jsonifier which serialises responses with the selected JsonBackend
+    Requests are still parsed by the json module
+    """
+    def __init__(self, indent: bool = False, sort_keys: bool = False):
+        """
+        :param indent: Indent by 2 spaces
+        :param sort_keys: Sort the keys of objects
+        """
+        super().__init__(json)
+        self.indent = indent
+        self.sort_keys = sort_keys
+
+    def dumps(self, data: Any, **kwargs) -> str:
+        return _backend.dumps(data, indent=self.indent, sort_keys=self.sort_keys) + '\n'
+
+
+def iter_json_array(items: Iterable[Any]) -> Iterator[str]:
+    """
+    Serialise items as a JSON array, a chunk at a time
+    Only STREAM_CHUNK_ITEMS items are held in memory at once
+    :param items: Iterable of JSON serialisable items
+    :return: Iterator of strings which together make up the JSON array
+    """
+    yield "["
+    chunk = []
+    separator = ""
+    for item in items:
+        chunk.append(dumps(item))
+        if len(chunk) == STREAM_CHUNK_ITEMS:
+            yield separator + ",".join(chunk)
+            separator = ","
+            chunk = []
+    if chunk:
+        yield separator + ",".join(chunk)
+    yield "]\n"
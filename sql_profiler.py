@@ -0,0 +1,258 @@
+import functools
+import inspect
+import logging
+import re
+import time
+from contextvars import ContextVar
+from functools import lru_cache
+from threading import Lock
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+from sqlalchemy import Engine
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+
+"""
+SQL statement profiler and slow query log
+
+SqlProfiler listens to a SQLAlchemy engine's cursor execute events and times every
+statement the DB runs. It keeps, for the most expensive normalised statements (literals
+and bound parameter lists collapsed, so the same query with different values is
+counted once), their calls and total, mean and max time. Statements slower than a
+threshold are logged with their parameters. Unlike echo=True, nothing is written
+for statements which are quick.
+
+Request handlers resolved through profiled() count the statements run while they are
+handling a request, per operation, which shows up handlers which make a query per
+item. Statements run after a handler returns, e.g. for a streamed response, aren't
+counted against the request.
+
+GET /admin/sql serves the report. As with the metrics, it is kept per process.
+"""
+
+# Statements taking at least this long are logged
+SLOW_QUERY_SECS = 0.1
+# Statements in the report, the ones with the greatest total time
+TOP_STATEMENTS = 20
+# Distinct normalised statements tracked, the one with the least total time is dropped to make room for a new one
+MAX_STATEMENTS = 500
+# Longest parameters logged for a slow statement, executemany parameters can be very long
+MAX_LOGGED_PARAMETERS = 500
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_REPEATED_GROUP = re.compile(r"(\([^()]*\))(?:\s*,\s*\1)+")
+
+
+@lru_cache(maxsize=1024)
+def normalise_statement(statement: str) -> str:
+    """
+    :return: statement with literals replaced by ?, lists of parameters, e.g. an IN list, shortened to (?, ...)
+    and repeated VALUES groups to one, on one line
+    """
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _STRING_LITERAL.sub("?", statement)
+    statement = _NUMBER_LITERAL.sub("?", statement)
+    statement = _PARAMETER_LIST.sub("(?, ...)", statement)
+    return _REPEATED_GROUP.sub(r"\1, ...", statement)
+
+
+def _format_parameters(parameters, executemany: bool) -> str:
+    text = f"{len(parameters)} sets, first {parameters[0]!r}" if executemany and parameters else repr(parameters)
+    return text if len(text) <= MAX_LOGGED_PARAMETERS else text[:MAX_LOGGED_PARAMETERS] + "..."
+
+
+class _StatementStats:
+    __slots__ = ('calls', 'total_secs', 'max_secs')
+
+    def __init__(self):
+        self.calls = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+
+
+class _OperationStats:
+    __slots__ = ('requests', 'statements', 'max_statements', 'total_secs')
+
+    def __init__(self):
+        self.requests = 0
+        self.statements = 0
+        self.max_statements = 0
+        self.total_secs = 0.0
+
+
+class _RequestStatements:
+    """
+    Statements run while handling one request
+    """
+    __slots__ = ('statements', 'total_secs')
+
+    def __init__(self):
+        self.statements = 0
+        self.total_secs = 0.0
+
+
+# Statements of the request being handled, see profiled
+_request_statements: ContextVar[Optional[_RequestStatements]] = ContextVar("_request_statements", default=None)
+
+
+class SqlProfiler:
+    """
+    Thread safe statement timings of the engines it is attached to
+    """
+    def __init__(self, slow_query_secs: float = SLOW_QUERY_SECS, top_n: int = TOP_STATEMENTS,
+                 max_statements: int = MAX_STATEMENTS):
+        """
+        :param slow_query_secs: Statements taking at least this long are logged
+        :param top_n: Statements in the report
+        :param max_statements: Distinct normalised statements tracked
+        """
+        self.slow_query_secs = slow_query_secs
+        self.top_n = top_n
+        self.max_statements = max_statements
+        self.lock = Lock()
+        self.statements: Dict[str, _StatementStats] = {}
+        self.operations: Dict[str, _OperationStats] = {}
+        self.slow_statements = 0
+
+    def attach(self, engine: Engine) -> None:
+        """
+        Time the statements run by engine, for an asyncio engine pass its sync_engine
+        """
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+        if context is not None:
+            context.panda_statement_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        start = getattr(context, 'panda_statement_start', None)
+        if start is not None:
+            self.record(statement, parameters, time.perf_counter() - start, executemany)
+
+    def record(self, statement: str, parameters, duration_secs: float, executemany: bool = False) -> None:
+        """
+        Record one run of a statement
+        :param statement: SQL as sent to the DB
+        :param parameters: Its parameters, only used if the statement is slow
+        :param duration_secs: How long it took
+        :param executemany: parameters is a sequence of parameter sets
+        """
+        normalised = normalise_statement(statement)
+        slow = duration_secs >= self.slow_query_secs
+        with self.lock:
+            stats = self.statements.get(normalised)
+            if stats is None:
+                if len(self.statements) >= self.max_statements:
+                    del self.statements[min(self.statements, key=lambda key: self.statements[key].total_secs)]
+                stats = self.statements[normalised] = _StatementStats()
+            stats.calls += 1
+            stats.total_secs += duration_secs
+            stats.max_secs = max(stats.max_secs, duration_secs)
+            if slow:
+                self.slow_statements += 1
+
+        request = _request_statements.get()
+        if request is not None:
+            request.statements += 1
+            request.total_secs += duration_secs
+        if slow:
+            logger.warning("Slow SQL statement, %.1fms: %s parameters: %s", duration_secs * 1000,
+                           _WHITESPACE.sub(" ", statement).strip(), _format_parameters(parameters, executemany))
+
+    def record_request(self, operation: str, request: _RequestStatements) -> None:
+        with self.lock:
+            stats = self.operations.get(operation)
+            if stats is None:
+                stats = self.operations[operation] = _OperationStats()
+            stats.requests += 1
+            stats.statements += request.statements
+            stats.max_statements = max(stats.max_statements, request.statements)
+            stats.total_secs += request.total_secs
+
+    def reset(self) -> None:
+        with self.lock:
+            self.statements.clear()
+            self.operations.clear()
+            self.slow_statements = 0
+
+    def report(self) -> dict:
+        """
+        :return: The top_n statements by total time and the statements run per request by each operation,
+        the operations running the most statements first
+        """
+        with self.lock:
+            top = sorted(self.statements.items(), key=lambda item: item[1].total_secs, reverse=True)[:self.top_n]
+            statements = [{"statement": statement,
+                           "calls": stats.calls,
+                           "total_ms": round(stats.total_secs * 1000, 3),
+                           "mean_ms": round(stats.total_secs * 1000 / stats.calls, 3),
+                           "max_ms": round(stats.max_secs * 1000, 3)}
+                          for statement, stats in top]
+            operations = [{"operation": operation,
+                           "requests": stats.requests,
+                           "statements": stats.statements,
+                           "mean_statements": round(stats.statements / stats.requests, 2),
+                           "max_statements": stats.max_statements,
+                           "total_ms": round(stats.total_secs * 1000, 3)}
+                          for operation, stats in self.operations.items()]
+            slow_statements = self.slow_statements
+        operations.sort(key=lambda op: (-op["statements"], op["operation"]))
+        return {"slow_query_ms": self.slow_query_secs * 1000, "slow_statements": slow_statements,
+                "statements": statements, "operations": operations}
+
+
+# Profiler used by the DataStores and request handlers
+SQL_PROFILER = SqlProfiler()
+
+
+def count_statements(profiler: SqlProfiler, operation: str, func: Callable) -> Callable:
+    """
+    Wrap a request handler, or async request handler, so that the statements run by each call are recorded
+    :param profiler: Where each request's statements are recorded
+    :param operation: Name they are recorded under
+    :param func: Handler to wrap
+    :return: The wrapped handler, with func's signature
+    """
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            request = _RequestStatements()
+            token = _request_statements.set(request)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _request_statements.reset(token)
+                profiler.record_request(operation, request)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        request = _RequestStatements()
+        token = _request_statements.set(request)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _request_statements.reset(token)
+            profiler.record_request(operation, request)
+    return wrapper
+
+
+def profiled(resolve: Callable[[str], Callable], profiler: SqlProfiler = SQL_PROFILER) -> Callable[[str], Callable]:
+    """
+    :param resolve: Resolves an operationId to its handler
+    :param profiler: Where each request's statements are recorded
+    :return: resolve, with each handler counting the statements run per request
+    """
+    def resolve_profiled(operation_id: str) -> Callable:
+        return count_statements(profiler, operation_id.rsplit('.', 1)[-1], resolve(operation_id))
+
+    return resolve_profiled
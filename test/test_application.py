@@ -1,24 +1,49 @@
+import os
+import tempfile
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 from datetime import date
 from datetime import datetime
 from typing import Optional
 from typing import List
 from unittest import TestCase
+from unittest import mock
 import pytz
 
 from dateutil.relativedelta import relativedelta
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import insert
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
 
+from application import MAX_BATCH_GET
+from application import NAME_SEARCH_LIMIT
 from application import PatientAppointmentsApp
+from application import appointment_to_dict
+from cache import CachingDatastore
 from datastore import DataStore
 from datastore import Patient
 from datastore import Appointment
+from datastore import AppointmentKey
+from exceptions import BatchTooLargeException
 from exceptions import TimeInThePastException
 from exceptions import NoResultsException
 from exceptions import InvalidStatusChangeException
 from exceptions import TimeInTheFutureException
 from exceptions import PatientNotFoundException
+from exceptions import ClinicianUnavailableException
+from exceptions import ConcurrentUpdateException
+from exceptions import InvalidTimeRangeException
+from exceptions import TimeRangeTooLongException
+from memory_datastore import MemoryDatastore
+from orm import AlchemyDatastore
+from orm import ORMAppointment
 from utils import Duration
+from utils import NameMatch
 from utils import Status
 
 utc = pytz.UTC
@@ -33,28 +58,48 @@ class MockDataStore(DataStore):
         self.cancelled_appointment.status = Status.CANCELLED.value
         self.one_patient = Patient("2179136439", "Francis Stewart",
                                    (datetime.now() - relativedelta(years=1)).date(), "LA10 3TZ")
+        # Returned by get_overlapping_appointments
+        self.booked: List[Appointment] = []
+        self.status_updates = []
 
     def create_appointment(self, patient: str, appointment_time: datetime, duration_mins: int, clinician: str,
                            department: str, postcode: str, appointment_id: Optional[str] = None) -> str:
         return str(uuid.uuid4())
 
+    def create_appointments(self, appointments: List[Appointment]) -> List[str]:
+        for appointment in appointments:
+            if appointment.id is None:
+                appointment.id = str(uuid.uuid4())
+        return [appointment.id for appointment in appointments if appointment.id != self.one_appointment.id]
+
     def get_appointment(self, appointment_id: str) -> Appointment:
         return self.one_appointment
 
-    def get_appointments(self, patient_id: str) -> List[Appointment]:
+    def get_appointments(self, patient_id: str, limit: Optional[int] = None,
+                         after: Optional[AppointmentKey] = None) -> List[Appointment]:
         return [self.one_appointment]
 
     def get_clinician_appointments(self, clinician: str) -> List[Appointment]:
         pass
 
+    def get_overlapping_appointments(self, clinician: str, start: datetime, end: datetime) -> List[Appointment]:
+        return self.booked
+
     def update_appointment(self, appointment_id: str, appointment_time: Optional[datetime] = None,
                            duration_mins: Optional[int] = None, clinician: Optional[str] = None,
                            status: Optional[str] = None) -> str:
         return "a1504ef1-dcdf-44ba-950c-debb711f8175"
 
+    def update_appointment_status(self, appointment_id: str, status: str) -> str:
+        self.status_updates.append((appointment_id, status))
+        return appointment_id
+
     def create_patient(self, patient: str, date_of_birth: date, patient_name: str, postcode: str) -> str:
         return patient
 
+    def create_patients(self, patients: List[Patient]) -> List[str]:
+        return [patient.nhs_num for patient in patients if patient.nhs_num != self.one_patient.nhs_num]
+
     def update_patient(self, patient: str, date_of_birth: Optional[date] = None, patient_name: Optional[str] = None,
                        postcode: Optional[str] = None) -> str:
         return patient
@@ -62,12 +107,17 @@ class MockDataStore(DataStore):
     def get_patient(self, patient_id) -> Patient:
         return self.one_patient
 
-    def findPatient(self, patient_name: str, date_of_birth: Optional[date]) -> List[Patient]:
+    def findPatient(self, patient_name: str, date_of_birth: Optional[date], match: str = NameMatch.EXACT.value,
+                    limit: Optional[int] = None) -> List[Patient]:
+        self.find_args = (match, limit)
         return [self.one_patient]
 
     def delete_patient(self, patient_id: str) -> str:
         return patient_id
 
+    def delete_patients(self, patient_ids: List[str]) -> List[str]:
+        return [patient_id for patient_id in dict.fromkeys(patient_ids) if patient_id != self.one_patient.nhs_num]
+
     def is_db_empty(self) -> bool:
         return False
 
@@ -89,6 +139,21 @@ class TestPatientAppointmentsApp(TestCase):
             self.patient_app.create_appointment("2179136439", test_date_time_past, Duration.MINS_90,
                                                 "Francis Stewart", "gastroentology", "LA10 3TZ")
 
+    def test_create_appointments(self):
+        now = datetime.now().replace(tzinfo=utc)
+        future = now + relativedelta(years=1)
+        appointments = [Appointment(None, "2179136439", Status.ACTIVE.value, future, 90,
+                                    "Francis Stewart", "gastroentology", "LA10 3TZ"),
+                        Appointment(None, "2179136439", Status.ACTIVE.value, now - relativedelta(years=1), 90,
+                                    "Francis Stewart", "gastroentology", "LA10 3TZ"),
+                        Appointment(self.data_store.one_appointment.id, "2179136439", Status.ACTIVE.value, future, 90,
+                                    "Joseph Savage", "gastroentology", "LA10 3TZ")]
+        errors = self.patient_app.create_appointments(appointments)
+        self.assertIsNone(errors[0])
+        self.assertTrue(isinstance(appointments[0].id, str))
+        self.assertIn("in the past", errors[1])
+        self.assertIn("already exists", errors[2])
+
     def test_get_appointment(self):
         result = self.patient_app.get_appointment("a1504ef1-dcdf-44ba-950c-debb711f8175")
         self.assertTrue(result == {'clinician': 'Francis Stewart',
@@ -103,13 +168,46 @@ class TestPatientAppointmentsApp(TestCase):
         with self.assertRaises(NoResultsException):
             self.patient_app.get_appointment("a1504ef1-dcdf-44ba-950c-debb711f8175")
 
+    def test_get_patient_appointments(self):
+        # Rows from the DataStore's list methods give the same dicts as the entities
+        expected = appointment_to_dict(self.data_store.one_appointment)
+        self.assertEqual(self.patient_app.get_patient_appointments("2179136439"), [expected])
+        self.assertEqual(self.patient_app.get_patient_appointments_page("2179136439", 1), ([expected], None))
+        self.assertEqual(self.patient_app.find_patient("Francis Stewart", None)[0]["patient"], "2179136439")
+
     def test_update_appointment(self):
         result = self.patient_app.update_appointment("a1504ef1-dcdf-44ba-950c-debb711f8175",
                                                      status=Status.ATTENDED.value)
         self.assertTrue(result["appointment_id"] == "a1504ef1-dcdf-44ba-950c-debb711f8175")
-        self.data_store.one_appointment = self.data_store.cancelled_appointment
-        with self.assertRaises(InvalidStatusChangeException):
-            self.patient_app.update_appointment("a1504ef1-dcdf-44ba-950c-debb711f8175", status=Status.ACTIVE.value)
+        # A status change on its own is left to the DataStore's conditional update
+        self.assertEqual(self.data_store.status_updates,
+                         [("a1504ef1-dcdf-44ba-950c-debb711f8175", Status.ATTENDED.value)])
+
+    def test_clinician_free_slots(self):
+        start = datetime(2030, 1, 1, 9, tzinfo=utc)
+        booked = copy(self.data_store.one_appointment)
+        booked.time = start + relativedelta(minutes=45)
+        self.data_store.booked = [booked]
+        slots = self.patient_app.get_clinician_free_slots("Francis Stewart", start, start + relativedelta(hours=3))
+        naive_start = start.replace(tzinfo=None)
+        self.assertEqual([(slot["start"], slot["end"]) for slot in slots],
+                         [(naive_start, naive_start + relativedelta(minutes=45)),
+                          (naive_start + relativedelta(minutes=135), naive_start + relativedelta(hours=3))])
+        self.assertEqual(slots[0]["durations"], ["15m", "30m"])
+        self.assertEqual(slots[1]["durations"], ["15m", "30m"])
+        self.assertEqual(self.patient_app.get_clinician_free_slots("Francis Stewart", start, start + relativedelta(
+            hours=3), duration=Duration.MINS_60), [])
+
+        with self.assertRaises(InvalidTimeRangeException):
+            self.patient_app.get_clinician_free_slots("Francis Stewart", start, start)
+        with self.assertRaises(TimeRangeTooLongException):
+            self.patient_app.get_clinician_free_slots("Francis Stewart", start, start + relativedelta(days=32))
+
+    def test_find_patient(self):
+        self.assertEqual(len(self.patient_app.find_patient("Chloe Cooney", None)), 1)
+        self.assertEqual(self.data_store.find_args, (NameMatch.EXACT.value, None))
+        self.patient_app.find_patient("chlo", None, NameMatch.PREFIX)
+        self.assertEqual(self.data_store.find_args, (NameMatch.PREFIX.value, NAME_SEARCH_LIMIT))
 
     def test_create_patient(self):
         now = datetime.now()
@@ -120,6 +218,26 @@ class TestPatientAppointmentsApp(TestCase):
         with self.assertRaises(TimeInTheFutureException):
             self.patient_app.create_patient("2179136439", test_date_time_future.date(), "Chloe Cooney", "LS1 5XT")
 
+    def test_create_patients(self):
+        past = (datetime.now() - relativedelta(years=1)).date()
+        future = (datetime.now() + relativedelta(years=1)).date()
+        errors = self.patient_app.create_patients([Patient("3315040893", "Chloe Cooney", past, "LS1 5XT"),
+                                                   Patient("2119596395", "Chloe Cooney", future, "LS1 5XT"),
+                                                   Patient("2179136439", "Chloe Cooney", past, "LS1 5XT"),
+                                                   Patient("3315040893", "Chloe Cooney", past, "LS1 5XT")])
+        self.assertIsNone(errors[0])
+        self.assertIn("in the future", errors[1])
+        # Existing patient, and a repeat of a patient earlier in the batch
+        self.assertIn("already exists", errors[2])
+        self.assertIn("already exists", errors[3])
+
+    def test_delete_patients(self):
+        errors = self.patient_app.delete_patients(["3315040893", self.data_store.one_patient.nhs_num, "3315040893"])
+        self.assertIsNone(errors[0])
+        # Unknown patient, and a repeat of a patient earlier in the batch
+        self.assertIn("Could not find patient", errors[1])
+        self.assertIn("Could not find patient", errors[2])
+
     def test_get_patient(self):
         result = self.patient_app.get_patient("2179136439")
         self.assertEqual(result, {'date_of_birth': self.data_store.one_patient.date_of_birth,
@@ -129,3 +247,224 @@ class TestPatientAppointmentsApp(TestCase):
         self.data_store.one_patient = None
         with self.assertRaises(PatientNotFoundException):
             self.patient_app.get_patient("2179136439")
+
+    def test_get_patients_by_id(self):
+        # MockDataStore only has patient 2179136439
+        result = self.patient_app.get_patients_by_id(["3315040893", "2179136439", "3315040893"])
+        self.assertEqual([patient["patient"] for patient in result["patients"]], ["2179136439"])
+        self.assertEqual(result["not_found"], ["3315040893"])
+        with self.assertRaises(BatchTooLargeException):
+            self.patient_app.get_patients_by_id([str(idx) for idx in range(MAX_BATCH_GET + 1)])
+
+    def test_get_patient_if_changed(self):
+        result, etag = self.patient_app.get_patient_if_changed("2179136439")
+        self.assertEqual(result["patient"], "2179136439")
+        # The body isn't built when the FE's copy is current
+        with mock.patch("application.patient_to_dict") as to_dict:
+            result, same_etag = self.patient_app.get_patient_if_changed("2179136439", if_none_match=etag)
+        to_dict.assert_not_called()
+        self.assertIsNone(result)
+        self.assertEqual(same_etag, etag)
+        # As a DataStore would on update_patient
+        self.data_store.one_patient.postcode = "LS1 5XT"
+        self.data_store.one_patient.version += 1
+        result, new_etag = self.patient_app.get_patient_if_changed("2179136439", if_none_match=etag)
+        self.assertEqual(result["postcode"], "LS1 5XT")
+        self.assertNotEqual(new_etag, etag)
+
+    def test_get_appointment_if_changed(self):
+        _, etag = self.patient_app.get_appointment_if_changed("a1504ef1-dcdf-44ba-950c-debb711f8175")
+        with mock.patch("application.appointment_to_dict") as to_dict:
+            result, _ = self.patient_app.get_appointment_if_changed("a1504ef1-dcdf-44ba-950c-debb711f8175",
+                                                                    if_none_match='W/' + etag)
+        to_dict.assert_not_called()
+        self.assertIsNone(result)
+        self.data_store.one_appointment = None
+        with self.assertRaises(NoResultsException):
+            self.patient_app.get_appointment_if_changed("a1504ef1-dcdf-44ba-950c-debb711f8175")
+
+
+def real_data_stores() -> List[DataStore]:
+    return [MemoryDatastore(), AlchemyDatastore("sqlite://"), CachingDatastore(MemoryDatastore()),
+            CachingDatastore(AlchemyDatastore("sqlite://"))]
+
+
+class TestRealDataStores(TestCase):
+    """
+    Checks which the DataStores make, over each of them, with and without the cache
+    """
+    def test_double_booking(self):
+        start = datetime.now().replace(tzinfo=utc) + relativedelta(years=1)
+        for data_store in real_data_stores():
+            with self.subTest(data_store=type(data_store).__name__):
+                patient_app = PatientAppointmentsApp(data_store)
+                booked = patient_app.create_appointment("2179136439", start, Duration.MINS_60, "Francis Stewart",
+                                                        "gastroentology", "LA10 3TZ")["appointment_id"]
+                with self.assertRaises(ClinicianUnavailableException):
+                    patient_app.create_appointment("2179136439", start + relativedelta(minutes=30), Duration.MINS_15,
+                                                   "Francis Stewart", "gastroentology", "LA10 3TZ")
+                moved = patient_app.create_appointment("2179136439", start + relativedelta(hours=1), Duration.MINS_15,
+                                                       "Francis Stewart", "gastroentology",
+                                                       "LA10 3TZ")["appointment_id"]
+                with self.assertRaises(ClinicianUnavailableException):
+                    patient_app.update_appointment(moved, appointment_time=start)
+                with self.assertRaises(ClinicianUnavailableException):
+                    patient_app.update_appointment(booked, duration=Duration.MINS_90)
+                # The status is checked before the clinician's diary
+                patient_app.update_appointment(moved, status=Status.CANCELLED.value)
+                with self.assertRaises(InvalidStatusChangeException):
+                    patient_app.update_appointment(moved, appointment_time=start, status=Status.ACTIVE.value)
+                # An appointment doesn't clash with itself, or with cancelled appointments
+                patient_app.update_appointment(booked, duration=Duration.MINS_90)
+
+    def test_create_appointments_double_booking(self):
+        future = datetime.now().replace(tzinfo=utc) + relativedelta(years=1)
+        for data_store in real_data_stores():
+            with self.subTest(data_store=type(data_store).__name__):
+                patient_app = PatientAppointmentsApp(data_store)
+                booked = patient_app.create_appointment("2179136439", future + relativedelta(hours=3),
+                                                        Duration.MINS_30, "Francis Stewart", "gastroentology",
+                                                        "LA10 3TZ")["appointment_id"]
+                appointments = [Appointment(None, "2179136439", Status.ACTIVE.value, future, 90,
+                                            "Francis Stewart", "gastroentology", "LA10 3TZ"),
+                                Appointment(None, "3315040893", Status.ACTIVE.value, future + relativedelta(minutes=60),
+                                            30, "Francis Stewart", "gastroentology", "LA10 3TZ"),
+                                Appointment(None, "3315040893", Status.ACTIVE.value, future + relativedelta(minutes=90),
+                                            30, "Francis Stewart", "gastroentology", "LA10 3TZ"),
+                                Appointment(None, "3315040893", Status.ACTIVE.value, future + relativedelta(hours=3),
+                                            30, "Francis Stewart", "gastroentology", "LA10 3TZ"),
+                                Appointment(booked, "3315040893", Status.ACTIVE.value, future + relativedelta(days=1),
+                                            30, "Francis Stewart", "gastroentology", "LA10 3TZ")]
+                errors = patient_app.create_appointments(appointments)
+                self.assertIsNone(errors[0])
+                # Clashes with an earlier appointment in the batch and one already booked name the appointment
+                self.assertTrue(errors[1].endswith(appointments[0].id))
+                self.assertIsNone(errors[2])
+                self.assertTrue(errors[3].endswith(booked))
+                self.assertIn("already exists", errors[4])
+
+    def test_concurrent_bookings(self):
+        # Each thread has its own connection to the database, as each gunicorn worker would
+        with tempfile.TemporaryDirectory() as db_dir:
+            db_url = f"sqlite:///{os.path.join(db_dir, 'PANDA.db')}"
+            AlchemyDatastore(db_url).dispose()
+            start = datetime.now().replace(tzinfo=utc) + relativedelta(years=1)
+            barrier = threading.Barrier(8)
+
+            def book(minutes: int) -> Optional[str]:
+                data_store = AlchemyDatastore(db_url)
+                barrier.wait()
+                try:
+                    return PatientAppointmentsApp(data_store).create_appointment(
+                        "2179136439", start + relativedelta(minutes=minutes), Duration.MINS_60, "Francis Stewart",
+                        "gastroentology", "LA10 3TZ")["appointment_id"]
+                except ClinicianUnavailableException:
+                    return None
+                finally:
+                    data_store.dispose()
+
+            with ThreadPoolExecutor(8) as executor:
+                booked = [appt_id for appt_id in executor.map(book, range(0, 40, 5)) if appt_id is not None]
+            self.assertEqual(len(booked), 1)
+
+    def test_etag_after_recreate(self):
+        appt_id = "a1504ef1-dcdf-44ba-950c-debb711f8175"
+        appt_time = datetime(2030, 6, 10, 9, tzinfo=utc)
+        for data_store in real_data_stores():
+            with self.subTest(data_store=type(data_store).__name__):
+                patient_app = PatientAppointmentsApp(data_store)
+                data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+                data_store.create_appointment("2179136439", appt_time, 30, "Francis Stewart", "gastroentology",
+                                              "LS1 5XT", appointment_id=appt_id)
+                _, patient_etag = patient_app.get_patient_if_changed("2179136439")
+                _, appt_etag = patient_app.get_appointment_if_changed(appt_id)
+
+                # Deleted and created again with new details, both start again at version 1
+                patient_app.delete_patient("2179136439")
+                data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Smith", "LS1 5XT")
+                data_store.create_appointment("2179136439", appt_time + relativedelta(hours=1), 30,
+                                              "Francis Stewart", "gastroentology", "LS1 5XT", appointment_id=appt_id)
+                result, _ = patient_app.get_patient_if_changed("2179136439", if_none_match=patient_etag)
+                self.assertEqual(result["name"], "Chloe Smith")
+                result, _ = patient_app.get_appointment_if_changed(appt_id, if_none_match=appt_etag)
+                self.assertEqual(result["time"], appt_time.replace(tzinfo=None) + relativedelta(hours=1))
+
+    def test_punctuation_names(self):
+        for data_store in real_data_stores():
+            with self.subTest(data_store=type(data_store).__name__):
+                patient_app = PatientAppointmentsApp(data_store)
+                # Names with no letters have no trigrams to index
+                self.assertEqual(patient_app.create_patient("2179136439", date(1990, 1, 1), "-", "LS1 5XT"),
+                                 {"patient_id": "2179136439"})
+                patient_app.update_patient("2179136439", patient_name=".")
+                self.assertEqual([p["patient"] for p in patient_app.find_patient(".", None)], ["2179136439"])
+                self.assertEqual(patient_app.find_patient("Chloe", None, NameMatch.FUZZY), [])
+                patient_app.update_patient("2179136439", patient_name="Chloe Cooney")
+                found = patient_app.find_patient("Cooney Cloe", None, NameMatch.FUZZY)
+                self.assertEqual([p["patient"] for p in found], ["2179136439"])
+
+    def test_create_appointments_fallback_keeps_lock(self):
+        with tempfile.TemporaryDirectory() as db_dir:
+            db_url = f"sqlite:///{os.path.join(db_dir, 'PANDA.db')}"
+            data_store = AlchemyDatastore(db_url)
+            other_writer = create_engine(db_url, connect_args={"timeout": 0.1})
+            start = datetime(2030, 6, 10, 9, tzinfo=utc)
+            taken_id = data_store.create_appointment("2179136439", start, 30, "Jane Doe", "gastroentology",
+                                                     "LS1 5XT")
+            appointments = [Appointment(taken_id, "2179136439", Status.ACTIVE.value, start, 30, "Francis Stewart",
+                                        "gastroentology", "LS1 5XT"),
+                            Appointment(None, "3315040893", Status.ACTIVE.value, start + relativedelta(hours=1), 60,
+                                        "Francis Stewart", "gastroentology", "LS1 5XT")]
+            appointment_inserts = []
+
+            @event.listens_for(data_store.engine, "before_cursor_execute")
+            def book_in_between(conn, cursor, statement, parameters, context, executemany):
+                if not statement.startswith("INSERT INTO appointment"):
+                    return
+                appointment_inserts.append(statement)
+                if len(appointment_inserts) != 2:
+                    return
+                # The executemany failed and the fallback is inserting row by row, another writer tries to book
+                # the clinician at the same time as the batch's second appointment
+                try:
+                    with other_writer.connect() as connection:
+                        connection.exec_driver_sql("BEGIN IMMEDIATE")
+                        connection.execute(insert(ORMAppointment).values(
+                            id=str(uuid.uuid4()), patient_id="3315040893", status=Status.ACTIVE.value,
+                            time=start + relativedelta(hours=1), duration_mins=30, clinician="Francis Stewart",
+                            department="gastroentology", postcode="LS1 5XT", version=1))
+                        connection.commit()
+                except OperationalError:
+                    # Still locked by the batch
+                    pass
+
+            # The id is taken after the batch checked for it, so the executemany fails
+            with mock.patch.object(AlchemyDatastore, "_existing_keys", staticmethod(lambda *args: set())):
+                created = data_store.create_appointments(appointments)
+            self.assertEqual(len(appointment_inserts), 3)
+            self.assertEqual(created, [appointments[1].id])
+            booked = data_store.get_overlapping_appointments("Francis Stewart", start + relativedelta(hours=1),
+                                                             start + relativedelta(hours=2))
+            self.assertEqual([appt.id for appt in booked], created)
+            other_writer.dispose()
+            data_store.dispose()
+
+    def test_concurrent_update(self):
+        data_store = AlchemyDatastore("sqlite://")
+        appt_id = data_store.create_appointment("2179136439", datetime(2030, 6, 10, 9, tzinfo=utc), 30,
+                                                "Francis Stewart", "gastroentology", "LS1 5XT")
+        patient_app = PatientAppointmentsApp(data_store)
+
+        @event.listens_for(Session, "before_flush", once=True)
+        def update_in_between(session, flush_context, instances):
+            # Another writer changes the appointment after it was read, before this update is written
+            session.connection().execute(update(ORMAppointment.__table__).where(ORMAppointment.id == appt_id)
+                                         .values(version=ORMAppointment.version + 1))
+
+        with self.assertRaises(ConcurrentUpdateException):
+            patient_app.update_appointment(appt_id, duration=Duration.MINS_60)
+        self.assertEqual(data_store.get_appointment(appt_id).duration_mins, 30)
+        # Retried once the other writer is done
+        patient_app.update_appointment(appt_id, duration=Duration.MINS_60)
+        self.assertEqual(data_store.get_appointment(appt_id).duration_mins, 60)
+        data_store.dispose()
@@ -0,0 +1,248 @@
+from datetime import date
+from datetime import datetime
+from unittest import IsolatedAsyncioTestCase
+from unittest import mock
+import pytz
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+from dateutil.relativedelta import relativedelta
+
+from async_main import create_app
+from async_orm import AsyncAlchemyDatastore
+from datastore import Appointment
+from datastore import Patient
+from datastore import appointment_row
+from datastore import patient_row
+from exceptions import AppointmentNotFoundException
+from exceptions import InvalidStatusChangeException
+from exceptions import PatientAlreadyExistsException
+from exceptions import PatientNotFoundException
+from migrations import LATEST_VERSION
+from utils import NameMatch
+from utils import Status
+
+utc = pytz.UTC
+
+
+class TestAsyncAlchemyDatastore(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.data_store = AsyncAlchemyDatastore("sqlite+aiosqlite://")
+        self.assertEqual(await self.data_store.initialise(), LATEST_VERSION)
+
+    async def asyncTearDown(self) -> None:
+        await self.data_store.dispose()
+
+    async def test_patients(self):
+        self.assertTrue(await self.data_store.is_db_empty())
+        await self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        with self.assertRaises(PatientAlreadyExistsException):
+            await self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        created = await self.data_store.create_patients([Patient("3315040893", "Chloe Cooney", date(1991, 1, 1),
+                                                                 "LS1 5XT")])
+        self.assertEqual(created, ["3315040893"])
+
+        await self.data_store.update_patient("2179136439", postcode="LA10 3TZ")
+        patient = await self.data_store.get_patient("2179136439")
+        self.assertEqual((patient.postcode, patient.version), ("LA10 3TZ", 2))
+        self.assertEqual(len(await self.data_store.findPatient("Chloe Cooney", None)), 2)
+
+        await self.data_store.delete_patient("3315040893")
+        self.assertIsNone(await self.data_store.get_patient("3315040893"))
+
+    async def test_name_search(self):
+        await self.data_store.create_patients([Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                                               Patient("3315040893", "Chloé O'Brien", date(1980, 1, 1), "S1 3QX")])
+        await self.data_store.create_patient("1953262716", date(1980, 1, 1), "Joseph Savage", "S1 3QX")
+        # Name and date of birth are both applied
+        self.assertEqual(await self.data_store.findPatient("Chloe Cooney", date(1980, 1, 1)), [])
+        found = await self.data_store.findPatient("CHLO", None, match=NameMatch.PREFIX.value)
+        self.assertEqual([p.nhs_num for p in found], ["2179136439", "3315040893"])
+        found = await self.data_store.findPatient("chlo", date(1980, 1, 1), match=NameMatch.PREFIX.value)
+        self.assertEqual([p.nhs_num for p in found], ["3315040893"])
+        found = await self.data_store.findPatient("Cooney Cloe", None, match=NameMatch.FUZZY.value)
+        self.assertEqual([p.nhs_num for p in found], ["2179136439"])
+        found = await self.data_store.findPatient("Josef Savag", date(1980, 1, 1), match=NameMatch.FUZZY.value)
+        self.assertEqual([p.nhs_num for p in found], ["1953262716"])
+
+        await self.data_store.update_patient("2179136439", patient_name="Zoe Smith")
+        self.assertEqual(await self.data_store.findPatient("Cooney", None, match=NameMatch.FUZZY.value), [])
+        await self.data_store.delete_patient("1953262716")
+        self.assertEqual(await self.data_store.findPatient("Joseph Savage", None, match=NameMatch.FUZZY.value), [])
+
+    async def test_appointments(self):
+        appt_time = datetime.now().replace(tzinfo=utc) + relativedelta(years=1)
+        appt_id = await self.data_store.create_appointment("2179136439", appt_time, 90, "Francis Stewart",
+                                                           "gastroentology", "LA10 3TZ")
+        await self.data_store.update_appointment(appt_id, status=Status.CANCELLED.value)
+        self.assertEqual((await self.data_store.get_appointment(appt_id)).status, Status.CANCELLED.value)
+        self.assertEqual([a.id for a in await self.data_store.get_clinician_appointments("Francis Stewart")],
+                         [appt_id])
+        self.assertEqual(await self.data_store.get_appointments("2179136439", limit=1, after=(appt_time, appt_id)),
+                         [])
+        self.assertEqual([a.id for a in await self.data_store.get_department_appointments(
+            "gastroentology", appt_time, appt_time + relativedelta(days=1), status=Status.CANCELLED.value)], [appt_id])
+        self.assertEqual(await self.data_store.get_department_appointments(
+            "gastroentology", appt_time, appt_time + relativedelta(days=1), status=Status.ACTIVE.value), [])
+
+    async def test_update_appointment_status(self):
+        appt_time = datetime(2030, 1, 1, 9, tzinfo=utc)
+        appt_id = await self.data_store.create_appointment("2179136439", appt_time, 90, "Francis Stewart",
+                                                           "gastroentology", "LA10 3TZ")
+        await self.data_store.update_appointment_status(appt_id, Status.MISSED.value)
+        await self.data_store.update_appointment_status(appt_id, Status.CANCELLED.value)
+        appt = await self.data_store.get_appointment(appt_id)
+        self.assertEqual((appt.status, appt.version), (Status.CANCELLED.value, 3))
+        with self.assertRaises(InvalidStatusChangeException):
+            await self.data_store.update_appointment_status(appt_id, Status.ACTIVE.value)
+        with self.assertRaises(InvalidStatusChangeException):
+            await self.data_store.update_appointment(appt_id, status=Status.ACTIVE.value)
+        with self.assertRaises(AppointmentNotFoundException):
+            await self.data_store.update_appointment_status("a1504ef1-dcdf-44ba-950c-debb711f8175",
+                                                            Status.MISSED.value)
+        self.assertEqual((await self.data_store.get_appointment(appt_id)).version, 3)
+
+    async def test_get_by_id(self):
+        await self.data_store.create_patients([Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                                               Patient("3315040893", "Chloe Smith", date(1980, 1, 1), "S1 3QX")])
+        appt_ids = await self.data_store.create_appointments([
+            Appointment(None, "2179136439", Status.ACTIVE.value, datetime(2030, 1, 1, 9 + hour, tzinfo=utc), 30,
+                        "Francis Stewart", "gastroentology", "LA10 3TZ") for hour in range(3)])
+        # Queried a chunk at a time
+        with mock.patch("orm.MAX_IN_PARAMS", 2):
+            found = await self.data_store.get_patients_by_id(["3315040893", "1953262716", "2179136439", "3315040893"])
+            self.assertEqual(sorted(patient.nhs_num for patient in found), ["2179136439", "3315040893"])
+            found = await self.data_store.get_appointments_by_id(appt_ids + ["a1504ef1-dcdf-44ba-950c-debb711f8175"])
+            self.assertEqual(sorted(appt.id for appt in found), sorted(appt_ids))
+
+    async def test_delete_patients(self):
+        appt_time = datetime(2030, 1, 1, 9, tzinfo=utc)
+        patient_ids = ["2179136439", "3315040893", "1953262716"]
+        await self.data_store.create_patients([Patient(patient_id, "Chloe Cooney", date(1990, 1, 1), "LS1 5XT")
+                                               for patient_id in patient_ids])
+        await self.data_store.create_appointments([
+            Appointment(None, patient_id, Status.ACTIVE.value, appt_time + relativedelta(hours=hour), 30,
+                        "Francis Stewart", "gastroentology", "LA10 3TZ")
+            for hour, patient_id in enumerate(patient_ids)])
+
+        await self.data_store.delete_patient("2179136439")
+        self.assertEqual(await self.data_store.get_appointments("2179136439"), [])
+        with self.assertRaises(PatientNotFoundException):
+            await self.data_store.delete_patient("2179136439")
+
+        # Deleted a chunk at a time, unknown and repeated NHS Numbers are skipped
+        with mock.patch("orm.MAX_IN_PARAMS", 1):
+            deleted = await self.data_store.delete_patients(["3315040893", "2179136439", "1953262716", "3315040893"])
+        self.assertEqual(deleted, ["3315040893", "1953262716"])
+        self.assertEqual(await self.data_store.findPatient("Cooney", None, match=NameMatch.FUZZY.value), [])
+        self.assertTrue(await self.data_store.is_db_empty())
+
+    async def test_rows(self):
+        appt_time = datetime(2030, 1, 1, 9, tzinfo=utc)
+        await self.data_store.create_appointments([
+            Appointment(None, "2179136439", Status.ACTIVE.value, appt_time + relativedelta(hours=hour), 30,
+                        "Francis Stewart", "gastroentology", "LA10 3TZ") for hour in range(3)])
+        await self.data_store.create_patients([Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                                               Patient("3315040893", "Chloé O'Brien", date(1980, 1, 1), "S1 3QX")])
+
+        # The rows have the same values as the entities
+        appointments = await self.data_store.get_appointments("2179136439", limit=2, after=None)
+        self.assertEqual([tuple(row) for row in await self.data_store.get_appointment_rows("2179136439", limit=2)],
+                         [appointment_row(appt) for appt in appointments])
+        after = (appointments[-1].time, appointments[-1].id)
+        self.assertEqual(len(await self.data_store.get_clinician_appointment_rows("Francis Stewart", after=after)), 1)
+        self.assertEqual(len(await self.data_store.get_department_appointment_rows(
+            "gastroentology", appt_time, appt_time + relativedelta(days=1), status=Status.ACTIVE.value)), 3)
+        for name, match in (("Chloe Cooney", NameMatch.EXACT), ("chlo", NameMatch.PREFIX),
+                            ("O'Brian Chloe", NameMatch.FUZZY)):
+            self.assertEqual([tuple(row) for row in await self.data_store.find_patient_rows(name, None, match.value)],
+                             [patient_row(patient) for patient in await self.data_store.findPatient(
+                                 name, None, match.value)])
+
+
+class TestAsyncApp(IsolatedAsyncioTestCase):
+    async def test_patient_requests(self):
+        async with TestClient(TestServer(create_app("sqlite+aiosqlite://"))) as client:
+            response = await client.post("/panda-api/patients", params={
+                "nhs_number": "2179136439", "date_of_birth": "1990-01-01", "name": "Chloe Cooney",
+                "postcode": "LS1 5XT"})
+            self.assertEqual(await response.json(), {"patient_id": "2179136439"})
+
+            response = await client.get("/panda-api/patients/2179136439")
+            self.assertEqual((await response.json())["name"], "Chloe Cooney")
+            response = await client.get("/panda-api/patients/2179136439",
+                                        headers={"If-None-Match": response.headers["ETag"]})
+            self.assertEqual(response.status, 304)
+
+            response = await client.get("/panda-api/patients/3315040893")
+            self.assertEqual(response.status, 400)
+
+    async def test_update_appointment_status(self):
+        async with TestClient(TestServer(create_app("sqlite+aiosqlite://"))) as client:
+            response = await client.post("/panda-api/appointments", params={
+                "patient": "2179136439", "time": "2030-06-10 09:00", "duration": "1h", "clinician": "Joseph Savage",
+                "department": "oncology", "postcode": "LS1 5XT"})
+            appt_id = (await response.json())["appointment_id"]
+
+            response = await client.put(f"/panda-api/appointments/{appt_id}", params={"status": "cancelled"})
+            self.assertEqual(await response.json(), {"appointment_id": appt_id})
+            response = await client.put(f"/panda-api/appointments/{appt_id}", params={"status": "active"})
+            self.assertEqual(response.status, 400)
+            self.assertIn("cannot be reinstated", await response.text())
+            response = await client.put("/panda-api/appointments/a1504ef1-dcdf-44ba-950c-debb711f8175",
+                                        params={"status": "missed"})
+            self.assertEqual(response.status, 400)
+            self.assertIn("a1504ef1-dcdf-44ba-950c-debb711f8175", await response.text())
+
+    async def test_batch_get(self):
+        async with TestClient(TestServer(create_app("sqlite+aiosqlite://"))) as client:
+            await client.post("/panda-api/patients", params={
+                "nhs_number": "2179136439", "date_of_birth": "1990-01-01", "name": "Chloe Cooney",
+                "postcode": "LS1 5XT"})
+            response = await client.post("/panda-api/appointments", params={
+                "patient": "2179136439", "time": "2030-06-10 09:00", "duration": "1h", "clinician": "Joseph Savage",
+                "department": "oncology", "postcode": "LS1 5XT"})
+            appt_id = (await response.json())["appointment_id"]
+
+            response = await client.post("/panda-api/patients:batchGet",
+                                         json={"nhs_numbers": ["3315040893", "2179136439"]})
+            result = await response.json()
+            self.assertEqual([patient["name"] for patient in result["patients"]], ["Chloe Cooney"])
+            self.assertEqual(result["not_found"], ["3315040893"])
+            response = await client.post("/panda-api/patients:batchGet", json={"nhs_numbers": ["1315040893"]})
+            self.assertEqual(response.status, 400)
+
+            response = await client.post("/panda-api/appointments:batchGet", json={"ids": [appt_id]})
+            self.assertEqual([appt["id"] for appt in (await response.json())["appointments"]], [appt_id])
+
+    async def test_bulk_delete_patients(self):
+        async with TestClient(TestServer(create_app("sqlite+aiosqlite://"))) as client:
+            response = await client.post("/panda-api/patients", params={
+                "nhs_number": "2179136439", "date_of_birth": "1990-01-01", "name": "Chloe Cooney",
+                "postcode": "LS1 5XT"})
+            self.assertEqual(response.status, 200)
+
+            response = await client.delete("/panda-api/patients", data='{"nhs_number": "2179136439"}\n'
+                                                                       '{"nhs_number": "3315040893"}\n'
+                                                                       '{"nhs_number": "123"}\n',
+                                           headers={"Content-Type": "application/x-ndjson"})
+            result = await response.json()
+            self.assertEqual(result["deleted"], 1)
+            self.assertEqual([error["line"] for error in result["errors"]], [2, 3])
+            response = await client.get("/panda-api/patients/2179136439")
+            self.assertEqual(response.status, 400)
+
+    async def test_free_slots(self):
+        async with TestClient(TestServer(create_app("sqlite+aiosqlite://"))) as client:
+            response = await client.post("/panda-api/appointments", params={
+                "patient": "2179136439", "time": "2030-06-10 09:00", "duration": "1h", "clinician": "Joseph Savage",
+                "department": "oncology", "postcode": "LS1 5XT"})
+            self.assertEqual(response.status, 200)
+            response = await client.post("/panda-api/appointments", params={
+                "patient": "3315040893", "time": "2030-06-10 09:30", "duration": "15m", "clinician": "Joseph Savage",
+                "department": "oncology", "postcode": "LS1 5XT"})
+            self.assertEqual(response.status, 400)
+
+            response = await client.get("/panda-api/appointments/clinician/Joseph Savage/free-slots", params={
+                "from": "2030-06-10 08:00", "to": "2030-06-10 12:00", "duration": "2h"})
+            self.assertEqual([slot["start"] for slot in await response.json()], ["2030-06-10T10:00:00Z"])
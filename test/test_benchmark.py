@@ -0,0 +1,66 @@
+import itertools
+import json
+import os
+import tempfile
+from collections import defaultdict
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import TestCase
+from unittest import mock
+
+from benchmark import suite
+from benchmark.data import iter_generated_appointments
+from benchmark.data import iter_generated_patients
+from benchmark.data import iter_nhs_nums
+from schedule import appointment_end
+from utils import validate_patient_ids
+from utils import validate_postcode
+
+
+class TestBenchmarkData(TestCase):
+    def test_nhs_nums(self):
+        nhs_nums = list(itertools.islice(iter_nhs_nums(chunk=1000), 20000))
+        self.assertEqual(len(set(nhs_nums)), len(nhs_nums))
+        self.assertTrue(validate_patient_ids(nhs_nums).all())
+        self.assertEqual(list(itertools.islice(iter_nhs_nums(), 20000)), nhs_nums)
+        self.assertNotEqual(list(itertools.islice(iter_nhs_nums(seed=2), 10)), nhs_nums[:10])
+
+    def test_patients_and_appointments(self):
+        patients = list(iter_generated_patients(1000, surnames=100))
+        self.assertEqual(len(patients), 1000)
+        self.assertTrue(all(validate_postcode(patient.postcode) for patient in patients))
+
+        patient_ids = [patient.nhs_num for patient in patients]
+        appointments = list(iter_generated_appointments(2000, patient_ids, clinicians=10))
+        self.assertEqual(len({appt.id for appt in appointments}), 2000)
+        self.assertTrue(all(appt.patient_id in patient_ids for appt in appointments))
+        diaries = defaultdict(list)
+        for appt in appointments:
+            diaries[appt.clinician].append(appt)
+        self.assertEqual(len(diaries), 10)
+        for diary in diaries.values():
+            self.assertEqual(len({appt.department for appt in diary}), 1)
+            for appt, next_appt in zip(diary, diary[1:]):
+                self.assertLessEqual(appointment_end(appt), next_appt.time)
+
+
+class TestBenchmarkSuite(TestCase):
+    @mock.patch.object(suite, "TARGET_RUN_SECS", 0.0001)
+    def test_suite(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            output = os.path.join(out_dir, "results.json")
+            with redirect_stdout(StringIO()):
+                self.assertEqual(suite.main(["--scale", "300", "--backend", "memory", "--output", output]), 0)
+            with open(output) as results_file:
+                results = json.load(results_file)["results"]
+            groups = {result["group"] for result in results}
+            self.assertEqual(groups, {"validators", "load", "datastore", "app"})
+            self.assertIn("delete_patient", {result["name"] for result in results if result["group"] == "app"})
+            self.assertTrue(all(result["secs_per_call"] > 0 for result in results))
+
+            # Ten times slower than the baseline in one benchmark
+            baseline = [dict(result) for result in results]
+            baseline[0]["secs_per_call"] /= 10
+            with redirect_stdout(StringIO()):
+                regressions = suite.compare(results, baseline)
+            self.assertEqual(regressions, [results[0]])
@@ -0,0 +1,162 @@
+from datetime import date
+from datetime import datetime
+from unittest import TestCase
+import pytz
+
+from dateutil.relativedelta import relativedelta
+
+from cache import CachingDatastore
+from cache import LRUCache
+from memory_datastore import MemoryDatastore
+from utils import Status
+
+utc = pytz.UTC
+
+
+class CountingDatastore(MemoryDatastore):
+    """
+    MemoryDatastore which counts lookups by id
+    """
+    def __init__(self):
+        super(CountingDatastore, self).__init__()
+        self.lookups = 0
+
+    def get_patient(self, patient_id: str):
+        self.lookups += 1
+        return super(CountingDatastore, self).get_patient(patient_id)
+
+    def get_appointment(self, appointment_id: str):
+        self.lookups += 1
+        return super(CountingDatastore, self).get_appointment(appointment_id)
+
+
+class TestLRUCache(TestCase):
+    def test_eviction(self):
+        cache = LRUCache(max_size=2, ttl_secs=60)
+        cache.get_or_load("a", lambda: 1)
+        cache.get_or_load("b", lambda: 2)
+        # "a" is now most recently used, so "b" is evicted
+        self.assertEqual(cache.get_or_load("a", lambda: -1), 1)
+        cache.get_or_load("c", lambda: 3)
+        self.assertEqual(cache.get_or_load("b", lambda: -2), -2)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (1, 4, 2))
+
+    def test_get_many(self):
+        cache = LRUCache(max_size=3, ttl_secs=60)
+        cache.get_or_load("a", lambda: 1)
+        loads = []
+
+        def loader(keys):
+            loads.append(keys)
+            return {key: key.upper() for key in keys}
+
+        # Hits are served from the cache, misses are loaded together and repeated keys only once
+        self.assertEqual(cache.get_many_or_load(["a", "b", "c", "b"], loader), {"a": 1, "b": "B", "c": "C"})
+        self.assertEqual(loads, [["b", "c"]])
+        self.assertEqual(cache.get_many_or_load(["c", "b"], loader), {"c": "C", "b": "B"})
+        self.assertEqual(len(loads), 1)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (3, 3))
+
+    def test_expiry(self):
+        cache = LRUCache(max_size=2, ttl_secs=0)
+        cache.get_or_load("a", lambda: 1)
+        self.assertEqual(cache.get_or_load("a", lambda: 2), 2)
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+
+class TestCachingDatastore(TestCase):
+    def setUp(self) -> None:
+        self.inner = CountingDatastore()
+        self.data_store = CachingDatastore(self.inner, max_size=100, ttl_secs=60)
+
+    def test_patient_cache(self):
+        self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        self.data_store.get_patient("2179136439")
+        self.assertEqual(self.data_store.get_patient("2179136439").name, "Chloe Cooney")
+        self.assertEqual(self.inner.lookups, 1)
+
+        self.data_store.update_patient("2179136439", patient_name="Chloe Smith")
+        self.assertEqual(self.data_store.get_patient("2179136439").name, "Chloe Smith")
+        self.assertEqual(self.inner.lookups, 2)
+
+        self.data_store.delete_patient("2179136439")
+        self.assertIsNone(self.data_store.get_patient("2179136439"))
+
+    def test_negative_cache(self):
+        self.assertIsNone(self.data_store.get_patient("3315040893"))
+        self.assertIsNone(self.data_store.get_patient("3315040893"))
+        self.assertEqual(self.inner.lookups, 1)
+        # Creating the patient replaces the cached miss
+        self.data_store.create_patient("3315040893", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        self.assertEqual(self.data_store.get_patient("3315040893").name, "Chloe Cooney")
+
+    def test_get_patients_by_id(self):
+        self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        self.data_store.get_patient("2179136439")
+        self.assertEqual(self.inner.lookups, 1)
+        found = self.data_store.get_patients_by_id(["2179136439", "3315040893"])
+        self.assertEqual([patient.nhs_num for patient in found], ["2179136439"])
+        # The miss is cached as not found too
+        self.assertIsNone(self.data_store.get_patient("3315040893"))
+        self.assertEqual(self.inner.lookups, 1)
+        self.assertEqual(self.data_store.cache_stats()["patients"]["hits"], 2)
+
+    def test_appointment_cache(self):
+        appt_time = datetime.now().replace(tzinfo=utc) + relativedelta(years=1)
+        appt_id = "a1504ef1-dcdf-44ba-950c-debb711f8175"
+        self.assertIsNone(self.data_store.get_appointment(appt_id))
+        self.data_store.create_appointment("2179136439", appt_time, 90, "Francis Stewart", "gastroentology",
+                                           "LA10 3TZ", appointment_id=appt_id)
+        self.assertEqual(self.data_store.get_appointment(appt_id).status, Status.ACTIVE.value)
+        self.data_store.update_appointment(appt_id, status=Status.CANCELLED.value)
+        self.assertEqual(self.data_store.get_appointment(appt_id).status, Status.CANCELLED.value)
+        self.data_store.get_appointment(appt_id)
+        # The update looks the appointment up too, to find the days it was booked on
+        self.assertEqual(self.inner.lookups, 4)
+        self.assertEqual(self.data_store.cache_stats()["appointments"]["hits"], 1)
+
+    def test_delete_patients(self):
+        appt_time = datetime(2030, 1, 1, 9, tzinfo=utc)
+        self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        appt_id = self.data_store.create_appointment("2179136439", appt_time, 60, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        self.assertIsNotNone(self.data_store.get_patient("2179136439"))
+        self.assertIsNotNone(self.data_store.get_appointment(appt_id))
+        self.assertEqual(len(self.data_store.get_clinician_day("Francis Stewart", appt_time.date())), 1)
+
+        # The patient's appointments aren't served from the cache once they have been deleted with the patient
+        self.assertEqual(self.data_store.delete_patients(["2179136439"]), ["2179136439"])
+        self.assertIsNone(self.data_store.get_patient("2179136439"))
+        self.assertIsNone(self.data_store.get_appointment(appt_id))
+        self.assertEqual(self.data_store.get_clinician_day("Francis Stewart", appt_time.date()), [])
+
+    def test_clinician_day_cache(self):
+        appt_time = datetime(2030, 1, 1, 9, tzinfo=utc)
+        day = appt_time.date()
+        self.assertEqual(self.data_store.get_clinician_day("Francis Stewart", day), [])
+        appt_id = self.data_store.create_appointment("2179136439", appt_time, 60, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        self.assertEqual([a.id for a in self.data_store.get_clinician_day("Francis Stewart", day)], [appt_id])
+        self.data_store.get_clinician_day("Francis Stewart", day)
+        self.assertEqual(self.data_store.cache_stats()["clinician_days"]["hits"], 1)
+
+        # Moving the appointment to another day invalidates both days
+        self.data_store.update_appointment(appt_id, appointment_time=appt_time + relativedelta(days=1))
+        self.assertEqual(self.data_store.get_clinician_day("Francis Stewart", day), [])
+        self.assertEqual([a.id for a in self.data_store.get_clinician_day("Francis Stewart",
+                                                                          day + relativedelta(days=1))], [appt_id])
+
+    def test_update_appointment_status(self):
+        appt_time = datetime(2030, 1, 1, 9, tzinfo=utc)
+        day = appt_time.date()
+        appt_id = self.data_store.create_appointment("2179136439", appt_time, 60, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        self.assertEqual(self.data_store.get_clinician_day("Francis Stewart", day)[0].status, Status.ACTIVE.value)
+        lookups = self.inner.lookups
+        # The update returns where the appointment is booked, so it isn't looked up to find the days to invalidate
+        self.assertEqual(self.data_store.update_appointment_status(appt_id, Status.CANCELLED.value), appt_id)
+        self.assertEqual(self.inner.lookups, lookups)
+        self.assertEqual(self.data_store.get_clinician_day("Francis Stewart", day), [])
+        self.assertEqual(self.data_store.get_appointment(appt_id).status, Status.CANCELLED.value)
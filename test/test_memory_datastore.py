@@ -0,0 +1,294 @@
+from datetime import date
+from datetime import datetime
+from unittest import TestCase
+import pytz
+
+from dateutil.relativedelta import relativedelta
+
+from datastore import Appointment
+from datastore import Patient
+from exceptions import AppointmentAlreadyExistsException
+from exceptions import AppointmentNotFoundException
+from exceptions import ClinicianUnavailableException
+from exceptions import InvalidStatusChangeException
+from exceptions import PatientAlreadyExistsException
+from exceptions import PatientNotFoundException
+from memory_datastore import MemoryDatastore
+from utils import NameMatch
+from utils import Status
+
+utc = pytz.UTC
+
+
+class TestMemoryDatastore(TestCase):
+    def setUp(self) -> None:
+        self.data_store = MemoryDatastore()
+        self.appt_time = datetime.now().replace(tzinfo=utc) + relativedelta(years=1)
+
+    def test_is_db_empty(self):
+        self.assertTrue(self.data_store.is_db_empty())
+        self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        self.assertFalse(self.data_store.is_db_empty())
+
+    def test_appointments(self):
+        appt_id = self.data_store.create_appointment("2179136439", self.appt_time, 90, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        appt = self.data_store.get_appointment(appt_id)
+        self.assertEqual(appt.status, Status.ACTIVE.value)
+        self.assertEqual(appt.duration_mins, 90)
+        self.assertIsNone(self.data_store.get_appointment("a1504ef1-dcdf-44ba-950c-debb711f8175"))
+        self.assertEqual([a.id for a in self.data_store.get_appointments("2179136439")], [appt_id])
+        self.assertEqual([a.id for a in self.data_store.get_clinician_appointments("Francis Stewart")], [appt_id])
+
+        with self.assertRaises(AppointmentAlreadyExistsException):
+            self.data_store.create_appointment("2179136439", self.appt_time, 90, "Francis Stewart",
+                                               "gastroentology", "LA10 3TZ", appointment_id=appt_id)
+
+        # Changing clinician moves the appointment between clinician index entries
+        self.data_store.update_appointment(appt_id, clinician="Joseph Savage", status=Status.CANCELLED.value)
+        self.assertEqual(self.data_store.get_clinician_appointments("Francis Stewart"), [])
+        appt = self.data_store.get_clinician_appointments("Joseph Savage")[0]
+        self.assertEqual(appt.status, Status.CANCELLED.value)
+
+        with self.assertRaises(AppointmentNotFoundException):
+            self.data_store.update_appointment("a1504ef1-dcdf-44ba-950c-debb711f8175", duration_mins=15)
+
+    def test_update_appointment_status(self):
+        appt_id = self.data_store.create_appointment("2179136439", self.appt_time, 90, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        self.data_store.update_appointment_status(appt_id, Status.CANCELLED.value)
+        appt = self.data_store.get_appointment(appt_id)
+        self.assertEqual((appt.status, appt.version), (Status.CANCELLED.value, 2))
+        # A cancelled appointment no longer blocks the clinician's time
+        self.assertEqual(self.data_store.get_overlapping_appointments(
+            "Francis Stewart", self.appt_time, self.appt_time + relativedelta(hours=1)), [])
+        with self.assertRaises(InvalidStatusChangeException):
+            self.data_store.update_appointment_status(appt_id, Status.ACTIVE.value)
+        with self.assertRaises(InvalidStatusChangeException):
+            self.data_store.update_appointment(appt_id, status=Status.ACTIVE.value)
+        with self.assertRaises(AppointmentNotFoundException):
+            self.data_store.update_appointment_status("a1504ef1-dcdf-44ba-950c-debb711f8175", Status.MISSED.value)
+
+    def test_create_appointments(self):
+        appt_id = self.data_store.create_appointment("2179136439", self.appt_time, 90, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        appointments = [Appointment(None, "2179136439", Status.MISSED.value, self.appt_time, 15,
+                                    "Joseph Savage", "oncology", "LA10 3TZ"),
+                        Appointment(appt_id, "2179136439", Status.ACTIVE.value, self.appt_time, 15,
+                                    "Joseph Savage", "oncology", "LA10 3TZ")]
+        created = self.data_store.create_appointments(appointments)
+        self.assertEqual(created, [appointments[0].id])
+        # Bulk created appointments are always active
+        self.assertEqual(self.data_store.get_appointment(created[0]).status, Status.ACTIVE.value)
+        self.assertEqual(len(self.data_store.get_appointments("2179136439")), 2)
+        self.assertEqual([a.id for a in self.data_store.get_clinician_appointments("Joseph Savage")], created)
+
+    def test_overlapping_appointments(self):
+        later = self.appt_time + relativedelta(minutes=90)
+        first = self.data_store.create_appointment("2179136439", self.appt_time, 90, "Francis Stewart",
+                                                   "gastroentology", "LA10 3TZ")
+        second = self.data_store.create_appointment("2179136439", later, 30, "Francis Stewart",
+                                                    "gastroentology", "LA10 3TZ")
+        overlapping = self.data_store.get_overlapping_appointments
+        self.assertEqual([a.id for a in overlapping("Francis Stewart", later, later + relativedelta(minutes=10))],
+                         [second])
+        self.assertEqual([a.id for a in overlapping("Francis Stewart", self.appt_time, later + relativedelta(
+            minutes=10))], [first, second])
+        self.assertEqual(overlapping("Joseph Savage", self.appt_time, later), [])
+
+        # Moved and cancelled appointments are re-indexed
+        self.data_store.update_appointment(second, appointment_time=later + relativedelta(hours=1))
+        self.assertEqual(overlapping("Francis Stewart", later, later + relativedelta(minutes=10)), [])
+        self.data_store.update_appointment(first, status=Status.CANCELLED.value)
+        self.assertEqual(overlapping("Francis Stewart", self.appt_time, later), [])
+
+    def test_double_booking(self):
+        first = self.data_store.create_appointment("2179136439", self.appt_time, 60, "Francis Stewart",
+                                                   "gastroentology", "LA10 3TZ")
+        with self.assertRaises(ClinicianUnavailableException):
+            self.data_store.create_appointment("2179136439", self.appt_time + relativedelta(minutes=30), 60,
+                                               "Francis Stewart", "gastroentology", "LA10 3TZ")
+        second = self.data_store.create_appointment("2179136439", self.appt_time + relativedelta(hours=1), 60,
+                                                    "Francis Stewart", "gastroentology", "LA10 3TZ")
+        with self.assertRaises(ClinicianUnavailableException):
+            self.data_store.update_appointment(second, duration_mins=15, appointment_time=self.appt_time)
+        # Unchanged by the failed update
+        self.assertEqual(self.data_store.get_appointment(second).duration_mins, 60)
+        self.data_store.update_appointment(first, duration_mins=60, appointment_time=self.appt_time)
+
+        # Skipped in a batch, including clashes within the batch
+        appointments = [Appointment(None, "2179136439", Status.ACTIVE.value, self.appt_time, 15,
+                                    "Francis Stewart", "gastroentology", "LA10 3TZ"),
+                        Appointment(None, "2179136439", Status.ACTIVE.value, self.appt_time, 15,
+                                    "Joseph Savage", "oncology", "LA10 3TZ"),
+                        Appointment(None, "2179136439", Status.ACTIVE.value, self.appt_time, 15,
+                                    "Joseph Savage", "oncology", "LA10 3TZ")]
+        self.assertEqual(self.data_store.create_appointments(appointments), [appointments[1].id])
+
+    def test_department_appointments(self):
+        first = self.data_store.create_appointment("2179136439", self.appt_time, 90, "Francis Stewart",
+                                                   "gastroentology", "LA10 3TZ")
+        second = self.data_store.create_appointment("2179136439", self.appt_time + relativedelta(hours=2), 30,
+                                                    "Joseph Savage", "gastroentology", "LA10 3TZ")
+        self.data_store.create_appointment("2179136439", self.appt_time, 30, "Joseph Savage", "oncology", "LA10 3TZ")
+        self.data_store.update_appointment(second, status=Status.CANCELLED.value)
+        end = self.appt_time + relativedelta(days=1)
+
+        appointments = self.data_store.get_department_appointments
+        self.assertEqual([a.id for a in appointments("gastroentology", self.appt_time, end)], [first, second])
+        # The range includes its start but not its end
+        self.assertEqual([a.id for a in appointments("gastroentology", self.appt_time + relativedelta(minutes=1),
+                                                     self.appt_time + relativedelta(hours=2))], [])
+        self.assertEqual([a.id for a in appointments("gastroentology", self.appt_time, end,
+                                                     status=Status.CANCELLED.value)], [second])
+        self.assertEqual([a.id for a in appointments("gastroentology", self.appt_time, end, limit=1,
+                                                     after=(self.appt_time, first))], [second])
+        # Moved appointments are re-sorted, and leave ranges they no longer start in
+        self.data_store.update_appointment(first, appointment_time=self.appt_time + relativedelta(hours=3))
+        self.assertEqual([a.id for a in appointments("gastroentology", self.appt_time, end)], [second, first])
+        self.assertEqual([a.id for a in appointments("gastroentology", self.appt_time,
+                                                     self.appt_time + relativedelta(hours=3))], [second])
+
+    def test_appointment_pages(self):
+        appt_ids = [self.data_store.create_appointment("2179136439", self.appt_time + relativedelta(days=-day), 15,
+                                                       "Francis Stewart", "gastroentology", "LA10 3TZ")
+                    for day in range(5)]
+        # Pages are ordered by time
+        page = self.data_store.get_clinician_appointments("Francis Stewart", limit=2)
+        self.assertEqual([a.id for a in page], [appt_ids[4], appt_ids[3]])
+        page = self.data_store.get_clinician_appointments("Francis Stewart", limit=2,
+                                                          after=(page[-1].time, page[-1].id))
+        self.assertEqual([a.id for a in page], [appt_ids[2], appt_ids[1]])
+        page = self.data_store.get_appointments("2179136439", limit=2, after=(page[-1].time, page[-1].id))
+        self.assertEqual([a.id for a in page], [appt_ids[0]])
+
+        # Moved appointments are re-sorted, deleted ones leave the pages
+        self.data_store.update_appointment(appt_ids[0], appointment_time=self.appt_time + relativedelta(days=-10))
+        self.data_store.update_appointment(appt_ids[4], clinician="Joseph Savage")
+        self.assertEqual([a.id for a in self.data_store.get_clinician_appointments("Francis Stewart", limit=2)],
+                         [appt_ids[0], appt_ids[3]])
+        self.assertEqual([a.id for a in self.data_store.get_appointments("2179136439")],
+                         [appt_ids[0], appt_ids[4], appt_ids[3], appt_ids[2], appt_ids[1]])
+        self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        self.data_store.delete_patient("2179136439")
+        self.assertEqual(self.data_store.get_clinician_appointments("Francis Stewart"), [])
+        self.assertEqual(self.data_store.get_clinician_appointments("Joseph Savage"), [])
+
+    def test_times_stored_as_naive_utc(self):
+        # As the databases store them, so they are serialised with a Z like AlchemyDatastore's
+        bst = pytz.timezone("Europe/London")
+        appt_time = bst.localize(datetime(2030, 6, 10, 10, 30))
+        appt_id = self.data_store.create_appointment("2179136439", appt_time, 15, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        self.assertEqual(self.data_store.get_appointment(appt_id).time, datetime(2030, 6, 10, 9, 30))
+        self.data_store.update_appointment(appt_id, appointment_time=appt_time + relativedelta(hours=1))
+        self.assertEqual(self.data_store.get_appointment(appt_id).time, datetime(2030, 6, 10, 10, 30))
+        self.assertEqual([a.id for a in self.data_store.get_department_appointments(
+            "gastroentology", appt_time, appt_time + relativedelta(hours=2))], [appt_id])
+
+    def test_returned_entities_are_copies(self):
+        appt_id = self.data_store.create_appointment("2179136439", self.appt_time, 90, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        self.data_store.get_appointment(appt_id).status = Status.MISSED.value
+        self.assertEqual(self.data_store.get_appointment(appt_id).status, Status.ACTIVE.value)
+
+    def test_patients(self):
+        self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        self.data_store.create_patient("3315040893", date(1980, 1, 1), "Chloe Cooney", "S1 3QX")
+        with self.assertRaises(PatientAlreadyExistsException):
+            self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+
+        self.assertEqual(len(self.data_store.findPatient("Chloe Cooney", None)), 2)
+        found = self.data_store.findPatient("Chloe Cooney", date(1980, 1, 1))
+        self.assertEqual([p.nhs_num for p in found], ["3315040893"])
+
+        self.data_store.update_patient("2179136439", patient_name="Chloe Smith", postcode="LN20 4JZ")
+        self.assertEqual(self.data_store.get_patient("2179136439").postcode, "LN20 4JZ")
+        self.assertEqual(self.data_store.get_patient("2179136439").version, 2)
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("Chloe Smith", None)], ["2179136439"])
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("Chloe Cooney", None)], ["3315040893"])
+
+        self.data_store.delete_patient("2179136439")
+        self.assertIsNone(self.data_store.get_patient("2179136439"))
+        with self.assertRaises(PatientNotFoundException):
+            self.data_store.delete_patient("2179136439")
+        with self.assertRaises(PatientNotFoundException):
+            self.data_store.update_patient("2179136439", postcode="LN20 4JZ")
+
+    def test_get_by_id(self):
+        self.data_store.create_patients([Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                                         Patient("3315040893", "Chloe Smith", date(1980, 1, 1), "S1 3QX")])
+        found = self.data_store.get_patients_by_id(["3315040893", "1953262716", "3315040893", "2179136439"])
+        self.assertEqual(sorted(patient.nhs_num for patient in found), ["2179136439", "3315040893"])
+        appt_id = self.data_store.create_appointment("2179136439", self.appt_time, 60, "Francis Stewart",
+                                                     "gastroentology", "LA10 3TZ")
+        found = self.data_store.get_appointments_by_id([appt_id, "a1504ef1-dcdf-44ba-950c-debb711f8175"])
+        self.assertEqual([appt.id for appt in found], [appt_id])
+        # Copies are handed out
+        found[0].status = Status.CANCELLED.value
+        self.assertEqual(self.data_store.get_appointment(appt_id).status, Status.ACTIVE.value)
+
+    def test_delete_patients(self):
+        self.data_store.create_patients([Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                                         Patient("3315040893", "Chloe Smith", date(1980, 1, 1), "S1 3QX")])
+        deleted_id = self.data_store.create_appointment("2179136439", self.appt_time, 60, "Francis Stewart",
+                                                        "gastroentology", "LA10 3TZ")
+        kept_id = self.data_store.create_appointment("3315040893", self.appt_time + relativedelta(hours=1), 60,
+                                                     "Francis Stewart", "gastroentology", "LA10 3TZ")
+
+        # Unknown and repeated NHS Numbers are skipped
+        self.assertEqual(self.data_store.delete_patients(["2179136439", "1953262716", "2179136439"]), ["2179136439"])
+        self.assertIsNone(self.data_store.get_patient("2179136439"))
+        # The patient's appointments go too, and no longer block the clinician's time
+        self.assertIsNone(self.data_store.get_appointment(deleted_id))
+        self.assertEqual(self.data_store.get_appointments("2179136439"), [])
+        self.assertEqual([a.id for a in self.data_store.get_clinician_appointments("Francis Stewart")], [kept_id])
+        self.assertEqual([a.id for a in self.data_store.get_overlapping_appointments(
+            "Francis Stewart", self.appt_time, self.appt_time + relativedelta(hours=2))], [kept_id])
+
+        self.data_store.delete_patient("3315040893")
+        self.assertTrue(self.data_store.is_db_empty())
+        self.assertEqual(self.data_store.get_department_appointments(
+            "gastroentology", self.appt_time, self.appt_time + relativedelta(days=1)), [])
+
+    def test_name_search(self):
+        self.data_store.create_patients([Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                                         Patient("3315040893", "Chloé O'Brien", date(1980, 1, 1), "S1 3QX"),
+                                         Patient("1953262716", "Joseph Savage", date(1980, 1, 1), "S1 3QX")])
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("CHLO", None, match=NameMatch.PREFIX.value)],
+                         ["2179136439", "3315040893"])
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("chloe o", None, NameMatch.PREFIX.value)],
+                         ["3315040893"])
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("chlo", date(1980, 1, 1),
+                                                                          NameMatch.PREFIX.value)], ["3315040893"])
+        self.assertEqual(len(self.data_store.findPatient("chlo", None, NameMatch.PREFIX.value, limit=1)), 1)
+
+        # Typos and word order
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("Cooney Cloe", None, NameMatch.FUZZY.value)],
+                         ["2179136439"])
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("Josef Savag", date(1980, 1, 1),
+                                                                          NameMatch.FUZZY.value)], ["1953262716"])
+        self.assertEqual(self.data_store.findPatient("Josef Savag", date(1990, 1, 1), NameMatch.FUZZY.value), [])
+
+        # Renamed and deleted patients are found under their new names only
+        self.data_store.update_patient("2179136439", patient_name="Zoe Smith")
+        self.assertEqual(self.data_store.findPatient("Cooney", None, NameMatch.FUZZY.value), [])
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("zoe", None, NameMatch.PREFIX.value)],
+                         ["2179136439"])
+        self.data_store.delete_patient("2179136439")
+        self.assertEqual(self.data_store.findPatient("zoe", None, NameMatch.PREFIX.value), [])
+
+        # A name of only punctuation has no trigrams, it is still stored and found exactly
+        self.data_store.update_patient("1953262716", patient_name="'")
+        self.assertEqual([p.nhs_num for p in self.data_store.findPatient("'", None)], ["1953262716"])
+        self.assertEqual(self.data_store.findPatient("Savage", None, NameMatch.FUZZY.value), [])
+
+    def test_create_patients(self):
+        self.data_store.create_patient("2179136439", date(1990, 1, 1), "Chloe Cooney", "LS1 5XT")
+        patients = [Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                    Patient("3315040893", "Chloe Cooney", date(1980, 1, 1), "S1 3QX"),
+                    Patient("3315040893", "Chloe Smith", date(1980, 1, 1), "S1 3QX")]
+        created = self.data_store.create_patients(patients)
+        self.assertEqual(created, ["3315040893"])
+        self.assertEqual(self.data_store.get_patient("3315040893").name, "Chloe Cooney")
+        self.assertEqual(len(self.data_store.findPatient("Chloe Cooney", None)), 2)
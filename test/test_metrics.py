@@ -0,0 +1,119 @@
+from unittest import IsolatedAsyncioTestCase
+from unittest import TestCase
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from async_main import create_app as create_async_app
+from exceptions import PatientNotFoundException
+from main import create_app
+from memory_datastore import MemoryDatastore
+from metrics import DATASTORE_METRICS
+from metrics import HANDLER_METRICS
+from metrics import InstrumentedDatastore
+from metrics import OperationMetrics
+from metrics import instrument
+from metrics import note_error
+
+
+class TestMetrics(TestCase):
+    def setUp(self) -> None:
+        HANDLER_METRICS.reset()
+        DATASTORE_METRICS.reset()
+
+    def test_render(self):
+        metrics = OperationMetrics("calls_total", "errors_total", "duration_seconds", "op", "test op",
+                                   buckets=(0.01, 0.1))
+        metrics.observe("a", 0.005)
+        metrics.observe("a", 0.05, "ValueError")
+        metrics.observe("a", 1.0, "ValueError")
+        metrics.observe('b"', 0.01)
+        lines = metrics.render()
+        self.assertIn('calls_total{op="a"} 3', lines)
+        self.assertIn('calls_total{op="b\\""} 1', lines)
+        self.assertIn('errors_total{op="a",exception="ValueError"} 2', lines)
+        self.assertIn("# TYPE duration_seconds histogram", lines)
+        # Buckets are cumulative and an observation on a bound is counted in it
+        self.assertEqual([line for line in lines if line.startswith('duration_seconds_bucket{op="a"')],
+                         ['duration_seconds_bucket{op="a",le="0.01"} 1',
+                          'duration_seconds_bucket{op="a",le="0.1"} 2',
+                          'duration_seconds_bucket{op="a",le="+Inf"} 3'])
+        self.assertIn('duration_seconds_bucket{op="b\\"",le="0.01"} 1', lines)
+        self.assertIn('duration_seconds_sum{op="a"} 1.055000', lines)
+        self.assertIn('duration_seconds_count{op="a"} 3', lines)
+
+    def test_instrument(self):
+        def handler(fail: bool):
+            if fail:
+                note_error(PatientNotFoundException("2179136439"))
+                return "not found", 400
+            return "ok", 200
+
+        def broken():
+            raise KeyError("x")
+
+        metrics = OperationMetrics("calls_total", "errors_total", "duration_seconds", "op", "test op")
+        instrumented = instrument(metrics, "handler", handler, note_errors=True)
+        self.assertEqual(instrumented(False), ("ok", 200))
+        self.assertEqual(instrumented(True), ("not found", 400))
+        with self.assertRaises(KeyError):
+            instrument(metrics, "broken", broken)()
+        # Noted outside an instrumented handler, nothing to count it against
+        note_error(ValueError())
+
+        lines = metrics.render()
+        self.assertIn('calls_total{op="handler"} 2', lines)
+        self.assertIn('errors_total{op="handler",exception="PatientNotFoundException"} 1', lines)
+        self.assertIn('errors_total{op="broken",exception="KeyError"} 1', lines)
+
+    def test_instrumented_datastore(self):
+        data_store = InstrumentedDatastore(MemoryDatastore())
+        self.assertTrue(data_store.is_db_empty())
+        with self.assertRaises(PatientNotFoundException):
+            data_store.delete_patient("2179136439")
+        self.assertTrue(data_store.is_db_empty())
+        lines = DATASTORE_METRICS.render()
+        self.assertIn('panda_datastore_calls_total{method="is_db_empty"} 2', lines)
+        self.assertIn('panda_datastore_errors_total{method="delete_patient",exception="PatientNotFoundException"} 1',
+                      lines)
+
+    def test_metrics_endpoint(self):
+        client = create_app(MemoryDatastore(), entity_cache_size=100, load_sample_data=False).app.test_client()
+        client.post("/panda-api/patients", query_string={
+            "nhs_number": "2179136439", "date_of_birth": "1990-01-01", "name": "Chloe Cooney", "postcode": "LS1 5XT"})
+        for _ in range(2):
+            self.assertEqual(client.get("/panda-api/patients/2179136439").status_code, 200)
+        self.assertEqual(client.get("/panda-api/patients/3315040893").status_code, 400)
+
+        response = client.get("/panda-api/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertIn('panda_requests_total{operation="create_patient"} 1', lines)
+        self.assertIn('panda_requests_total{operation="get_patient"} 3', lines)
+        self.assertIn('panda_request_errors_total{operation="get_patient",exception="PatientNotFoundException"} 1',
+                      lines)
+        # The second get was served by the cache
+        self.assertIn('panda_datastore_calls_total{method="get_patient"} 2', lines)
+
+
+class TestAsyncMetrics(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        HANDLER_METRICS.reset()
+        DATASTORE_METRICS.reset()
+
+    async def test_metrics_endpoint(self):
+        async with TestClient(TestServer(create_async_app("sqlite+aiosqlite://"))) as client:
+            await client.post("/panda-api/patients", params={
+                "nhs_number": "2179136439", "date_of_birth": "1990-01-01", "name": "Chloe Cooney",
+                "postcode": "LS1 5XT"})
+            response = await client.get("/panda-api/patients/3315040893")
+            self.assertEqual(response.status, 400)
+
+            response = await client.get("/panda-api/metrics")
+            self.assertEqual(response.status, 200)
+            lines = (await response.text()).splitlines()
+            self.assertIn('panda_requests_total{operation="create_patient"} 1', lines)
+            self.assertIn('panda_request_errors_total{operation="get_patient",'
+                          'exception="PatientNotFoundException"} 1', lines)
+            self.assertIn('panda_datastore_calls_total{method="create_patient"} 1', lines)
@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+from sqlalchemy import text
+
+from migrations import get_schema_version
+from migrations import upgrade_schema
+from migrations import LATEST_VERSION
+from orm import Base
+
+# Schema created by versions of the app before migrations were introduced
+UNVERSIONED_SCHEMA = [
+    "CREATE TABLE patient (nhs_num VARCHAR(10) NOT NULL, name VARCHAR(50), date_of_birth DATE, "
+    "postcode VARCHAR(8), PRIMARY KEY (nhs_num))",
+    "CREATE TABLE appointments (id VARCHAR(36) NOT NULL, patient_id VARCHAR(10), status VARCHAR(10), "
+    "title DATETIME, duration_mins INTEGER, clinician VARCHAR(50), department VARCHAR(20), postcode VARCHAR(8), "
+    "PRIMARY KEY (id), FOREIGN KEY(patient_id) REFERENCES patient (nhs_num))",
+    "INSERT INTO patient VALUES ('2179136439', 'Chloe Cooney', '1990-01-01', 'LS1 5XT')",
+]
+
+
+def index_names(engine, table_name: str) -> set:
+    return {index["name"] for index in inspect(engine).get_indexes(table_name)}
+
+
+class TestMigrations(TestCase):
+    def setUp(self) -> None:
+        self.engine = create_engine("sqlite://")
+
+    def test_new_database(self):
+        self.assertEqual(upgrade_schema(self.engine, Base.metadata), LATEST_VERSION)
+        self.assertIn("ix_appointments_clinician_time", index_names(self.engine, "appointments"))
+
+    def test_upgrade_unversioned_database(self):
+        with self.engine.begin() as connection:
+            for statement in UNVERSIONED_SCHEMA:
+                connection.execute(text(statement))
+        self.assertEqual(index_names(self.engine, "appointments"), set())
+
+        self.assertEqual(upgrade_schema(self.engine, Base.metadata), LATEST_VERSION)
+        self.assertTrue({"ix_appointments_patient_id_time", "ix_appointments_clinician_time",
+                         "ix_appointments_time", "ix_appointments_department_time"}
+                        <= index_names(self.engine, "appointments"))
+        self.assertTrue({"ix_patient_name_date_of_birth", "ix_patient_name_normalised_date_of_birth"}
+                        <= index_names(self.engine, "patient"))
+        with self.engine.connect() as connection:
+            self.assertEqual(get_schema_version(connection), LATEST_VERSION)
+            # Existing data is kept, new columns get their default
+            self.assertEqual(connection.execute(text("SELECT name, version FROM patient")).one(), ("Chloe Cooney", 1))
+            self.assertEqual(connection.scalar(text("SELECT incarnation FROM patient")), "")
+            # Name search columns are filled in for existing patients
+            self.assertEqual(connection.scalar(text("SELECT name_normalised FROM patient")), "chloe cooney")
+            self.assertIn("  c", connection.scalars(text("SELECT trigram FROM patient_name_trigram")).all())
+
+        # Upgrading again is a no-op
+        self.assertEqual(upgrade_schema(self.engine, Base.metadata), LATEST_VERSION)
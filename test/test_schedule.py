@@ -0,0 +1,73 @@
+from datetime import datetime
+from datetime import timedelta
+from unittest import TestCase
+import pytz
+
+from datastore import Appointment
+from schedule import ClinicianSchedule
+from schedule import ScheduleIndex
+from schedule import free_slots
+from schedule import utc_days
+from utils import Status
+
+utc = pytz.UTC
+
+
+class TestSchedule(TestCase):
+    def setUp(self) -> None:
+        self.start = datetime(2030, 1, 1, 9, tzinfo=utc)
+
+    def test_clinician_schedule(self):
+        schedule = ClinicianSchedule()
+        schedule.add("a", self.start, self.start + timedelta(minutes=120))
+        schedule.add("b", self.start + timedelta(hours=3), self.start + timedelta(hours=3, minutes=15))
+        self.assertEqual(len(schedule), 2)
+
+        self.assertEqual(schedule.overlapping(self.start + timedelta(minutes=90), self.start + timedelta(hours=4)),
+                         ["a", "b"])
+        # Touching intervals don't overlap
+        self.assertEqual(schedule.overlapping(self.start + timedelta(hours=2), self.start + timedelta(hours=3)), [])
+        self.assertEqual(schedule.overlapping(self.start - timedelta(hours=1), self.start), [])
+        self.assertEqual(schedule.overlapping(self.start, self.start + timedelta(minutes=1), exclude_id="a"), [])
+
+        schedule.remove("a", self.start)
+        self.assertEqual(schedule.overlapping(self.start, self.start + timedelta(hours=4)), ["b"])
+
+    def test_naive_times_are_utc(self):
+        schedule = ClinicianSchedule()
+        schedule.add("a", self.start.replace(tzinfo=None), self.start.replace(tzinfo=None) + timedelta(minutes=30))
+        self.assertEqual(schedule.overlapping(self.start, self.start + timedelta(minutes=1)), ["a"])
+
+    def test_schedule_index(self):
+        active = Appointment("a", "2179136439", Status.ACTIVE.value, self.start, 60, "Francis Stewart",
+                             "gastroentology", "LA10 3TZ")
+        cancelled = Appointment("b", "2179136439", Status.CANCELLED.value, self.start, 60, "Francis Stewart",
+                                "gastroentology", "LA10 3TZ")
+        index = ScheduleIndex([active, cancelled])
+        end = self.start + timedelta(minutes=10)
+        self.assertEqual(index.overlapping("Francis Stewart", self.start, end), ["a"])
+        self.assertEqual(index.overlapping("Joseph Savage", self.start, end), [])
+
+        index.remove(active)
+        self.assertEqual(index.overlapping("Francis Stewart", self.start, end), [])
+        self.assertEqual(index.schedules, {})
+
+    def test_utc_days(self):
+        self.assertEqual(list(utc_days(self.start, self.start + timedelta(hours=1))), [self.start.date()])
+        # A range ending at midnight doesn't include the next day
+        midnight = self.start.replace(hour=0) + timedelta(days=1)
+        self.assertEqual(list(utc_days(self.start, midnight)), [self.start.date()])
+        self.assertEqual(len(list(utc_days(self.start, midnight + timedelta(minutes=1)))), 2)
+
+    def test_free_slots(self):
+        first = Appointment("a", "2179136439", Status.ACTIVE.value, self.start + timedelta(minutes=30), 60,
+                            "Francis Stewart", "gastroentology", "LA10 3TZ")
+        second = Appointment("b", "2179136439", Status.ACTIVE.value, self.start + timedelta(minutes=100), 15,
+                             "Francis Stewart", "gastroentology", "LA10 3TZ")
+        end = self.start + timedelta(hours=3)
+        # Appointments may be given more than once and in any order
+        self.assertEqual(free_slots([second, first, second], self.start, end, timedelta(minutes=15)),
+                         [(self.start, first.time), (self.start + timedelta(minutes=115), end)])
+        self.assertEqual(free_slots([second, first], self.start, end, timedelta(minutes=60)),
+                         [(self.start + timedelta(minutes=115), end)])
+        self.assertEqual(free_slots([], self.start, end, timedelta(minutes=15)), [(self.start, end)])
@@ -0,0 +1,58 @@
+import json
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from unittest import TestCase
+import pytz
+
+from connexion.apps.flask_app import FlaskJSONEncoder
+
+import serialisation
+from serialisation import JSON_BACKENDS
+from serialisation import ResponseJsonifier
+from serialisation import dumps
+from serialisation import iter_json_array
+from serialisation import set_json_backend
+
+utc = pytz.UTC
+
+
+class TestSerialisation(TestCase):
+    def setUp(self) -> None:
+        self.items = [{"time": datetime(2023, 6, 10, 9, 30), "date_of_birth": date(1990, 1, 1), "name": "Chloe"},
+                      {"time": datetime(2023, 6, 10, 9, 30, tzinfo=utc), "duration": 15},
+                      {"time": datetime(2023, 6, 10, 9, 30, 0, 123456, tzinfo=timezone(timedelta(hours=1))),
+                       "patients": [{"patient": "2179136439", "status": None}], "empty": []}]
+
+    def tearDown(self) -> None:
+        set_json_backend(None)
+
+    def test_dumps_matches_connexion(self):
+        for name in JSON_BACKENDS:
+            set_json_backend(name)
+            for item in self.items:
+                self.assertEqual(json.loads(dumps(item)), json.loads(json.dumps(item, cls=FlaskJSONEncoder)))
+        set_json_backend('json')
+        for item in self.items:
+            self.assertEqual(dumps(item), json.dumps(item, cls=FlaskJSONEncoder))
+
+    def test_response_jsonifier(self):
+        # Full responses are the same whichever backend is used, as served by Flask before
+        jsonifier = ResponseJsonifier(indent=True, sort_keys=True)
+        for name in JSON_BACKENDS:
+            set_json_backend(name)
+            self.assertEqual(jsonifier.dumps(self.items),
+                             json.dumps(self.items, cls=FlaskJSONEncoder, indent=2, sort_keys=True) + "\n")
+        with self.assertRaises(ValueError):
+            set_json_backend("simplejson")
+
+    def test_iter_json_array(self):
+        serialisation.STREAM_CHUNK_ITEMS = 2
+        try:
+            for count in range(6):
+                items = (self.items * 3)[:count]
+                self.assertEqual(json.loads("".join(iter_json_array(iter(items)))),
+                                 json.loads(json.dumps(items, cls=FlaskJSONEncoder)))
+        finally:
+            serialisation.STREAM_CHUNK_ITEMS = 100
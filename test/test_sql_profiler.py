@@ -0,0 +1,124 @@
+from datetime import date
+from unittest import IsolatedAsyncioTestCase
+from unittest import TestCase
+
+from aiohttp.test_utils import TestClient
+from aiohttp.test_utils import TestServer
+
+from async_main import create_app as create_async_app
+from datastore import Patient
+from main import create_app
+from orm import AlchemyDatastore
+from sql_profiler import SQL_PROFILER
+from sql_profiler import SqlProfiler
+from sql_profiler import count_statements
+from sql_profiler import normalise_statement
+
+
+class TestSqlProfiler(TestCase):
+    def setUp(self) -> None:
+        SQL_PROFILER.reset()
+
+    def test_normalise_statement(self):
+        self.assertEqual(normalise_statement("SELECT patient.name\nFROM patient\n  WHERE patient.nhs_num = ?"),
+                         "SELECT patient.name FROM patient WHERE patient.nhs_num = ?")
+        self.assertEqual(normalise_statement("SELECT * FROM patient WHERE name = 'O''Brien' LIMIT 10 OFFSET 2.5"),
+                         "SELECT * FROM patient WHERE name = ? LIMIT ? OFFSET ?")
+        # IN lists of any length are one statement, identifiers ending in digits are kept
+        self.assertEqual(normalise_statement("SELECT a FROM t AS t_1 WHERE t_1.id IN (?, ?, ?)"),
+                         normalise_statement("SELECT a FROM t AS t_1 WHERE t_1.id IN (?,?)"))
+        self.assertEqual(normalise_statement("SELECT a FROM t AS t_1 WHERE t_1.id IN (?, ?, ?)"),
+                         "SELECT a FROM t AS t_1 WHERE t_1.id IN (?, ...)")
+        self.assertEqual(normalise_statement("INSERT INTO t (a, b) VALUES (?, ?), (?, ?), (?, ?)"),
+                         "INSERT INTO t (a, b) VALUES (?, ...), ...")
+
+    def test_report(self):
+        profiler = SqlProfiler(slow_query_secs=0.5, top_n=2, max_statements=3)
+        with self.assertLogs("sql_profiler", "WARNING") as logs:
+            profiler.record("SELECT a FROM t WHERE id = 1", (), 0.01)
+            profiler.record("SELECT a FROM t WHERE id = 2", (), 0.03)
+            profiler.record("SELECT b FROM t WHERE id = ?", ("2179136439",), 0.75)
+            profiler.record("UPDATE t SET a = ?", [(1,), (2,)], 0.5, executemany=True)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn("750.0ms: SELECT b FROM t WHERE id = ? parameters: ('2179136439',)", logs.output[0])
+        self.assertIn("2 sets, first (1,)", logs.output[1])
+
+        report = profiler.report()
+        self.assertEqual(report["slow_statements"], 2)
+        self.assertEqual(report["slow_query_ms"], 500)
+        self.assertEqual(report["statements"], [
+            {"statement": "SELECT b FROM t WHERE id = ?", "calls": 1, "total_ms": 750, "mean_ms": 750, "max_ms": 750},
+            {"statement": "UPDATE t SET a = ?", "calls": 1, "total_ms": 500, "mean_ms": 500, "max_ms": 500}])
+
+        # Full, the statement with the least total time makes way for a new one
+        profiler.record("DELETE FROM t", (), 0.001)
+        profiler.top_n = 10
+        self.assertEqual([stats["statement"] for stats in profiler.report()["statements"]],
+                         ["SELECT b FROM t WHERE id = ?", "UPDATE t SET a = ?", "DELETE FROM t"])
+
+    def test_count_statements(self):
+        profiler = SqlProfiler()
+
+        def handler(queries: int):
+            for _ in range(queries):
+                profiler.record("SELECT 1", (), 0.001)
+            return "ok", 200
+
+        counted = count_statements(profiler, "handler", handler)
+        self.assertEqual(counted(3), ("ok", 200))
+        counted(1)
+        # Not counted against a request
+        profiler.record("SELECT 1", (), 0.001)
+        operations = profiler.report()["operations"]
+        self.assertEqual([(op["operation"], op["requests"], op["statements"], op["mean_statements"],
+                           op["max_statements"]) for op in operations], [("handler", 2, 4, 2, 3)])
+        self.assertEqual(profiler.report()["statements"][0]["calls"], 5)
+
+    def test_alchemy_datastore(self):
+        profiler = SqlProfiler()
+        data_store = AlchemyDatastore("sqlite://", profiler=profiler)
+        profiler.reset()
+        data_store.create_patients([Patient("2179136439", "Chloe Cooney", date(1990, 1, 1), "LS1 5XT"),
+                                    Patient("3315040893", "Rupert Bear", date(1980, 2, 3), "LS1 5XT")])
+        for nhs_num in ("2179136439", "3315040893"):
+            data_store.get_patient(nhs_num)
+        data_store.get_patients_by_id(["2179136439", "3315040893"])
+        statements = {stats["statement"]: stats["calls"] for stats in profiler.report()["statements"]}
+        # The same query for each patient, and the batch get whatever the number of ids
+        columns = "SELECT patient.nhs_num, patient.name, patient.date_of_birth"
+        self.assertEqual([calls for statement, calls in statements.items()
+                          if statement.startswith(columns) and statement.endswith("patient.nhs_num = ?")], [2])
+        self.assertEqual([calls for statement, calls in statements.items()
+                          if statement.startswith(columns) and statement.endswith("IN (?, ...)")], [1])
+        data_store.dispose()
+
+    def test_sql_profile_endpoint(self):
+        client = create_app(AlchemyDatastore("sqlite://", profiler=SQL_PROFILER), load_sample_data=False,
+                            metrics=False).app.test_client()
+        SQL_PROFILER.reset()
+        client.post("/panda-api/patients", query_string={
+            "nhs_number": "2179136439", "date_of_birth": "1990-01-01", "name": "Chloe Cooney", "postcode": "LS1 5XT"})
+        for _ in range(2):
+            self.assertEqual(client.get("/panda-api/patients/2179136439").status_code, 200)
+
+        report = client.get("/panda-api/admin/sql").get_json()
+        operations = {op["operation"]: op for op in report["operations"]}
+        self.assertEqual(operations["get_patient"]["requests"], 2)
+        self.assertEqual(operations["get_patient"]["statements"], 2)
+        self.assertGreater(operations["create_patient"]["statements"], 0)
+        self.assertTrue(report["statements"])
+
+
+class TestAsyncSqlProfiler(IsolatedAsyncioTestCase):
+    async def test_sql_profile_endpoint(self):
+        async with TestClient(TestServer(create_async_app("sqlite+aiosqlite://"))) as client:
+            SQL_PROFILER.reset()
+            await client.post("/panda-api/patients", params={
+                "nhs_number": "2179136439", "date_of_birth": "1990-01-01", "name": "Chloe Cooney",
+                "postcode": "LS1 5XT"})
+            await client.get("/panda-api/patients/2179136439")
+
+            report = await (await client.get("/panda-api/admin/sql")).json()
+            operations = {op["operation"]: op for op in report["operations"]}
+            self.assertEqual(operations["get_patient"]["statements"], 1)
+            self.assertGreater(operations["create_patient"]["statements"], 0)
@@ -1,8 +1,32 @@
+from datetime import date
+from datetime import datetime
 from unittest import TestCase
+import pytz
+
+from dateutil.parser import parse
 
 from dev_tools import generate_nhs_num
+from dev_tools import generate_nhs_nums
+from exceptions import InvalidBulkBodyException
+from exceptions import InvalidRecordException
+from exceptions import InvalidCursorException
+from exceptions import InvalidDateException
+from exceptions import InvalidDateTimeException
+from exceptions import InvalidPatientIdException
+from exceptions import MissingFieldException
+from utils import decode_cursor
+from utils import encode_cursor
+from utils import etag_matches
+from utils import get_date_field
+from utils import get_datetime_field
+from utils import get_patient_id_list
+from utils import get_postcode_str
+from utils import iter_bulk_records
+from utils import normalise_postcode
+from utils import normalise_postcodes
 from utils import validate_postcode
 from utils import validate_patient_id
+from utils import validate_patient_ids
 
 
 class Test(TestCase):
@@ -11,6 +35,16 @@ class Test(TestCase):
         assert validate_postcode("LN20 4JZ")
         assert not validate_postcode("S1 3Q")
         assert not validate_postcode("LN20 4J")
+        assert validate_postcode("GIR 0AA")
+        assert not validate_postcode("GIR 1AA")
+
+    def test_normalise_postcode(self):
+        self.assertEqual(normalise_postcode("LN204JZ"), "LN20 4JZ")
+        self.assertEqual(normalise_postcode("S 1 3QX"), "S1 3QX")
+        self.assertEqual(normalise_postcode("EC1A 1BB"), "EC1A 1BB")
+        self.assertIsNone(normalise_postcode("S1 3Q"))
+        self.assertEqual(normalise_postcodes(["S13QX", "S1 3Q", "S13QX"]), ["S1 3QX", None, "S1 3QX"])
+        self.assertEqual(get_postcode_str({"postcode": "LS15XT"}, "postcode"), "LS1 5XT")
 
     def test_validate_patient_id(self):
         valid_nums = [
@@ -40,3 +74,66 @@ class Test(TestCase):
         # Test NHS Num generator
         for i in range(1000):
             assert validate_patient_id(generate_nhs_num())
+
+    def test_validate_patient_ids(self):
+        nhs_nums = ["3315040893", "1315040893", "331504089", "33150408931", "331504089a", "", "2119596395"]
+        self.assertEqual(validate_patient_ids(nhs_nums).tolist(), [validate_patient_id(num) for num in nhs_nums])
+        self.assertEqual(len(validate_patient_ids([])), 0)
+
+    def test_get_patient_id_list(self):
+        nhs_nums = ["3315040893", "2119596395"]
+        self.assertEqual(get_patient_id_list({"ids": nhs_nums}, "ids"), nhs_nums)
+        self.assertEqual(get_patient_id_list({"ids": []}, "ids"), [])
+        with self.assertRaises(InvalidPatientIdException) as cm:
+            get_patient_id_list({"ids": ["3315040893", "1315040893", "331504089"]}, "ids")
+        self.assertIn("1315040893", cm.exception.user_message)
+        with self.assertRaises(MissingFieldException):
+            get_patient_id_list({}, "ids")
+
+    def test_generate_nhs_nums(self):
+        nhs_nums = generate_nhs_nums(1000)
+        self.assertEqual(len(nhs_nums), 1000)
+        self.assertTrue(validate_patient_ids(nhs_nums).all())
+
+    def test_iter_bulk_records(self):
+        records = list(iter_bulk_records(b'[{"name": "a"}, 2, {"name": "b"}]'))
+        self.assertEqual([line_no for line_no, _ in records], [1, 2, 3])
+        self.assertEqual(records[0][1], {"name": "a"})
+        self.assertIsInstance(records[1][1], InvalidRecordException)
+
+        records = list(iter_bulk_records('{"name": "a"}\n\nnot json\n{"name": "b"}\n'))
+        self.assertEqual([line_no for line_no, _ in records], [1, 3, 4])
+        self.assertIsInstance(records[1][1], InvalidRecordException)
+        self.assertEqual(records[2][1], {"name": "b"})
+
+        with self.assertRaises(InvalidBulkBodyException):
+            iter_bulk_records(b'[{"name": "a"}')
+
+    def test_cursor(self):
+        key = (datetime(2023, 6, 10, 9, 30), "a1504ef1-dcdf-44ba-950c-debb711f8175")
+        self.assertEqual(decode_cursor(encode_cursor(*key)), key)
+        with self.assertRaises(InvalidCursorException):
+            decode_cursor("not a cursor")
+
+    def test_etag_matches(self):
+        self.assertTrue(etag_matches('"2"', '"2"'))
+        self.assertTrue(etag_matches('"1", W/"2"', '"2"'))
+        self.assertTrue(etag_matches('*', '"2"'))
+        self.assertFalse(etag_matches('"1"', '"2"'))
+        self.assertFalse(etag_matches(None, '"2"'))
+
+    def test_get_date_field(self):
+        self.assertEqual(get_date_field({"dob": "2023-01-01"}, "dob"), date(2023, 1, 1))
+        # Falls back to the lenient parser
+        self.assertEqual(get_date_field({"dob": "1 Jan 2023"}, "dob"), date(2023, 1, 1))
+        with self.assertRaises(InvalidDateException):
+            get_date_field({"dob": "2023-02-30"}, "dob")
+
+    def test_get_datetime_field(self):
+        # The fast path gives the same result as the lenient parser
+        for value in ["2023-01-01T09:30:00Z", "2023-01-01 09:30", "2023-01-01T09:30:00.123456+01:00",
+                      "9:30am 1 January 2023"]:
+            self.assertEqual(get_datetime_field({"time": value}, "time"),
+                             parse(value, fuzzy=True).replace(tzinfo=pytz.UTC))
+        with self.assertRaises(InvalidDateTimeException):
+            get_datetime_field({"time": "2023-01-01T25:00:00Z"}, "time")
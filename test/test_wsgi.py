@@ -0,0 +1,57 @@
+import os
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from sqlalchemy import text
+
+import operations
+from cache import CachingDatastore
+from datastore import set_data_store
+from memory_datastore import MemoryDatastore
+from orm import AlchemyDatastore
+from wsgi import create_app
+from wsgi import prepare_database
+
+
+class TestWsgi(TestCase):
+    def setUp(self) -> None:
+        self.db_dir = tempfile.TemporaryDirectory()
+        self.db_url = f"sqlite:///{os.path.join(self.db_dir.name, 'panda.db')}"
+
+    def tearDown(self) -> None:
+        set_data_store(None)
+        self.db_dir.cleanup()
+
+    def test_sqlite_wal(self):
+        data_store = AlchemyDatastore(self.db_url)
+        with data_store.engine.connect() as connection:
+            self.assertEqual(connection.scalar(text("PRAGMA journal_mode")), "wal")
+        data_store.dispose()
+
+    def test_create_app(self):
+        with mock.patch.dict(os.environ, {"PANDA_DB_URL": self.db_url, "PANDA_CACHE_SIZE": "0"}):
+            prepare_database()
+            client = create_app().test_client()
+        response = client.get("/panda-api/patients/1953262716")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["patient"], "1953262716")
+        operations.get_data_store().dispose()
+
+    def test_cache_off_with_many_workers(self):
+        for workers, cached in (("1", True), ("4", False)):
+            with self.subTest(workers=workers):
+                with mock.patch.dict(os.environ, {"PANDA_DB_URL": self.db_url, "PANDA_SAMPLE_DATA": "0",
+                                                  "PANDA_WORKERS": workers}):
+                    prepare_database()
+                    create_app()
+                data_store = operations.get_data_store()
+                self.assertEqual(isinstance(data_store, CachingDatastore), cached)
+                (data_store.data_store if cached else data_store).dispose()
+
+    def test_app_follows_data_store(self):
+        set_data_store(MemoryDatastore())
+        app = operations.get_app()
+        self.assertIs(operations.get_app(), app)
+        set_data_store(MemoryDatastore())
+        self.assertIsNot(operations.get_app(), app)
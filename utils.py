@@ -1,20 +1,41 @@
+import base64
+import binascii
+import json
+import math
 import re
+import unicodedata
 from datetime import date
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Union
+import numpy as np
 import pytz
 
 from dateutil.parser import parse
 from dateutil.parser import ParserError
 
 from exceptions import MissingFieldException
+from exceptions import InvalidBulkBodyException
+from exceptions import InvalidRecordException
+from exceptions import InvalidCursorException
 from exceptions import InvalidDurationException
 from exceptions import InvalidStatusException
+from exceptions import InvalidStatusChangeException
+from exceptions import InvalidNameMatchException
 from exceptions import InvalidDateException
 from exceptions import InvalidDateTimeException
 from exceptions import InvalidPostcodeException
 from exceptions import InvalidPatientIdException
+from messages import MSG_CANT_REINSTATE_CANCELLED
 
 utc = pytz.UTC
 
@@ -28,6 +49,29 @@ class Status(Enum):
     ACTIVE = 'active'
 
 
+# Status changes which aren't allowed, (from, to): message for the user
+FORBIDDEN_STATUS_CHANGES: Dict[Tuple[Status, Status], str] = {
+    (Status.CANCELLED, Status.ACTIVE): MSG_CANT_REINSTATE_CANCELLED,
+}
+
+
+def statuses_changeable_to(status: str) -> List[str]:
+    """
+    :param status: New status
+    :return: The statuses an appointment can be changed to status from
+    """
+    return [current.value for current in Status if (current, Status(status)) not in FORBIDDEN_STATUS_CHANGES]
+
+
+def check_status_change(current: str, new: str) -> None:
+    """
+    :raises InvalidStatusChangeException: if an appointment's status can't be changed from current to new
+    """
+    msg = FORBIDDEN_STATUS_CHANGES.get((Status(current), Status(new)))
+    if msg is not None:
+        raise InvalidStatusChangeException(msg)
+
+
 class Duration(Enum):
     MINS_15 = '15m'
     MINS_120 = '2h'
@@ -53,6 +97,16 @@ MINS_TO_DURATION: Dict[int, Duration] = {
 }
 
 
+# Longest appointment, bounds how far back an appointment overlapping a given time can start
+MAX_DURATION_MINS = max(DURATION_TO_MINS.values())
+
+
+class NameMatch(Enum):
+    EXACT = 'exact'
+    PREFIX = 'prefix'
+    FUZZY = 'fuzzy'
+
+
 def strToDuration(duration_str: str) -> Duration:
     """
     Convert a duration string rxd from FE to Duration enum
@@ -77,6 +131,18 @@ def strToStatus(status_str: str) -> Status:
     raise InvalidStatusException(status_str)
 
 
+def strToNameMatch(match_str: str) -> NameMatch:
+    """
+    Convert a name match string rxd from FE to NameMatch enum
+    :param match_str: rxd from FE
+    :return: NameMatch enum
+    """
+    for match in NameMatch:
+        if match.value == match_str:
+            return match
+    raise InvalidNameMatchException(match_str)
+
+
 def validate_patient_id(patient_id: str) -> bool:
     """
     Perform modulo 11 check on patient_id https://www.datadictionary.nhs.uk/attributes/nhs_number.html
@@ -98,9 +164,60 @@ def validate_patient_id(patient_id: str) -> bool:
         return False
 
 
-# UK Gov Mainland Postcode Regex
-POSTCODE_REGEX = r"^([A-PR-UWYZ0-9][A-HK-Y0-9][AEHMNPRTVXY0-9]?[ABEHMNPRVWXY0-9]? {1,2}[0-9][ABD-HJLN-UW-Z]{2}|GIR 0AA)$"
-MIN_POSTCODE_LENGTH = 5
+# Weights applied to the first 9 digits of an NHS Number by the modulo 11 check
+NHS_NUM_WEIGHTS = np.arange(10, 1, -1)
+
+
+def validate_patient_ids(patient_ids: Sequence[str]) -> np.ndarray:
+    """
+    validate_patient_id for many NHS Numbers in one vectorised pass, e.g. for a practice extract
+    :param patient_ids: strings representing the numbers to check
+    :return: bool array, True where the checksum digit matches
+    """
+    # One row of unicode code points per number, one extra column to catch numbers that are too long
+    codes = np.asarray(patient_ids, dtype="U11").reshape(-1).view(np.uint32).reshape(-1, 11)
+    digits = codes[:, :10].astype(np.int64) - ord("0")
+    well_formed = ((digits >= 0) & (digits <= 9)).all(axis=1) & (codes[:, 10] == 0)
+    chk_digit = 11 - (digits[:, :9] @ NHS_NUM_WEIGHTS) % 11
+    csum = np.where(chk_digit == 11, 0, chk_digit)
+    return well_formed & (csum != 10) & (digits[:, 9] == csum)
+
+
+# UK Gov Mainland Postcode Regex, with the spaces removed:
+# ^([A-PR-UWYZ0-9][A-HK-Y0-9][AEHMNPRTVXY0-9]?[ABEHMNPRVWXY0-9]? {1,2}[0-9][ABD-HJLN-UW-Z]{2}|GIR 0AA)$
+# The inward code is always the last 3 characters, so the space doesn't need to be matched
+POSTCODE_PATTERN = re.compile(r"[A-PR-UWYZ0-9][A-HK-Y0-9][AEHMNPRTVXY0-9]?[ABEHMNPRVWXY0-9]?[0-9][ABD-HJLN-UW-Z]{2}|GIR0AA")
+
+
+def normalise_postcode(postcode: str) -> Optional[str]:
+    """
+    Validate a postcode according to regex specified by UK Gov and put it in its canonical form
+    Allow for incorrect placing of space char
+    :param postcode: postcode string to check
+    :return: postcode with a single space before the inward code, None if it doesn't match the postcode format
+    """
+    no_space = postcode.replace(" ", "")
+    if POSTCODE_PATTERN.fullmatch(no_space) is None:
+        return None
+    return f"{no_space[:-3]} {no_space[-3:]}"
+
+
+def normalise_postcodes(postcodes: Iterable[str]) -> List[Optional[str]]:
+    """
+    normalise_postcode for a column of postcodes, e.g. from a bulk import
+    Each distinct postcode is only checked once, bulk data usually repeats them
+    :param postcodes: postcode strings to check
+    :return: canonical postcode (or None if invalid) for each postcode, in the same order
+    """
+    normalised: Dict[str, Optional[str]] = {}
+    results: List[Optional[str]] = []
+    for postcode in postcodes:
+        try:
+            results.append(normalised[postcode])
+        except KeyError:
+            normalised[postcode] = canonical = normalise_postcode(postcode)
+            results.append(canonical)
+    return results
 
 
 def validate_postcode(postcode: str) -> bool:
@@ -110,16 +227,122 @@ def validate_postcode(postcode: str) -> bool:
     :param postcode: postcode string to check
     :return: True if matches postcode format
     """
-    # Get rid of any spaces
-    no_space = postcode.replace(" ", "")
-    # Check is at least minimum length
-    if len(no_space) < MIN_POSTCODE_LENGTH:
+    return POSTCODE_PATTERN.fullmatch(postcode.replace(" ", "")) is not None
+
+
+# Names are similar if at least this proportion of their trigrams are shared, the pg_trgm default
+FUZZY_NAME_THRESHOLD = 0.3
+NON_NAME_CHARS_REGEX = re.compile(r"[^\w]+|_")
+
+
+def normalise_name(name: str) -> str:
+    """
+    Put a name in the form used for prefix and fuzzy searches
+    Accents are removed, case is folded and punctuation becomes single spaces, e.g. "O'Brien, Zoë" -> "o brien zoe"
+    :param name: name string
+    :return: normalised name
+    """
+    decomposed = unicodedata.normalize("NFKD", name.casefold())
+    unaccented = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return NON_NAME_CHARS_REGEX.sub(" ", unaccented).strip()
+
+
+def name_trigrams(normalised_name: str) -> Set[str]:
+    """
+    Trigrams of a normalised name, each word is padded so that the start and end of words count for more
+    :param normalised_name: name from normalise_name
+    :return: distinct trigrams
+    """
+    trigrams = set()
+    for word in normalised_name.split():
+        padded = f"  {word} "
+        trigrams.update(padded[idx:idx + 3] for idx in range(len(padded) - 2))
+    return trigrams
+
+
+def name_similarity(trigrams: Set[str], other_trigrams: Set[str]) -> float:
+    """
+    :return: Shared trigrams as a proportion of all trigrams, 1.0 for the same name
+    """
+    if not trigrams or not other_trigrams:
+        return 0.0
+    shared = len(trigrams & other_trigrams)
+    return shared / (len(trigrams) + len(other_trigrams) - shared)
+
+
+def min_shared_trigrams(trigrams: Set[str]) -> int:
+    """
+    A name needs at least this many of trigrams to be FUZZY_NAME_THRESHOLD similar to the name they come from
+    The union of two trigram sets is at least as big as either, so this follows from the similarity threshold
+    """
+    return max(1, math.ceil(FUZZY_NAME_THRESHOLD * len(trigrams)))
+
+
+def rank_by_similarity(name: str, candidates: Iterable[Tuple[str, object]]) -> List[object]:
+    """
+    Rank candidates by how similar their names are to name, dropping those below FUZZY_NAME_THRESHOLD
+    :param name: name searched for
+    :param candidates: (normalised name, candidate)
+    :return: candidates, most similar first
+    """
+    trigrams = name_trigrams(normalise_name(name))
+    scored = []
+    for normalised, candidate in candidates:
+        similarity = name_similarity(trigrams, name_trigrams(normalised))
+        if similarity >= FUZZY_NAME_THRESHOLD:
+            scored.append((-similarity, normalised, len(scored), candidate))
+    scored.sort()
+    return [candidate for _, _, _, candidate in scored]
+
+
+def encode_cursor(time: datetime, appointment_id: str) -> str:
+    """
+    Encode the (time, id) sort key of the last appointment in a page as an opaque cursor
+    :param time: time of the appointment
+    :param appointment_id: id of the appointment
+    :return: URL safe cursor string
+    """
+    return base64.urlsafe_b64encode(f"{time.isoformat()}|{appointment_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """
+    Decode a cursor created by encode_cursor
+    :param cursor: cursor string rxd from FE
+    :return: Tuple of: appointment time, appointment id
+    """
+    try:
+        time_str, appointment_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(time_str), appointment_id
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise InvalidCursorException(cursor) from e
+
+
+def make_etag(incarnation: Optional[str], version: int) -> str:
+    """
+    Made from the entity's stored state rather than its response body, so it can be checked without building one
+    The version alone starts at 1 again when a deleted patient or appointment is created again, the incarnation
+    is new each time
+    :param incarnation: Token stamped on the entity when it was stored, see datastore.new_incarnation
+    :param version: Version of the entity, incremented on every update
+    :return: (strong) ETag header value for the entity
+    """
+    return f'"{incarnation or ""}-{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match header against an ETag
+    :param if_none_match: If-None-Match header value, a list of ETags or *
+    :param etag: Current ETag of the resource
+    :return: True if the client's copy of the resource is current
+    """
+    if if_none_match is None:
         return False
-    # Test with spaces at permitted indices, TODO: check order of most common first
-    for permitted_space_idx in [4, 3, 2]:
-        if re.match(POSTCODE_REGEX, f"{no_space[:permitted_space_idx]} {no_space[permitted_space_idx:]}"):
-            return True
-    return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, as required for If-None-Match
+    return etag.removeprefix("W/") in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
 
 
 """
@@ -165,6 +388,51 @@ def get_status_field(args: dict, field_name: str) -> Status:
     return strToStatus(field)
 
 
+# Strict ISO 8601 forms handled without dateutil, e.g. 2023-01-01 and 2023-01-01T09:30:00Z
+ISO_DATE_REGEX = re.compile(r"\d{4}-\d{2}-\d{2}")
+ISO_DATETIME_REGEX = re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d{3}(\d{3})?)?)?(Z|[+-]\d{2}:\d{2})?")
+# Number of recent values remembered by the lenient parser
+LENIENT_PARSE_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=LENIENT_PARSE_CACHE_SIZE)
+def _parse_lenient(value: str, today: date) -> datetime:
+    # today is part of the cache key because missing date parts are taken from the current date
+    return parse(value, fuzzy=True)
+
+
+def parse_date(value: str) -> date:
+    """
+    Parse a date str rxd from the FE
+    ISO 8601 dates are parsed directly, anything else by the lenient parser
+    :param value: date str
+    :return: date value
+    """
+    if ISO_DATE_REGEX.fullmatch(value):
+        try:
+            return date.fromisoformat(value)
+        except ValueError:
+            # e.g. month 13, let the lenient parser decide
+            pass
+    return _parse_lenient(value, date.today()).date()
+
+
+def parse_datetime(value: str) -> datetime:
+    """
+    Parse a datetime str rxd from the FE, the result is in UTC
+    ISO 8601 datetimes are parsed directly, anything else by the lenient parser
+    As with the lenient parser any UTC offset is replaced, not applied
+    :param value: datetime str
+    :return: datetime value
+    """
+    if ISO_DATETIME_REGEX.fullmatch(value):
+        try:
+            return datetime.fromisoformat(value[:-1] if value[-1] == "Z" else value).replace(tzinfo=utc)
+        except ValueError:
+            pass
+    return _parse_lenient(value, date.today()).replace(tzinfo=utc)
+
+
 def get_date_field(args: dict, field_name: str) -> date:
     """
     Get date field str and convert to enum.
@@ -175,7 +443,7 @@ def get_date_field(args: dict, field_name: str) -> date:
     """
     field = get_str_field(args, field_name)
     try:
-        return parse(field, fuzzy=True).date()
+        return parse_date(field)
     except ParserError as pe:
         raise InvalidDateException(field) from pe
 
@@ -190,7 +458,7 @@ def get_datetime_field(args: dict, field_name: str) -> datetime:
     """
     field = get_str_field(args, field_name)
     try:
-        return parse(field, fuzzy=True).replace(tzinfo=utc)
+        return parse_datetime(field)
     except ParserError as pe:
         raise InvalidDateTimeException(field) from pe
 
@@ -200,12 +468,13 @@ def get_postcode_str(args: dict, field_name: str) -> str:
     Get postcode field str and validate.
     :param args: Args originating from FE
     :param field_name: Name of the field requested
-    :return: validated postcode str
+    :return: validated postcode str, in canonical form
     """
     postcode = get_str_field(args, field_name)
-    if not validate_postcode(postcode):
+    normalised = normalise_postcode(postcode)
+    if normalised is None:
         raise InvalidPostcodeException(postcode)
-    return postcode
+    return normalised
 
 
 def get_patient_id(args: dict, field_name: str) -> str:
@@ -219,3 +488,81 @@ def get_patient_id(args: dict, field_name: str) -> str:
     if not validate_patient_id(patient_id):
         raise InvalidPatientIdException(patient_id)
     return patient_id
+
+
+def get_str_list_field(args: dict, field_name: str) -> List[str]:
+    """
+    Get a list of strings field from the args rxd from the FE
+    Raise Exception if not present
+    :param args: Args originating from FE
+    :param field_name: Name of the field requested
+    :return: list of field value strings
+    """
+    if field_name not in args.keys():
+        raise MissingFieldException(field_name)
+    return [str(value) for value in args[field_name]]
+
+
+def get_patient_id_list(args: dict, field_name: str) -> List[str]:
+    """
+    Get a list of NHS Numbers field from the args rxd from the FE, checked in one vectorised pass
+    Raise Exception if not present or any of the NHS Numbers is invalid
+    :param args: Args originating from FE
+    :param field_name: Name of the field requested
+    :return: validated NHS Number strs
+    """
+    patient_ids = get_str_list_field(args, field_name)
+    if patient_ids:
+        valid = validate_patient_ids(patient_ids)
+        if not valid.all():
+            raise InvalidPatientIdException(patient_ids[int(np.argmin(valid))])
+    return patient_ids
+
+
+def _iter_ndjson_records(body: str) -> Iterator[Tuple[int, Union[dict, InvalidRecordException]]]:
+    for line_no, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            yield line_no, InvalidRecordException(line)
+        else:
+            yield line_no, record
+
+
+def _iter_array_records(records: list) -> Iterator[Tuple[int, Union[dict, InvalidRecordException]]]:
+    for line_no, record in enumerate(records, start=1):
+        if not isinstance(record, dict):
+            yield line_no, InvalidRecordException(json.dumps(record))
+        else:
+            yield line_no, record
+
+
+def iter_bulk_records(body: Union[bytes, str]) -> Iterator[Tuple[int, Union[dict, InvalidRecordException]]]:
+    """
+    Iterate over the records in a bulk request body
+    The body can be a JSON array or newline delimited JSON (one object per line)
+    Records that can't be used are returned as an exception, rather than raised,
+    so that the caller can report them and carry on with the rest
+    :param body: Request body rxd from the FE
+    :return: Iterator of (line number, record dict or InvalidRecordException),
+    for JSON arrays the line number is the 1-based position in the array
+    """
+    if isinstance(body, bytes):
+        try:
+            body = body.decode("utf-8")
+        except UnicodeDecodeError as ude:
+            raise InvalidBulkBodyException() from ude
+    if not body.lstrip().startswith("["):
+        # NDJSON is parsed lazily, one line at a time
+        return _iter_ndjson_records(body)
+    try:
+        records = json.loads(body)
+    except ValueError as ve:
+        raise InvalidBulkBodyException() from ve
+    if not isinstance(records, list):
+        raise InvalidBulkBodyException()
+    return _iter_array_records(records)
@@ -0,0 +1,103 @@
+import multiprocessing
+import os
+from typing import Optional
+
+from flask import Flask
+
+from datastore import DataStore
+from datastore import set_data_store
+from main import create_app as create_connexion_app
+from main import create_data_store
+from operations import populate_sample_data_if_empty
+from orm import AlchemyDatastore
+
+
+"""
+Production WSGI entry point
+
+create_app() is a WSGI app factory for pre-fork servers such as gunicorn:
+gunicorn -c gunicorn.conf.py
+
+Each worker calls create_app() after it has been forked, so every worker has its
+own DataStore and its own DB engine and connection pool. prepare_database() is
+called once by the server before any workers are started, so migrations and the
+sample data are applied by one process rather than racing in every worker.
+
+Configuration is read from environment variables:
+PANDA_DB_URL            SQLAlchemy DB URL, default sqlite:///PANDA.db
+PANDA_DATA_STORE        'alchemy' (default) or 'memory', memory is per worker so is only useful for testing
+PANDA_DB_POOL_SIZE      DB connections kept open by each worker, default: the SQLAlchemy default
+PANDA_SQLITE_WAL        Put a file based SQLite DB in WAL mode so workers' reads don't block writes, default 1
+PANDA_ECHO_SQL          Log every SQL statement, default 0
+PANDA_PROFILE_SQL       Time every SQL statement, served from GET /panda-api/admin/sql, default 1
+PANDA_SLOW_QUERY_MS     SQL statements taking at least this long are logged with their parameters, default 100
+PANDA_WORKERS           Worker processes, set by gunicorn.conf.py, default one per core plus one as gunicorn.conf.py
+PANDA_CACHE_SIZE        Patients and appointments cached by each worker, 0 turns the cache off,
+                        default 10000 with one worker, otherwise 0, see below
+PANDA_CACHE_TTL_SECS    How long a cached entity is served, default 60
+PANDA_SAMPLE_DATA       Populate an empty DB with the sample data, default 1
+PANDA_JSON              Library responses are serialised with, 'orjson' or 'json', default orjson if it is installed
+PANDA_METRICS           Record request and DataStore latencies, served from GET /panda-api/metrics, default 1
+
+The entity cache is per worker and a write only clears the cache of the worker
+which made it, so with more than one worker the others go on serving the old
+entity for up to PANDA_CACHE_TTL_SECS. The cache is off by default when there
+is more than one worker, set PANDA_CACHE_SIZE to turn it on if reads that stale
+are acceptable.
+"""
+
+
+def _get_env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _get_env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _default_cache_size() -> int:
+    # Other workers' caches aren't cleared by a write, see above
+    workers = _get_env_int('PANDA_WORKERS', multiprocessing.cpu_count() + 1)
+    return 10000 if workers == 1 else 0
+
+
+def _create_data_store() -> DataStore:
+    return create_data_store(os.environ.get('PANDA_DATA_STORE', 'alchemy'),
+                             os.environ.get('PANDA_DB_URL', 'sqlite:///PANDA.db'),
+                             pool_size=_get_env_int('PANDA_DB_POOL_SIZE', None),
+                             echo=_get_env_bool('PANDA_ECHO_SQL', False),
+                             sqlite_wal=_get_env_bool('PANDA_SQLITE_WAL', True),
+                             profile_sql=_get_env_bool('PANDA_PROFILE_SQL', True),
+                             slow_query_secs=_get_env_int('PANDA_SLOW_QUERY_MS', 100) / 1000)
+
+
+def prepare_database() -> None:
+    """
+    Apply migrations and, if configured, load the sample data into an empty DB
+    Called once in the server's master process, the DataStore is closed again before workers are forked
+    """
+    data_store = _create_data_store()
+    if _get_env_bool('PANDA_SAMPLE_DATA', True):
+        set_data_store(data_store)
+        populate_sample_data_if_empty()
+    if isinstance(data_store, AlchemyDatastore):
+        data_store.dispose()
+
+
+def create_app() -> Flask:
+    """
+    WSGI app factory, call once in each worker process
+    :return: WSGI app serving the API
+    """
+    # Sample data has already been loaded by prepare_database
+    app = create_connexion_app(_create_data_store(),
+                               entity_cache_size=_get_env_int('PANDA_CACHE_SIZE', _default_cache_size()),
+                               entity_cache_ttl_secs=_get_env_int('PANDA_CACHE_TTL_SECS', 60),
+                               load_sample_data=False,
+                               json_backend=os.environ.get('PANDA_JSON') or None,
+                               metrics=_get_env_bool('PANDA_METRICS', True))
+    return app.app